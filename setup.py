@@ -24,10 +24,15 @@ setup(
         'close'
     ],
     install_requires=[
-        'greenlet==0.2',
-        'gevent==0.12.2',
-        #'redis==1.34.1'
+        # ``gevent.ssl.SSLContext``, with SNI, and ``gevent.pywsgi``
+        'gevent>=1.1',
+        # the stream commands, e.g.: ``xgroup_create(mkstream=True)``
+        'redis>=3.0,<4'
     ],
+    extras_require = {
+        # faster json decoding in ``parse.py`` and ``dedup.py``
+        'ujson': ['ujson']
+    },
     entry_points = {
         'console_scripts': [
             'close-consume = close.consumer.consumer:main',
@@ -0,0 +1,640 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""An asyncio_ engine, for Python 3, that can be embedded in an asyncio
+  service without gevent or monkey patching:
+  
+  #. an ``AsyncConsumer``, an ``asyncio.Protocol`` based Streaming API
+     consumer with the same reconnect and backoff policies as
+     ``base.BaseConsumer.run``
+  #. an ``AsyncManager``, that looks after the consumers, with a low
+     latency handover ala ``base.BaseManager``, though it retires the
+     old consumers as soon as the new ones connect
+  #. an ``AsyncControlApp`` that responds to ``/start``, ``/stop``,
+     ``/restart`` and ``/health`` requests, ala ``base.BaseWSGIApp``
+      
+  The stream is parsed by the same ``framing.StreamParser`` as the gevent
+  engine.  Subclass ``AsyncManager`` to implement ``get_params`` and
+  ``handle_data``, ala:
+      
+      manager = Manager(AsyncConsumer, 'stream.twitter.com', PATH)
+      app = ControlApp(manager)
+      loop.run_until_complete(app.serve(port=8282))
+      manager.start_a_consumer()
+      loop.run_forever()
+      
+  If ``handle_data`` returns an awaitable, it's scheduled as a task and
+  the consumer stops reading from the socket while ``max_pending`` of
+  them are outstanding.
+  
+  The module sticks to callbacks, rather than ``async def``, so that it
+  still compiles alongside the Python 2 modules.
+  
+  .. _asyncio: https://docs.python.org/3/library/asyncio.html
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import ssl
+import uuid
+
+from urllib.parse import parse_qs, urlencode
+
+try:
+    from .backoff import ExitBackoffMixin, ReconnectBackoffMixin
+    from .framing import FramingError, StreamParser
+except (ImportError, ValueError):
+    # imported from the package's directory, like the gevent modules
+    from backoff import ExitBackoffMixin, ReconnectBackoffMixin
+    from framing import FramingError, StreamParser
+    
+# the most response header we'll read before giving up on a connection
+MAX_HEADER_SIZE = 65536
+
+class StreamProtocol(asyncio.Protocol):
+    """Sends the consumer's request, reads the status and headers of the
+      response and hands the body on to the consumer.
+    """
+    
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.transport = None
+        self.status = None
+        self._header = bytearray()
+        
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(self.consumer.request)
+        
+    
+    def data_received(self, data):
+        consumer = self.consumer
+        consumer.last_received = consumer.loop.time()
+        if self.status is None:
+            self._header += data
+            end = self._header.find(b'\r\n\r\n')
+            if end == -1:
+                if len(self._header) > MAX_HEADER_SIZE:
+                    consumer._close('tcp', 'Response header too long')
+                return
+            try:
+                self.status = int(self._header.split(None, 2)[1])
+            except (IndexError, ValueError):
+                self.status = 0
+            data = bytes(self._header[end + 4:])
+            self._header = None
+            consumer._handle_status(self.status)
+            if self.status != 200 or not data:
+                return
+        consumer._handle_body(data)
+        
+    
+    def connection_lost(self, exc):
+        self.consumer._handle_lost(self, exc)
+        
+    
+
+
+
+class AsyncConsumer(ReconnectBackoffMixin):
+    """Connect to the Streaming API and pass the messages, and connect and
+      exit events, to ``on_event(event_name, data)``.
+      
+      As in ``base.BaseConsumer.run``, network errors and timeouts back
+      off linearly, server errors back off exponentially and any other
+      status gives up without an exit event.  The gevent consumer stops
+      quietly when the server closes the stream, as that looks just like
+      being killed; here it's reported as an exit, so the manager replaces
+      it.
+    """
+    
+    delimited = 'length'
+    
+    def __init__(
+            self, host, path, port=None, params={}, headers={},
+            timeout=61, username=None, password=None,
+            min_tcp_ip_delay=0.25, max_tcp_ip_delay=16,
+            min_http_delay=10, max_http_delay=240,
+            secure=True, on_event=None, max_pending=1000, ssl_context=None,
+            loop=None
+        ):
+        if port is None:
+            port = secure and 443 or 80
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secure = secure
+        self.ssl_context = ssl_context
+        if secure and ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+        headers = dict(headers)
+        if username and password:
+            auth = base64.b64encode(
+                ('%s:%s' % (username, password)).encode('utf-8')
+            )
+            headers['Authorization'] = 'Basic %s' % auth.decode('ascii')
+        body = urlencode(params).encode('utf-8')
+        header_lines = [
+            'POST %s HTTP/1.1' % path,
+            'Host: %s' % host,
+            'Content-Length: %s' % len(body),
+            'Content-Type: application/x-www-form-urlencoded'
+        ]
+        header_lines.extend(['%s: %s' % item for item in headers.items()])
+        header_lines.extend(['', ''])
+        self.request = '\r\n'.join(header_lines).encode('utf-8') + body
+        self.timeout = timeout
+        self.min_tcp_ip_delay = min_tcp_ip_delay
+        self.max_tcp_ip_delay = max_tcp_ip_delay
+        self.min_http_delay = min_http_delay
+        self.max_http_delay = max_http_delay
+        self.on_event = on_event
+        self.max_pending = max_pending
+        self.loop = loop or asyncio.get_event_loop()
+        self.id = uuid.uuid4().hex
+        self.tcp_ip_delay = 0
+        self.http_delay = 0
+        self.last_received = None
+        self.stopped = False
+        self.transport = None
+        self.parser = None
+        # why we closed the connection, if we did
+        self._close_reason = None
+        self._timer = None
+        self._watchdog = None
+        self._pending = set()
+        self._paused = False
+        
+    
+    
+    def start(self):
+        self.stopped = False
+        self._connect()
+        
+    
+    def stop(self):
+        """Close the connection, without an exit event.
+        """
+        
+        self.stopped = True
+        for timer in self._timer, self._watchdog:
+            if timer is not None:
+                timer.cancel()
+        if self.transport is not None:
+            self.transport.close()
+        
+    
+    
+    def get_parser(self):
+        """Override to customise the parser.
+        """
+        
+        return StreamParser(delimited=self.delimited)
+        
+    
+    def _connect(self):
+        self._timer = None
+        if self.stopped:
+            return
+        self._close_reason = None
+        self.parser = self.get_parser()
+        connecting = asyncio.wait_for(
+            self.loop.create_connection(
+                lambda: StreamProtocol(self),
+                self.host,
+                self.port,
+                ssl=self.secure and self.ssl_context or None
+            ),
+            self.timeout
+        )
+        asyncio.ensure_future(connecting, loop=self.loop).add_done_callback(
+            self._handle_connection
+        )
+        
+    
+    def _handle_connection(self, future):
+        if future.cancelled():
+            return
+        err = future.exception()
+        if err is not None:
+            logging.info(err)
+            self._retry('tcp')
+            return
+        transport, protocol = future.result()
+        if self.stopped:
+            transport.close()
+            return
+        self.transport = transport
+        self.last_received = self.loop.time()
+        self._watchdog = self.loop.call_later(self.timeout, self._check_timeout)
+        
+    
+    def _check_timeout(self):
+        """Close the connection if nothing's been received for
+          ``self.timeout`` seconds, ala a socket timeout.
+        """
+        
+        idle = self.loop.time() - self.last_received
+        if idle >= self.timeout:
+            self._close('tcp', 'Timed out')
+        else:
+            self._watchdog = self.loop.call_later(
+                self.timeout - idle,
+                self._check_timeout
+            )
+        
+    
+    def _close(self, reason, message):
+        logging.info('closing connection: %s' % message)
+        self._close_reason = reason
+        if self.transport is not None:
+            self.transport.close()
+        
+    
+    def _retry(self, reason):
+        """Reconnect, after backing off according to the ``reason``.
+        """
+        
+        if reason == 'http':
+            self.http_delay = self._incr_http_delay(self.http_delay)
+            delay = self.http_delay
+        else:
+            self.tcp_ip_delay = self._incr_tcp_ip_delay(self.tcp_ip_delay)
+            delay = self.tcp_ip_delay
+        self._timer = self.loop.call_later(delay, self._connect)
+        
+    
+    
+    def _handle_status(self, status):
+        if status == 200:
+            self.tcp_ip_delay = 0
+            self.http_delay = 0
+            self._notify('connect', self.id)
+        elif status > 500:
+            self._close('http', 'HTTP %s' % status)
+        else: # we're doing something wrong
+            logging.warning(status)
+            self._close('rejected', 'HTTP %s' % status)
+        
+    
+    def _handle_body(self, data):
+        try:
+            for message in self.parser.feed(data):
+                self._notify('data', message)
+        except FramingError as err:
+            self._close('exit', str(err))
+            return
+        except Exception as err:
+            logging.warning('Fatal exception in Consumer')
+            logging.warning(err, exc_info=True)
+            self._close('exit', 'Fatal exception')
+            return
+        if self.parser.closed:
+            self._close('exit', 'Connection closed by server')
+        
+    
+    def _handle_lost(self, protocol, exc):
+        self.transport = None
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        if self.stopped:
+            return
+        reason = self._close_reason
+        if reason is None:
+            # the server hung up on us, cleanly, or otherwise
+            reason = exc is None and protocol.status == 200 and 'exit' or 'tcp'
+            if exc is not None:
+                logging.info(exc)
+        if reason in ('tcp', 'http'):
+            self._retry(reason)
+        else:
+            self.stopped = True
+            if reason == 'exit':
+                self._notify('exit', self.id)
+        
+    
+    
+    def _notify(self, event_name, data):
+        result = self.on_event(event_name, data)
+        if result is None:
+            return
+        task = asyncio.ensure_future(result, loop=self.loop)
+        self._pending.add(task)
+        task.add_done_callback(self._handled)
+        if len(self._pending) >= self.max_pending and self.transport is not None:
+            self.transport.pause_reading()
+            self._paused = True
+        
+    
+    def _handled(self, task):
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning('Failed to handle data')
+            logging.warning(task.exception())
+        if self._paused and len(self._pending) < self.max_pending / 2:
+            self._paused = False
+            if self.transport is not None:
+                self.transport.resume_reading()
+        
+    
+
+
+
+
+class AsyncManager(ExitBackoffMixin):
+    """Manages running consumer instances on an event ``loop``.
+      
+      Each call to ``start_a_consumer`` starts a new generation and the
+      consumers of earlier generations are only closed once it's
+      connected, so the stream is never dropped during a restart.  A
+      consumer that exits unexpectedly is replaced after a backoff.
+      
+      Override ``get_params`` and ``handle_data``.
+    """
+    
+    def __init__(
+            self, consumer_class, host, path, username=None, password=None,
+            min_exit_delay=0.25, max_exit_delay=16, port=None, secure=True,
+            max_pending=1000, loop=None
+        ):
+        # the consumers, and the generation each belongs to, by id
+        self.consumers = {}
+        self.generations = {}
+        self.generation = 0
+        self.num_messages = 0
+        self.consumer_class = consumer_class
+        self.host = host
+        self.path = path
+        self.port = port
+        self.secure = secure
+        self.username = username
+        self.password = password
+        self.min_exit_delay = min_exit_delay
+        self.max_exit_delay = max_exit_delay
+        self.max_pending = max_pending
+        self.loop = loop or asyncio.get_event_loop()
+        
+    
+    
+    def _handle_event(self, event_name, data):
+        return getattr(self, '_handle_%s' % event_name)(data)
+        
+    
+    def _handle_connect(self, consumer_id):
+        """When a consumer of the current generation connects, close the
+          consumers from earlier generations.
+        """
+        
+        logging.info('handle_connect %s' % consumer_id)
+        self.exit_delay = 0
+        if self.generations.get(consumer_id) != self.generation:
+            return
+        for k, consumer in list(self.consumers.items()):
+            if self.generations[k] != self.generation:
+                logging.info('stopping: %s' % k)
+                consumer.stop()
+                del self.consumers[k]
+                del self.generations[k]
+        
+    
+    def _handle_exit(self, consumer_id):
+        """If exit wasn't scheduled, start again.
+        """
+        
+        logging.info('handle_exit %s' % consumer_id)
+        if self.consumers.pop(consumer_id, None) is None:
+            return
+        generation = self.generations.pop(consumer_id)
+        self._incr_exit_delay()
+        if generation == self.generation:
+            self.loop.call_later(self.exit_delay, self._restart, generation)
+        
+    
+    def _handle_data(self, data):
+        self.num_messages += 1
+        return self.handle_data(data)
+        
+    
+    
+    def _start(self):
+        consumer = self.consumer_class(
+            self.host,
+            self.path,
+            port=self.port,
+            secure=self.secure,
+            params=self.get_params(),
+            username=self.username,
+            password=self.password,
+            headers=self.get_headers(),
+            on_event=self._handle_event,
+            max_pending=self.max_pending,
+            loop=self.loop
+        )
+        logging.info('creating new consumer %s' % consumer.id)
+        self.consumers[consumer.id] = consumer
+        self.generations[consumer.id] = self.generation
+        consumer.start()
+        
+    
+    def _restart(self, generation):
+        if generation == self.generation:
+            self._start()
+        
+    
+    def start_a_consumer(self):
+        """Fire up a new generation.
+        """
+        
+        self.generation += 1
+        self._start()
+        
+    
+    def stop_all_consumers(self):
+        """Close any consumers.
+        """
+        
+        # make sure any pending restarts are ignored
+        self.generation += 1
+        for consumer in self.consumers.values():
+            consumer.stop()
+        self.consumers = {}
+        self.generations = {}
+        
+    
+    
+    def health(self):
+        """How the consumers are getting on.
+        """
+        
+        return {
+            'consumers': len(self.consumers),
+            'messages': self.num_messages
+        }
+        
+    
+    
+    def get_params(self):
+        """Override to specify the parameters to POST to the streaming
+          API when connecting.
+        """
+        
+        raise NotImplementedError
+        
+    
+    def get_headers(self):
+        """Override to specify any extra headers to send to the streaming
+          API when connecting.
+        """
+        
+        return {}
+        
+    
+    def handle_data(self, data):
+        """Override to do something with the data, a ``bytes``.  Return
+          an awaitable to handle it asynchronously.
+        """
+        
+        raise NotImplementedError
+        
+    
+
+
+
+
+class ControlProtocol(asyncio.Protocol):
+    """Reads one HTTP request, has the app handle it and closes the
+      connection.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+        self.transport = None
+        self._buffer = bytearray()
+        
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        
+    
+    def data_received(self, data):
+        self._buffer += data
+        end = self._buffer.find(b'\r\n\r\n')
+        if end == -1:
+            if len(self._buffer) > MAX_HEADER_SIZE:
+                self.transport.close()
+            return
+        lines = bytes(self._buffer[:end]).decode('latin-1').split('\r\n')
+        length = 0
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        if len(self._buffer) < end + 4 + length:
+            return
+        body = bytes(self._buffer[end + 4:end + 4 + length]).decode('utf-8')
+        try:
+            target = lines[0].split()[1]
+        except IndexError:
+            status, response = '400 Bad Request', 'Bad Request\r\n'
+        else:
+            status, response = self.app.handle_request(target, body)
+        response = response.encode('utf-8')
+        self.transport.write(
+            (
+                'HTTP/1.0 %s\r\n'
+                'Content-Type: text/plain\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: close\r\n\r\n' % (status, len(response))
+            ).encode('latin-1') + response
+        )
+        self.transport.close()
+        
+    
+
+
+
+class AsyncControlApp(object):
+    """Responds to requests to urls in ``/self.__all__``, like
+      ``base.BaseWSGIApp``, served by ``serve``.
+      
+      Override ``handle_request_params`` as necessary.  It's only called
+      for the ``param_actions``.
+    """
+    
+    __all__ = [
+        'start',
+        'stop',
+        'restart',
+        'health'
+    ]
+    
+    # the actions that can carry new params
+    param_actions = [
+        'start',
+        'restart'
+    ]
+    
+    def __init__(self, manager):
+        self.manager = manager
+        
+    
+    
+    def _start(self):
+        self.manager.start_a_consumer()
+        
+    
+    def _stop(self):
+        self.manager.stop_all_consumers()
+        
+    
+    def _restart(self):
+        self._stop()
+        self._start()
+        
+    
+    def _health(self):
+        return json.dumps(self.manager.health(), sort_keys=True) + '\r\n'
+        
+    
+    
+    def handle_request(self, target, body):
+        """Handle a request for ``target``, returning the status and the
+          response.
+        """
+        
+        action = target.split('?')[0].strip('/').replace('/', '_')
+        if action not in self.__all__:
+            return '404 Not Found', 'Not Found\r\n'
+        if action in self.param_actions:
+            self.handle_request_params(action, parse_qs(body))
+        # actions can respond with something more useful than OK
+        response = getattr(self, '_%s' % action)()
+        return '200 OK', response or 'OK\r\n'
+        
+    
+    def serve(self, host=None, port=8282, loop=None):
+        """Start serving on ``port``, returns a coroutine that resolves
+          to the ``asyncio.Server``.
+        """
+        
+        loop = loop or self.manager.loop
+        return loop.create_server(lambda: ControlProtocol(self), host, port)
+        
+    
+    
+    def handle_request_params(self, action, params):
+        """The idea here is that, when you communicate with the
+          manager, you can pass info in the params.
+        """
+        
+        raise NotImplementedError
+        
+    
+
+
+
+
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""The queues that ``consumer.Batcher`` writes items to and that the
+  ``process.PostingParsingQueueProcessor`` reads batches from.
+  
+  Each processor delivers batches through one or more ``slots``, one per
+  batch in flight.  A slot holds on to the batch it's claimed until it's
+  acknowledged, so a batch that was in flight when a processor died is
+  read again, with the same id, from its slot on restart:
+      
+      batch = backend.read_pending(slot, num_items)
+      if batch is None:
+          batch = backend.claim(slot, num_items)
+      ... post batch.items, with batch.id ...
+      backend.ack(batch)
+      
+  A batch that's posted in parts has the bounds of the part in flight
+  stored with it, by ``save_part``, so it's read again as ``batch.part``
+  and posted again as the same part.
+  
+  ``claim`` waits for ``num_items``, unless given a ``max_linger``, in
+  which case it settles for fewer once the first of them has been
+  waiting that many seconds.
+  
+  ``ListBackend`` is the original layout, a redis list that's renamed
+  wholesale into a slot's ready list.  ``StreamBackend`` uses a redis
+  stream and a consumer group, so batches are at most ``num_items`` long
+  and any number of processors can share the stream without racing.
+"""
+
+from gevent import sleep
+from redis import Redis
+from redis.exceptions import ResponseError
+
+import logging
+import re
+import time
+import uuid
+
+from keys import DATA_KEY, NOTIFICATION_KEY, STREAM_KEY
+
+class Batch(object):
+    """Items claimed by a ``slot``, with an ``id`` that stays the same
+      until they're acknowledged.
+    """
+    
+    def __init__(self, slot, id, items, keys=None, part=None):
+        self.slot = slot
+        self.id = id
+        self.items = items
+        # what the backend needs to acknowledge the items
+        self.keys = keys
+        # the ``(start, end)`` of the part in flight, if any
+        self.part = part
+        
+    
+
+
+
+def _dump_part(batch, start, end):
+    return '%s %d %d' % (batch.id, start, end)
+    
+    
+
+def _load_part(batch_id, value):
+    """The ``(start, end)`` stored by ``_dump_part``, if it's for the
+      batch called ``batch_id``.
+    """
+    
+    if value is None:
+        return None
+    part_batch_id, start, end = value.rsplit(' ', 2)
+    if part_batch_id != batch_id:
+        return None
+    return int(start), int(end)
+    
+
+
+
+def _slots(prefix, concurrency):
+    # the first slot keeps the plain name, so slots left by a serial
+    # processor are picked up
+    return [prefix] + ['%s.%d' % (prefix, i) for i in range(1, concurrency)]
+    
+    
+
+def _is_orphan(prefix, concurrency, slot):
+    match = re.match(r'^%s\.(\d+)$' % re.escape(prefix), slot)
+    return match is not None and int(match.group(1)) >= concurrency
+    
+    
+
+
+class ListBackend(object):
+    """Items are ``RPUSH``ed onto ``data_key``, with a notification on
+      ``notification_key`` per write.  Once there are ``num_items`` in
+      ``data_key``, a slot claims all of them by renaming ``data_key`` to
+      its ready list, ``data_key.name[.n]``.
+    """
+    
+    # how often to check on items that are lingering
+    poll_interval = 0.01
+    
+    def __init__(self, redis, data_key, notification_key):
+        self.redis = redis
+        self.data_key = data_key
+        self.notification_key = notification_key
+        # when each slot first saw the items in ``data_key`` that are
+        # waiting for there to be ``num_items``, as each slot's
+        # ``claim`` runs in its own greenlet
+        self._waiting_since = {}
+        
+    
+    def write(self, items):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.rpush(self.data_key, *items)
+        pipe.rpush(self.notification_key, 1)
+        pipe.execute()
+        
+    
+    
+    def slots(self, name, concurrency):
+        return _slots('%s.%s' % (self.data_key, name), concurrency)
+        
+    
+    def orphaned_slots(self, name, concurrency):
+        """Find the ready lists left by running with a higher
+          ``concurrency``.
+        """
+        
+        prefix = '%s.%s' % (self.data_key, name)
+        return sorted(
+            key for key in self.redis.keys('%s.*' % prefix)
+            if _is_orphan(prefix, concurrency, key)
+        )
+        
+    
+    def _batch_id(self, slot):
+        id_key = '%s.id' % slot
+        batch_id = self.redis.get(id_key)
+        if batch_id is None:
+            # the process died between the rename and setting the id
+            batch_id = uuid.uuid4().hex
+            self.redis.set(id_key, batch_id)
+        return batch_id
+        
+    
+    def read_pending(self, slot, num_items):
+        """The batch in ``slot``'s ready list, or ``None``.
+        """
+        
+        if not self.redis.llen(slot):
+            return None
+        items = self.redis.lrange(slot, 0, -1)
+        batch_id = self._batch_id(slot)
+        part = _load_part(batch_id, self.redis.get('%s.part' % slot))
+        return Batch(slot, batch_id, items, part=part)
+        
+    
+    def claim(self, slot, num_items, max_linger=0):
+        """Block waiting for a notification, then, if there are
+          ``num_items`` in ``data_key``, or the ones there have lingered
+          long enough, move them into ``slot``'s ready list, neatly
+          clearing ``data_key`` in the same fell swoop.  Returns ``None``
+          if there weren't enough, or another slot got there first.
+          
+          While items are lingering, ``data_key`` is polled instead, so the
+          notifications build up.  They're all for the items claimed, so
+          they're cleared along with ``data_key``.
+        """
+        
+        waiting_since = self._waiting_since.get(slot)
+        if max_linger and waiting_since is not None:
+            due = waiting_since + max_linger - time.time()
+            sleep(max(0, min(due, self.poll_interval)))
+        else:
+            logging.debug('blocking waiting for %s' % self.notification_key)
+            self.redis.blpop([self.notification_key])
+        n = self.redis.llen(self.data_key)
+        logging.debug(n)
+        if not n:
+            self._waiting_since.pop(slot, None)
+            return None
+        if n < num_items:
+            if not max_linger:
+                return None
+            now = time.time()
+            if waiting_since is None:
+                self._waiting_since[slot] = waiting_since = now
+            if now - waiting_since < max_linger:
+                return None
+        self._waiting_since.pop(slot, None)
+        # in one transaction, so no write's notification is lost between
+        # the two
+        pipe = self.redis.pipeline()
+        pipe.rename(self.data_key, slot)
+        pipe.delete(self.notification_key)
+        try:
+            pipe.execute()
+        except ResponseError:
+            return None
+        self.redis.set('%s.id' % slot, uuid.uuid4().hex)
+        return self.read_pending(slot, num_items)
+        
+    
+    def save_part(self, batch, start, end):
+        self.redis.set('%s.part' % batch.slot, _dump_part(batch, start, end))
+        batch.part = (start, end)
+        
+    
+    def ack(self, batch):
+        slot = batch.slot
+        self.redis.delete(slot, '%s.id' % slot, '%s.part' % slot)
+        
+    
+
+
+
+class StreamBackend(object):
+    """Items are ``XADD``ed to ``stream_key`` and read by the slots as
+      consumers in the consumer ``group``, ``num_items`` at a time, with
+      ``XREADGROUP``.  Acknowledged items are deleted from the stream.
+      
+      A slot's pending entries, that it's read but not acknowledged, are
+      its batch in flight.  The batch id is made from the first and last
+      entry ids, so it's the same when the batch is read again.  The
+      slots' parts in flight are kept in a hash, ``stream_key.parts``.
+      
+      Needs redis >= 5.0.
+    """
+    
+    # the field each item is stored in
+    field = 'd'
+    # how often to top up a batch that's lingering
+    poll_interval = 0.01
+    
+    def __init__(self, redis, stream_key, group='processors'):
+        self.redis = redis
+        self.stream_key = stream_key
+        self.group = group
+        self.parts_key = '%s.parts' % stream_key
+        self._has_group = False
+        
+    
+    def write(self, items):
+        pipe = self.redis.pipeline(transaction=False)
+        for item in items:
+            pipe.xadd(self.stream_key, {self.field: item})
+        pipe.execute()
+        
+    
+    
+    def _ensure_group(self):
+        if self._has_group:
+            return
+        try:
+            # start from the beginning of the stream, so items written
+            # before the first processor started aren't skipped
+            self.redis.xgroup_create(self.stream_key, self.group, '0', mkstream=True)
+        except ResponseError, err:
+            if 'BUSYGROUP' not in str(err):
+                raise
+        self._has_group = True
+        
+    
+    def slots(self, name, concurrency):
+        return _slots(name, concurrency)
+        
+    
+    def orphaned_slots(self, name, concurrency):
+        """Find the consumers, left by running with a higher
+          ``concurrency``, that have batches in flight.
+        """
+        
+        self._ensure_group()
+        return sorted(
+            consumer['name']
+            for consumer in self.redis.xinfo_consumers(self.stream_key, self.group)
+            if consumer['pending'] and _is_orphan(name, concurrency, consumer['name'])
+        )
+        
+    
+    def _read(self, slot, num_items, start, block=None):
+        self._ensure_group()
+        response = self.redis.xreadgroup(
+            self.group,
+            slot,
+            {self.stream_key: start},
+            count=num_items,
+            block=block
+        )
+        entries = response and response[0][1] or []
+        if not entries:
+            return None
+        ids = [entry_id for entry_id, fields in entries]
+        # entries deleted while pending come back without their fields
+        items = [fields[self.field] for entry_id, fields in entries if fields]
+        return Batch(slot, '%s:%s' % (ids[0], ids[-1]), items, keys=ids)
+        
+    
+    def read_pending(self, slot, num_items):
+        """The entries ``slot`` has read but not acknowledged, or ``None``.
+        """
+        
+        batch = self._read(slot, num_items, '0')
+        if batch is not None:
+            batch.part = _load_part(batch.id, self.redis.hget(self.parts_key, slot))
+        return batch
+        
+    
+    def claim(self, slot, num_items, max_linger=0):
+        """Block waiting for new entries, then read up to ``num_items`` of
+          them, topping them up for up to ``max_linger`` seconds if there
+          weren't that many.
+        """
+        
+        batch = self._read(slot, num_items, '>', block=0)
+        if not max_linger or batch is None:
+            return batch
+        deadline = time.time() + max_linger
+        items = batch.items
+        keys = batch.keys
+        while len(keys) < num_items and time.time() < deadline:
+            sleep(min(self.poll_interval, max(0, deadline - time.time())))
+            more = self._read(slot, num_items - len(keys), '>')
+            if more is not None:
+                items.extend(more.items)
+                keys.extend(more.keys)
+        return Batch(slot, '%s:%s' % (keys[0], keys[-1]), items, keys=keys)
+        
+    
+    def save_part(self, batch, start, end):
+        self.redis.hset(self.parts_key, batch.slot, _dump_part(batch, start, end))
+        batch.part = (start, end)
+        
+    
+    def ack(self, batch):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xack(self.stream_key, self.group, *batch.keys)
+        pipe.xdel(self.stream_key, *batch.keys)
+        pipe.hdel(self.parts_key, batch.slot)
+        pipe.execute()
+        
+    
+
+
+
+def make_redis(host='localhost', port=6379, db=0):
+    """A client for the redis the backends live in.  It doesn't connect
+      until it's first used.
+    """
+    
+    return Redis(host=host, port=port, db=db)
+    
+    
+
+def make_backend(redis, name='list'):
+    """The implementation called ``name``, on the keys in ``keys.py``.
+    """
+    
+    if name == 'stream':
+        return StreamBackend(redis, STREAM_KEY)
+    return ListBackend(redis, DATA_KEY, NOTIFICATION_KEY)
+    
+    
+
+
+
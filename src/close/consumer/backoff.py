@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""The reconnection backoff policies, shared by the gevent and asyncio
+  engines, see ``base.py`` and ``aio.py``.
+  
+  Doesn't depend on gevent and runs on Python 2 and 3.
+"""
+
+import logging
+
+class ReconnectBackoffMixin(object):
+    """How long a consumer waits before reconnecting, depending on what
+      went wrong.  Expects ``min_tcp_ip_delay``, ``max_tcp_ip_delay``,
+      ``min_http_delay`` and ``max_http_delay`` attributes.
+    """
+    
+    def _incr_tcp_ip_delay(self, delay):
+        """When a network error (TCP/IP level) is encountered,
+          back off linearly.
+        """
+        
+        min_ = self.min_tcp_ip_delay
+        max_ = self.max_tcp_ip_delay
+        
+        delay += min_
+        if delay > max_:
+            delay = max_
+        if delay == max_:
+            logging.warning('Consumer reached max tcp ip delay')
+        return delay
+        
+    
+    def _incr_http_delay(self, delay):
+        """When an http error (> 200) is returned, back off
+          exponentially.
+              
+              >>> d = _incr_http_delay(0)
+              >>> d
+              10
+              >>> d = _incr_http_delay(d)
+              >>> d
+              30
+              >>> d = _incr_http_delay(d)
+              >>> d
+              70
+              >>> d = _incr_http_delay(d)
+              >>> d
+              150
+              >>> d = _incr_http_delay(d)
+              >>> d
+              240
+              >>> d = _incr_http_delay(d)
+              >>> d
+              240
+            
+        """
+        
+        min_ = self.min_http_delay
+        max_ = self.max_http_delay
+        
+        delay = min_ + min_ * delay / 5
+        if delay > max_:
+            delay = max_
+        if delay == max_:
+            logging.warning('Consumer reached max http delay')
+        return delay
+        
+    
+
+
+
+class ExitBackoffMixin(object):
+    """How long a manager waits before replacing a consumer that exited
+      unexpectedly.  Expects ``min_exit_delay`` and ``max_exit_delay``
+      attributes and keeps the current delay in ``exit_delay``.
+    """
+    
+    # we back off from repeated unexpected exits
+    exit_delay = 0
+    
+    def _incr_exit_delay(self):
+        """When a network error (TCP/IP level) is encountered,
+          back off linearly.
+        """
+        
+        delay = self.exit_delay
+        
+        min_ = self.min_exit_delay
+        max_ = self.max_exit_delay
+        
+        delay += min_
+        
+        if delay > max_:
+            delay = max_
+        if delay == max_:
+            logging.warning('Manager reached max unexpected exit delay')
+            
+        self.exit_delay = delay
+        
+    
+
+
+
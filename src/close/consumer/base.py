@@ -9,26 +9,39 @@
      running in their own ``gevent.Greenlet`` thread
   #. an ultra-simple WSGI app to recieve ``/stop``, ``/start`` and 
      ``/restart`` instructions
-  
-  See ``consumer.py`` for a specific implementation.
+      
+  See ``consumer.py`` for a specific implementation.  Importing this
+  doesn't monkey patch the standard library; call ``utils.monkey_patch``
+  before starting anything that talks to other services through it, e.g.:
+  redis.
   
   .. _gevent: http://www.gevent.org/
 """
 
 import gevent
 
-from gevent import monkey
-monkey.patch_all()
-
-from gevent import queue
-notification_queue = queue.Queue()
-
-from gevent import sleep, socket, ssl
+from gevent import event, sleep, socket
 
 import cgi
 import logging
 import httplib
+import os
+import time
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+    
+from backoff import ExitBackoffMixin, ReconnectBackoffMixin
+from connect import Connector
+from dedup import Deduplicator
+from framing import FramingError, StreamParser
+from metrics import Metrics
+from queues import NotificationQueue, SPILL
+from sampler import Profiler
+from spill import SpillQueue
+from trace import Traced, Tracer
 from utils import generate_hash, generate_auth_header, unicode_urlencode
 
 class ChunkReadingMixin(object):
@@ -43,6 +56,13 @@ class ChunkReadingMixin(object):
     sock = NotImplemented
     chunk_left = None
     
+    def _reset_buffer(self):
+        """Forget any chunk state left over from a previous connection.
+        """
+        
+        self.chunk_left = None
+        
+    
     def _safe_read(self, amt):
         s = []
         while amt > 0:
@@ -110,31 +130,204 @@ class ChunkReadingMixin(object):
         return ''.join(chars).strip()
         
     
+
+
+
+class BufferedChunkReadingMixin(ChunkReadingMixin):
+    """Drop in replacement for ``ChunkReadingMixin`` that reads from the
+      socket in ``buffer_size`` blocks and parses chunk sizes, CRLFs and
+      lines out of an in memory buffer, rather than calling 
+      ``self.sock.recv(1)`` for every byte of every line.
+      
+      The buffer is a preallocated ``bytearray`` that the socket reads
+      straight into using ``recv_into``.  When a message spans chunks, the
+      chunk boundaries are spliced out of the buffer in place, so it's
+      copied out in one go, rather than joined together.
+    """
+    
+    buffer_size = 65536
+    
+    # ``_rbuf[_rpos:_rend]`` is the data we've received but not yet read,
+    # ``_rpin``, if set, is the start of a message we're still assembling
+    _rbuf = None
+    _rpos = 0
+    _rend = 0
+    _rpin = None
+    
+    def _reset_buffer(self):
+        self._rbuf = bytearray(self.buffer_size)
+        self._rpos = 0
+        self._rend = 0
+        self._rpin = None
+        self.chunk_left = None
+        
+    
+    def _recv_into(self, view):
+        """Read into ``view``, falling back on ``recv`` for sockets that
+          don't support ``recv_into``.
+        """
+        
+        recv_into = getattr(self.sock, 'recv_into', None)
+        if recv_into is None:
+            data = self.sock.recv(len(view))
+            view[:len(data)] = data
+            return len(data)
+        return recv_into(view)
+        
+    
+    def _fill(self):
+        """Read the next block from the socket into the free space at the 
+          end of the buffer, first moving the data we still need to the
+          front of the buffer, or growing it, if we're running out of room.
+        """
+        
+        buf = self._rbuf
+        size = len(buf)
+        start = self._rpos if self._rpin is None else self._rpin
+        if start and (start == self._rend or size - self._rend < size / 4):
+            n = self._rend - start
+            if n:
+                buf[:n] = buf[start:self._rend]
+            self._rpos -= start
+            self._rend = n
+            if self._rpin is not None:
+                self._rpin -= start
+        elif self._rend == size:
+            buf = bytearray(size * 2)
+            buf[:size] = self._rbuf
+            self._rbuf = buf
+        n = self._recv_into(memoryview(buf)[self._rend:])
+        if not n:
+            raise gevent.GreenletExit('Connection closed by server')
+        self._rend += n
+        
+    
+    def _safe_read(self, amt):
+        while self._rend - self._rpos < amt:
+            self._fill()
+        start = self._rpos
+        self._rpos = start + amt
+        return str(self._rbuf[start:self._rpos])
+        
+    
+    def _safe_readline(self):
+        i = self._rbuf.find('\n', self._rpos, self._rend)
+        while i == -1:
+            searched = self._rend - self._rpos
+            self._fill()
+            i = self._rbuf.find('\n', self._rpos + searched, self._rend)
+        start = self._rpos
+        self._rpos = i + 1
+        return str(self._rbuf[start:i]).strip()
+        
+    
+    
+    def _next_chunk(self):
+        """Toss the CRLF at the end of the current chunk, if there is one,
+          and read the size of the next chunk.
+        """
+        
+        if self.chunk_left == 0:
+            self._safe_read(2)
+        line = self._safe_readline()
+        try:
+            self.chunk_left = int(line, 16)
+        except ValueError:
+            raise gevent.GreenletExit('Lost chunk sync')
+        if not self.chunk_left:
+            raise gevent.GreenletExit('Connection closed by server')
+        
     
+    def _read_chunked(self, amt):
+        """Read ``amt`` bytes of the decoded stream.  If they span more
+          than one chunk, the CRLF and chunk size line in between are
+          cut out of the buffer, so the bytes can be copied out in one go.
+        """
+        
+        if amt is None:
+            return super(BufferedChunkReadingMixin, self)._read_chunked(amt)
+        if not self.chunk_left:
+            self._next_chunk()
+        self._rpin = self._rpos
+        have = 0
+        try:
+            while True:
+                take = min(self.chunk_left, amt - have)
+                while self._rend - self._rpos < take:
+                    self._fill()
+                self._rpos += take
+                self.chunk_left -= take
+                have += take
+                if have == amt:
+                    return str(self._rbuf[self._rpin:self._rpos])
+                # splice the chunk boundary out of the buffer
+                self._next_chunk()
+                gap = self._rpin + have
+                n = self._rpos - gap
+                buf = self._rbuf
+                buf[gap:self._rend - n] = buf[self._rpos:self._rend]
+                self._rend -= n
+                self._rpos = gap
+        finally:
+            self._rpin = None
+        
+    
+    def _readline_chunked(self):
+        s = []
+        while True:
+            if not self.chunk_left:
+                self._next_chunk()
+            if self._rpos == self._rend:
+                self._fill()
+            end = min(self._rend, self._rpos + self.chunk_left)
+            i = self._rbuf.find('\n', self._rpos, end)
+            if i > -1:
+                end = i + 1
+            s.append(str(self._rbuf[self._rpos:end]))
+            self.chunk_left -= end - self._rpos
+            self._rpos = end
+            if i > -1:
+                return ''.join(s).strip()
+        
+    
+
 
 
-class BaseConsumer(ChunkReadingMixin):
+class BaseConsumer(BufferedChunkReadingMixin, ReconnectBackoffMixin):
     """Connect to the Streaming API and put data into the queue.
+      
+      Set ``delimited`` to ``'length'`` or ``'newline'`` to have the
+      stream parsed by a ``framing.StreamParser``, or leave it as ``None``
+      and override ``get_data`` to read from the stream yourself.
+      
+      If passed a ``metrics.Metrics``, the consumer counts what it reads
+      and why it reconnects into it.  If passed a ``trace.Tracer``, it
+      traces a sample of the messages it reads.
+      
+      Connections are opened by the ``connect.Connector`` passed in, which
+      the manager shares between its consumers, or by one of its own.
     """
     
     sock = None
+    delimited = None
     
     def __init__(
             self, host, path, port=None, params={}, headers={},
             timeout=61, username=None, password=None, 
             min_tcp_ip_delay=0.25, max_tcp_ip_delay=16,
             min_http_delay=10, max_http_delay=240,
-            secure=True
+            secure=True, notification_queue=None, metrics=None, tracer=None,
+            connector=None
         ):
         """Store config and build the connection headers.
         """
-
+        
         if port is None:
             if secure:
                 port = 443
             else:
                 port = 80
-
+            
         self.host = host
         self.port = port
         self.path = path
@@ -158,84 +351,92 @@ class BaseConsumer(ChunkReadingMixin):
         self.max_tcp_ip_delay = max_tcp_ip_delay
         self.min_http_delay = min_http_delay
         self.max_http_delay = max_http_delay
+        self.notification_queue = notification_queue
+        self.metrics = metrics
+        self.tracer = tracer
+        if connector is None:
+            connector = Connector(host, port, secure=secure, timeout=timeout)
+        self.connector = connector
         self.id = generate_hash()
         
     
     
-    def _incr_tcp_ip_delay(self, delay):
-        """When a network error (TCP/IP level) is encountered, 
-          back off linearly.
-        """
-        
-        min_ = self.min_tcp_ip_delay
-        max_ = self.max_tcp_ip_delay
-        
-        delay += min_
-        if delay > max_:
-            delay = max_
-        if delay == max_:
-            logging.warning('Consumer reached max tcp ip delay')
-        return delay
-        
-    
-    def _incr_http_delay(self, delay):
-        """When an http error (> 200) is returned, back off 
-          exponentially.
-          
-              >>> d = _incr_http_delay(0)
-              >>> d
-              10
-              >>> d = _incr_http_delay(d)
-              >>> d
-              30
-              >>> d = _incr_http_delay(d)
-              >>> d
-              70
-              >>> d = _incr_http_delay(d)
-              >>> d
-              150
-              >>> d = _incr_http_delay(d)
-              >>> d
-              240
-              >>> d = _incr_http_delay(d)
-              >>> d
-              240
-          
-        """
-        
-        min_ = self.min_http_delay
-        max_ = self.max_http_delay
-        
-        delay = min_ + min_ * delay / 5
-        if delay > max_:
-            delay = max_
-        if delay == max_:
-            logging.warning('Consumer reached max http delay')
-        return delay
-        
-    
-    
     def _notify(self, event_name, data):
-        """Puts an {event_name: data} item into a gevent queue_
-          
-          .. _queue: http://www.gevent.org/gevent.queue.html
+        """Puts an {event_name: data} item into the manager's
+          ``queues.NotificationQueue``.  Only data is subject to
+          the queue's overload policy.
         """
         
+        if isinstance(data, Traced):
+            data.stamp('notify')
         item = {}
         item[event_name] = data
-        notification_queue.put_nowait(item)
+        self.notification_queue.put(item, droppable=event_name == 'data')
         
     
     def _consume_stream(self):
         """Consume the stream ad infinitum.
         """
         
-        while True:
-            data = self.get_data()
-            if data:
-                self._notify('data', data)
+        metrics = self.metrics
+        tracer = self.tracer
+        # tell the manager once the stream's flowing, see
+        # ``BaseManager._handle_stream``
+        streaming = False
+        if self.delimited is None:
+            while True:
+                data = self.get_data()
+                if data:
+                    if metrics is not None:
+                        metrics.messages += 1
+                    if tracer is not None:
+                        messages = [data]
+                        tracer.trace(messages, time.time())
+                        data = messages[0]
+                    self._notify('data', data)
+                    if not streaming:
+                        self._notify('stream', self.id)
+                        streaming = True
             
         
+        parser = self.get_parser()
+        buf = self._rbuf
+        view = memoryview(buf)
+        try:
+            # start with whatever we read past the end of the headers
+            n = self._rend - self._rpos
+            received_at = time.time()
+            messages = parser.feed(buf, self._rpos, self._rend)
+            num_chunks = 0
+            while True:
+                if metrics is not None:
+                    # just adding up ints, so it's cheap enough to do
+                    # for every read
+                    metrics.bytes_received += n
+                    metrics.messages += len(messages)
+                    metrics.chunks += parser.num_chunks - num_chunks
+                    num_chunks = parser.num_chunks
+                if tracer is not None and messages:
+                    tracer.trace(messages, received_at)
+                for data in messages:
+                    self._notify('data', data)
+                if messages and not streaming:
+                    self._notify('stream', self.id)
+                    streaming = True
+                if parser.closed:
+                    raise gevent.GreenletExit('Connection closed by server')
+                # reading from a socket that has data waiting doesn't
+                # yield, so give the notification workers a look in
+                sleep(0)
+                n = self._recv_into(view)
+                if not n:
+                    raise gevent.GreenletExit('Connection closed by server')
+                if tracer is not None:
+                    received_at = time.time()
+                messages = parser.feed(buf, 0, n)
+        except FramingError, err:
+            raise gevent.GreenletExit(str(err))
+        
     
     
     def _get_status_and_consume_headers(self):
@@ -254,40 +455,57 @@ class BaseConsumer(ChunkReadingMixin):
         return status
         
     
+    def get_parser(self):
+        """Override to customise the parser used when ``self.delimited``.
+        """
+        
+        return StreamParser(delimited=self.delimited)
+        
+    
     def get_data(self):
-        """Overwrite to read data.
+        """Overwrite to read data, if not ``self.delimited``.
         """
         
         raise NotImplementedError
         
     
     
+    def _close(self):
+        # we might have been stopped before we'd connected
+        if self.sock is not None:
+            self.sock.close()
+        
+    
     def run(self):
+        metrics = self.metrics
         tcp_ip_delay = 0
         http_delay = 0
         notify_on_exit = True
         while True:
             try:
-                raw_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                if self.secure:
-                    self.sock = ssl.wrap_socket(raw_sock)
-                else:
-                    self.sock = raw_sock
-                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                self.sock = None
+                self._reset_buffer()
+                self.sock = self.connector.connect()
                 self.sock.settimeout(self.timeout)
-                self.sock.connect((self.host, self.port))
-                self.sock.send(self.headers)
-                self.sock.send(self.body)
+                # in one go, so Nagle's algorithm doesn't hold the body
+                # back waiting for the headers to be acked
+                self.sock.sendall(self.headers + self.body)
                 status = self._get_status_and_consume_headers()
                 if status == 200:
                     self._notify('connect', self.id)
                     tcp_ip_delay = 0
                     http_delay = 0
+                    if metrics is not None:
+                        metrics.tcp_ip_delay = 0
+                        metrics.http_delay = 0
                     self._consume_stream()
                 else:
                     self.sock.close()
                     if status > 500:
                         http_delay = self._incr_http_delay(http_delay)
+                        if metrics is not None:
+                            metrics.reconnects['http'] += 1
+                            metrics.http_delay = http_delay
                         sleep(http_delay)
                     else: # we're doing something wrong
                         logging.warning(status)
@@ -295,107 +513,281 @@ class BaseConsumer(ChunkReadingMixin):
                         break
             except (socket.timeout, socket.error), err:
                 logging.info(err, exc_info=True)
-                self.sock.close()
+                self._close()
                 tcp_ip_delay = self._incr_tcp_ip_delay(tcp_ip_delay)
+                if metrics is not None:
+                    metrics.reconnects['tcp'] += 1
+                    metrics.tcp_ip_delay = tcp_ip_delay
                 sleep(tcp_ip_delay)
             except gevent.GreenletExit:
-                self.sock.close()
+                self._close()
                 notify_on_exit = False
                 break
             except Exception, err:
                 logging.warning('Fatal exception in Consumer')
                 logging.warning(err, exc_info=True)
-                self.sock.close()
+                self._close()
                 break
         if notify_on_exit:
             self._notify('exit', self.id)
         
-        
+    
     def get_headers(self):
         return {}
+        
+    
+
+
+# the predicates that are split between shards, the rest of the
+# params are sent to all of them
+PARTITIONED_PARAMS = ('follow', 'track')
+
+def partition_params(params, num_shards):
+    """Split the comma separated ``follow`` and ``track`` predicates in
+      ``params`` between up to ``num_shards`` sets of params, so that each
+      gets roughly the same number of predicates.  Shards that would have
+      no predicates are left out, but there's always at least one.
+    """
+    
+    predicates = []
+    for k in PARTITIONED_PARAMS:
+        if params.get(k):
+            predicates.extend((k, v) for v in params[k].split(','))
+    num_shards = max(1, min(num_shards, len(predicates)))
+    common = dict(
+        (k, v) for k, v in params.iteritems() if k not in PARTITIONED_PARAMS
+    )
+    shards = [dict(common) for i in range(num_shards)]
+    values = [{} for i in range(num_shards)]
+    for i, (k, v) in enumerate(predicates):
+        values[i % num_shards].setdefault(k, []).append(v)
+    for shard, shard_values in zip(shards, values):
+        for k, v in shard_values.iteritems():
+            shard[k] = ','.join(v)
+    return shards
     
     
 
 
-class BaseManager(object):
+class BaseManager(ExitBackoffMixin):
     """Manages running consumer instances in their own greenlet.
       
       Handles low latency restarts and unexpected errors.  To use,
       override ``get_params`` and ``handle_data`` and pass an 
       instance of your implementation to a subclass of 
       ``BaseWSGIApp``'s constructor.
+      
+      If ``num_shards`` is more than one, the predicates from
+      ``get_params`` are split between up to that many consumers, see
+      ``partition_params``, which all feed the same ``handle_data``.
+      Each time ``start_a_consumer`` is called, a new generation of
+      consumers is started, one per shard, and the previous generation
+      is only killed once they've all connected, so no predicate goes
+      uncovered when they're reshuffled between shards.  If a consumer
+      exits unexpectedly, just its shard is restarted.
+      
+      Messages seen in the last ``dedup_window`` seconds, e.g.: while old
+      and new consumers overlap, are dropped, see ``dedup.Deduplicator``.
+      
+      If a ``worker_slice`` of ``(index, count)`` is provided, the manager
+      only takes the ``index``th of ``count`` partitions of the predicates,
+      so that ``count`` managers, e.g.: in different processes, see
+      ``supervisor.py``, can share them out.
+      
+      Unless ``enable_metrics`` is ``False``, the manager and its
+      consumers keep count of what they're up to in ``self.metrics``, see
+      ``render_metrics``.
+      
+      Set ``trace_sample_rate`` to trace that fraction of the messages
+      through the pipeline, see ``trace.py``.
+      
+      A new generation takes over from the old one once each of its
+      consumers has streamed some data, or ``max_overlap`` seconds after
+      they've all connected, if the stream's too quiet to tell.
+      
+      ``update`` hot swaps the consumers for a generation with the latest
+      params, like ``start_a_consumer``, but debounced, so that a burst
+      of updates only reconnects once every ``min_update_interval``
+      seconds, and it reports how long the old and new generations
+      overlapped, or the gap between them.
+      
+      The consumers share a ``connect.Connector``, which caches the
+      host's addresses for ``dns_ttl`` seconds and, with ``prewarm``,
+      keeps a spare connection ready, so a restart or reconnect doesn't
+      wait on DNS or the TCP and TLS handshakes.
     """
     
-    # we keep a dictionary of consumers, using the consumer.id
-    # as the dictionary key and the greenlet they're running in
-    # as the value
-    consumers = {}
-    active_consumer_id = None
-    
-    # we back off from repeated unexpected exits
-    exit_delay = 0
+    # time one in this many calls to ``_handle_data``
+    latency_sample_rate = 256
     
     def __init__(
             self, consumer_class, host, path, username=None, password=None, 
-            num_workers=10, min_exit_delay=0.25, max_exit_delay=16
+            num_workers=10, min_exit_delay=0.25, max_exit_delay=16,
+            port=None, secure=True, queue_size=10000, overload_policy='block',
+            spill_dir=None, num_shards=1, worker_slice=None, dedup_window=30,
+            dedup_size=100000, enable_metrics=True, trace_sample_rate=0,
+            dns_ttl=60, prewarm=False, min_update_interval=10,
+            max_overlap=5
         ):
+        # we keep a dictionary of consumers, using the consumer.id
+        # as the dictionary key and the greenlet they're running in
+        # as the value, and a dictionary of the generation and shard
+        # each one belongs to
+        self.consumers = {}
+        self.shards = {}
+        self.generation = 0
+        # the params for each shard of the current generation and the
+        # ids of its consumers that have connected, by shard
+        self.partitions = []
+        self.active_consumer_ids = {}
+        # the ids of its consumers that have streamed data, by shard, and
+        # when it connected, first streamed data, was streaming on every
+        # shard and retired the earlier generations
+        self.streaming_consumer_ids = {}
+        self.max_overlap = max_overlap
+        self._handover = {}
+        self.num_shards = num_shards
+        self.worker_slice = worker_slice
+        # the debounced update waiting to happen, the updates waiting on
+        # their generation to connect, by generation, and the last one
+        # to have done so
+        self.min_update_interval = min_update_interval
+        self.next_update = None
+        self._next_swap = None
+        self.num_coalesced = 0
+        self.swaps = {}
+        self.last_update = None
+        self.num_updates = 0
+        self._updated_at = 0
+        self.num_messages = 0
+        # overlapping consumers see the same statuses, so drop the
+        # duplicates, unless ``dedup_window`` is ``0``
+        self.deduplicator = None
+        if dedup_window:
+            self.deduplicator = Deduplicator(
+                window=dedup_window,
+                max_size=dedup_size
+            )
+        # shared with the consumers
+        self.metrics = None
+        if enable_metrics:
+            self.metrics = Metrics()
+        self.tracer = None
+        if trace_sample_rate:
+            self.tracer = Tracer(trace_sample_rate)
         self.consumer_class = consumer_class
         self.host = host
         self.path = path
+        self.port = port
+        self.secure = secure
         self.username = username
         self.password = password
         self.min_exit_delay = min_exit_delay
         self.max_exit_delay = max_exit_delay
+        if port is None:
+            port = secure and 443 or 80
+        self.connector = Connector(
+            host,
+            port,
+            secure=secure,
+            dns_ttl=dns_ttl,
+            prewarm=prewarm
+        )
+        # each manager has its own, bounded, notification queue
+        spill = None
+        if overload_policy == SPILL:
+            spill = SpillQueue(os.path.join(spill_dir or '.', 'notifications'))
+        self.notification_queue = NotificationQueue(
+            maxsize=queue_size,
+            policy=overload_policy,
+            spill=spill
+        )
         # spawn worker greenlets to handle notifications
         for i in range(num_workers):
             gevent.spawn(self._handle_event)
         
     
     
-    def _incr_exit_delay(self):
-        """When a network error (TCP/IP level) is encountered, 
-          back off linearly.
+    def _handle_connect(self, consumer_id):
+        """When a consumer connects successuflly, and it completes the
+          current generation, give it ``max_overlap`` seconds to start
+          streaming before retiring the earlier generations anyway.
         """
         
-        delay = self.exit_delay
-        
-        min_ = self.min_exit_delay
-        max_ = self.max_exit_delay
-        
-        delay += min_
-        
-        if delay > max_:
-            delay = max_
-        if delay == max_:
-            logging.warning('Manager reached max unexpected exit delay')
+        logging.info('handle_connect %s' % consumer_id)
+        logging.info(self.consumers)
         
-        self.exit_delay = delay
+        self.exit_delay = 0
+        if self.metrics is not None:
+            self.metrics.exit_delay = 0
+        # it may have been killed, or stopped, since it connected
+        item = self.shards.get(consumer_id)
+        if item is None:
+            return
+        generation, shard = item
+        if generation != self.generation:
+            return
+        self.active_consumer_ids[shard] = consumer_id
+        if len(self.active_consumer_ids) < len(self.partitions):
+            return
+        handover = self._handover
+        if 'connected_at' in handover:
+            return
+        handover['connected_at'] = time.time()
+        gevent.spawn_later(self.max_overlap, self._retire, generation)
         
     
-    
-    def _handle_connect(self, consumer_id):
-        """When a consumer connects successuflly, kill any other
-          active consumers.
+    def _handle_stream(self, consumer_id):
+        """When a consumer starts streaming, and it completes the current
+          generation, kill any consumers from earlier generations.
           
           This approach enables a low latecy restart, i.e.: only 
-          kill the active consumer when the new one is actually
+          kill the active consumers when the new ones are actually
           up and running.
         """
         
-        logging.info('handle_connect %s' % consumer_id)
-        logging.info(self.consumers)
+        item = self.shards.get(consumer_id)
+        if item is None:
+            return
+        generation, shard = item
+        if generation != self.generation:
+            return
+        handover = self._handover
+        handover.setdefault('first_data_at', time.time())
+        self.streaming_consumer_ids[shard] = consumer_id
+        if len(self.streaming_consumer_ids) < len(self.partitions):
+            return
+        if 'streaming_at' in handover:
+            return
+        handover['streaming_at'] = time.time()
+        self._retire(generation)
         
-        self.exit_delay = 0
-        self.active_consumer_id = consumer_id
-        for k, v in self.consumers.items():
-            if not k == consumer_id:
-                logging.info('killing: %s' % k)
-                v.kill(block=True)
-                del self.consumers[k]
-            
+    
+    def _retire(self, generation):
+        """Kill the consumers from generations before ``generation``, if
+          it's still the current one and they're still running.
+        """
         
+        handover = self._handover
+        if generation != self.generation:
+            return
+        if 'retired_at' not in handover:
+            # killing them yields, so don't let another call in
+            handover['retired_at'] = None
+            for k, v in self.consumers.items():
+                if self.shards[k][0] != generation:
+                    logging.info('killing: %s' % k)
+                    del self.consumers[k]
+                    del self.shards[k]
+                    v.kill(block=True)
+            handover['retired_at'] = time.time()
+        elif handover['retired_at'] is None:
+            return
+        if self.swaps and 'streaming_at' in handover:
+            self._swapped(generation, handover)
         
     
+    
     def _handle_exit(self, consumer_id):
         """If exit wasn't scheduled, start again.
         """
@@ -403,17 +795,31 @@ class BaseManager(object):
         logging.info('handle_exit %s' % consumer_id)
         logging.info(self.consumers)
         
-        # remove it from the dict of consumers we're manitaining
-        del self.consumers[consumer_id]
+        # remove it from the dicts of consumers we're manitaining, unless
+        # they've been stopped since it exited
+        self.consumers.pop(consumer_id, None)
+        item = self.shards.pop(consumer_id, None)
+        if item is None:
+            return
+        generation, shard = item
         
         # if it exited unexpectedly
         self._incr_exit_delay()
-        if consumer_id == self.active_consumer_id:
-            logging.info('active consumer exited unexpectedly')
-            gevent.spawn_later(self.exit_delay, self.start_a_consumer)
-        elif not self.consumers:
-            logging.info('only consumer exited unexpectedly')
-            gevent.spawn_later(self.exit_delay, self.start_a_consumer)
+        if self.metrics is not None:
+            self.metrics.reconnects['exit'] += 1
+            self.metrics.exit_delay = self.exit_delay
+        if generation == self.generation:
+            logging.info('consumer for shard %s exited unexpectedly' % shard)
+            if self.active_consumer_ids.get(shard) == consumer_id:
+                del self.active_consumer_ids[shard]
+            if self.streaming_consumer_ids.get(shard) == consumer_id:
+                del self.streaming_consumer_ids[shard]
+            gevent.spawn_later(
+                self.exit_delay,
+                self._restart_shard,
+                generation,
+                shard
+            )
         
     
     def _handle_data(self, data):
@@ -422,32 +828,74 @@ class BaseManager(object):
           .. _something: http://bit.ly/2NDL32
         """
         
+        if self.deduplicator is not None and self.deduplicator.seen(data):
+            return
+        self.num_messages += 1
         self.handle_data(data)
+        if self.tracer is not None and isinstance(data, Traced):
+            data.stamp('handle_data')
         
     
     def _handle_event(self):
+        metrics = self.metrics
+        handle_data = self._handle_data
+        # timing every message costs more than the rest of the
+        # instrumentation put together, so just time one in every
+        # ``latency_sample_rate`` of the data, connects and exits are
+        # rare.  The countdown runs whether or not there are metrics, so
+        # the untimed calls cost the same either way.
+        sample_rate = self.latency_sample_rate
+        countdown = sample_rate
         while True:
-            item = notification_queue.get()
+            item = self.notification_queue.get()
             for k, v in item.iteritems():
-                getattr(self, '_handle_%s' % k)(v)
-            
+                try:
+                    if k == 'data':
+                        countdown -= 1
+                        if countdown:
+                            handle_data(v)
+                            continue
+                        countdown = sample_rate
+                        if metrics is None:
+                            handle_data(v)
+                            continue
+                    handler = getattr(self, '_handle_%s' % k)
+                    if metrics is None:
+                        handler(v)
+                    else:
+                        started = time.time()
+                        handler(v)
+                        metrics.handler_latency[k].observe(
+                            time.time() - started
+                        )
+                except Exception, err:
+                    # don't let one bad item take the worker down with it
+                    logging.warning('Failed to handle %s' % k)
+                    logging.warning(err, exc_info=True)
         
     
     
-    def start_a_consumer(self):
-        """Fire up a new Consumer.
+    
+    def _start_shard(self, shard):
+        """Fire up a new Consumer for ``shard`` of the current generation.
         """
         
-        logging.info('creating new consumer')
+        logging.info('creating new consumer for shard %s' % shard)
         
         # create the new consumer
         consumer = self.consumer_class(
             path=self.path,
             host=self.host,
-            params=self.get_params(),
+            port=self.port,
+            secure=self.secure,
+            params=self.partitions[shard],
             username=self.username, 
             password=self.password,
             headers=self.get_headers(),
+            notification_queue=self.notification_queue,
+            metrics=self.metrics,
+            tracer=self.tracer,
+            connector=self.connector
         )
         logging.info(consumer.id)
         
@@ -456,19 +904,257 @@ class BaseManager(object):
         
         # put it in self.consumers
         self.consumers[consumer.id] = g
+        self.shards[consumer.id] = (self.generation, shard)
         logging.info(self.consumers)
         
     
+    def _restart_shard(self, generation, shard):
+        """Restart ``shard``, unless a new generation has been started
+          in the meantime.
+        """
+        
+        if generation == self.generation:
+            self._start_shard(shard)
+        
+    
+    def _swap(self):
+        """Start the debounced update's generation, which retires the
+          current one once it's streaming, see ``_handle_stream``.
+        """
+        
+        result = self.next_update
+        self.next_update = None
+        self._next_swap = None
+        self._updated_at = time.time()
+        # if the current generation is still connecting, or has been
+        # stopped, there's no stream to overlap with
+        was_connected = bool(self.partitions) and \
+            len(self.streaming_consumer_ids) == len(self.partitions)
+        self.start_a_consumer()
+        if not self.partitions:
+            result.set({'status': 'no predicates'})
+            return
+        self.swaps[self.generation] = (result, self._updated_at, was_connected)
+        
+    
+    def _swapped(self, generation, handover):
+        """Report how the update that started ``generation`` went, and
+          that any earlier ones were superseded.
+        """
+        
+        for k in sorted(self.swaps):
+            if k < generation:
+                self.swaps.pop(k)[0].set({'status': 'superseded'})
+        if generation not in self.swaps:
+            return
+        result, started_at, was_connected = self.swaps.pop(generation)
+        retired_at = handover['retired_at']
+        streaming_at = handover['streaming_at']
+        overlap = gap = 0.0
+        if was_connected:
+            # both generations were streaming from the new one's first
+            # data until the old one was killed, unless it was killed,
+            # after ``max_overlap``, before the new one was streaming
+            overlap = max(0.0, retired_at - handover['first_data_at'])
+            gap = max(0.0, streaming_at - retired_at)
+        else:
+            gap = streaming_at - started_at
+        self.last_update = {
+            'status': 'connected',
+            'generation': generation,
+            'connect_seconds': handover['connected_at'] - started_at,
+            'overlap_seconds': overlap,
+            'gap_seconds': gap
+        }
+        self.num_updates += 1
+        result.set(self.last_update)
+        
+    
+    def update(self):
+        """Hot swap the consumers for ones with the latest params, no
+          sooner than ``min_update_interval`` seconds after the last
+          update.  Updates requested in the meantime share the next one.
+          
+          Returns a ``gevent.event.AsyncResult`` that's set to a dict
+          with the ``status`` and, once the new generation is streaming,
+          the ``connect_seconds``, ``overlap_seconds`` and ``gap_seconds``.
+        """
+        
+        if self.next_update is not None:
+            self.num_coalesced += 1
+            return self.next_update
+        self.next_update = event.AsyncResult()
+        delay = self._updated_at + self.min_update_interval - time.time()
+        self._next_swap = gevent.spawn_later(max(0, delay), self._swap)
+        return self.next_update
+        
+    
+    def start_a_consumer(self):
+        """Fire up a new generation of consumers, one for each shard.
+        """
+        
+        self.generation += 1
+        params = self.get_params()
+        self.partitions = []
+        if self.worker_slice is not None:
+            index, count = self.worker_slice
+            partitions = partition_params(params, count)
+            params = index < len(partitions) and partitions[index] or None
+        if params is not None:
+            self.partitions = partition_params(params, self.num_shards)
+        self.active_consumer_ids = {}
+        self.streaming_consumer_ids = {}
+        self._handover = {}
+        for shard in range(len(self.partitions)):
+            self._start_shard(shard)
+        
+    
     def stop_all_consumers(self, accept_updates=True):
         """Kill any consumers.
         """
         
-        self.active_consumer_id = None
+        # make sure any pending restarts are ignored
+        self.generation += 1
+        self.partitions = []
+        self.active_consumer_ids = {}
+        self.streaming_consumer_ids = {}
+        self._handover = {}
         
         for item in self.consumers.itervalues():
             item.kill(block=True)
-        
+            
         self.consumers = {}
+        self.shards = {}
+        # an update that's waiting to happen would start them again
+        if self._next_swap is not None:
+            self._next_swap.kill()
+            self._next_swap = None
+        if self.next_update is not None:
+            self.next_update.set({'status': 'stopped'})
+            self.next_update = None
+        for k in sorted(self.swaps):
+            self.swaps.pop(k)[0].set({'status': 'stopped'})
+        # there's nothing to keep a connection warm for
+        self.connector.close()
+        
+    
+    
+    def dropped(self):
+        """Data items thrown away because the notification queue was full.
+          Overwrite to add those ``handle_data`` threw away.
+        """
+        
+        return self.notification_queue.dropped
+        
+    
+    def blocked(self):
+        """Seconds spent waiting for room in the notification queue.
+          Overwrite to add the time ``handle_data`` spent waiting.
+        """
+        
+        return self.notification_queue.blocked
+        
+    
+    def health(self):
+        """How the consumers are getting on.
+        """
+        
+        health = {
+            'consumers': len(self.consumers),
+            'shards': len(self.partitions),
+            'connected': len(self.active_consumer_ids),
+            'streaming': len(self.streaming_consumer_ids),
+            'messages': self.num_messages,
+            'queued': len(self.notification_queue),
+            'dropped': self.dropped()
+        }
+        if self.deduplicator is not None:
+            health['duplicates'] = self.deduplicator.duplicates
+            health['dedup_memory'] = self.deduplicator.memory()
+        if self.last_update is not None:
+            health['last_update'] = self.last_update
+        return health
+        
+    
+    def render_metrics(self):
+        """``self.metrics``, plus the state of the notification queue and
+          the consumers, in the Prometheus text format.
+        """
+        
+        if self.metrics is None:
+            return '# metrics are disabled\n'
+        queue = self.notification_queue
+        counters = {
+            'notifications_dropped_total': (
+                'Notifications dropped when the queue, or the sink, was full.',
+                self.dropped()
+            ),
+            'notifications_spilled_total': (
+                'Notifications spilled to disk when the queue was full.',
+                queue.spilled
+            ),
+            'notifications_blocked_seconds_total': (
+                'Time spent waiting for room in the queue, or the sink.',
+                self.blocked()
+            ),
+            'messages_handled_total': (
+                'Messages passed on to handle_data.',
+                self.num_messages
+            ),
+            'dns_lookups_total': (
+                'Times the stream host was resolved.',
+                self.connector.dns_lookups
+            ),
+            'connections_dialed_total': (
+                'Connections opened to the stream host.',
+                self.connector.dials
+            ),
+            'connections_prewarmed_total': (
+                'Connects that used a spare, prewarmed, connection.',
+                self.connector.spares_used
+            ),
+            'updates_total': (
+                'Hot swaps that have taken over the stream.',
+                self.num_updates
+            ),
+            'updates_coalesced_total': (
+                'Updates that were folded into one already waiting.',
+                self.num_coalesced
+            )
+        }
+        gauges = {
+            'notification_queue_depth': (
+                'Notifications waiting to be handled.',
+                len(queue)
+            ),
+            'consumers': (
+                'Consumers running.',
+                len(self.consumers)
+            ),
+            'consumers_connected': (
+                'Shards of the current generation that have connected.',
+                len(self.active_consumer_ids)
+            )
+        }
+        if self.last_update is not None:
+            gauges['update_overlap_seconds'] = (
+                'How long both generations streamed in the last update.',
+                self.last_update['overlap_seconds']
+            )
+            gauges['update_gap_seconds'] = (
+                'How long there was no stream in the last update.',
+                self.last_update['gap_seconds']
+            )
+        if self.deduplicator is not None:
+            counters['duplicates_total'] = (
+                'Duplicate messages dropped.',
+                self.deduplicator.duplicates
+            )
+            gauges['dedup_memory_bytes'] = (
+                'Roughly how much memory the dedup index is using.',
+                self.deduplicator.memory()
+            )
+        return self.metrics.render(counters=counters, gauges=gauges)
         
     
     
@@ -480,6 +1166,14 @@ class BaseManager(object):
         raise NotImplementedError
         
     
+    def get_headers(self):
+        """Override to specify any extra headers to send to the streaming
+          API when connecting.
+        """
+        
+        return {}
+        
+    
     def handle_data(self, data):
         """Override to do something with the data.
         """
@@ -487,31 +1181,61 @@ class BaseManager(object):
         raise NotImplementedError
         
     
-    
+
 
 
 class BaseWSGIApp(object):
     """Responds to requests to urls in ``/self.__all__``:
-      
-          from gevent import wsgi
+          
+          from gevent.pywsgi import WSGIServer
           
           app = WSGIApp(manager=Manager())
-          server = wsgi.WSGIServer(('', PORT), app.handle_requests)
+          server = WSGIServer(('', PORT), app.handle_requests)
           server.serve_forever()
           
       
-      Override ``handle_request_params`` as necessary.
+      Override ``handle_request_params`` as necessary.  It's only called
+      for the ``param_actions``, so ``/health`` and ``/metrics`` scrapes
+      don't go through it.  ``/health`` responds with ``manager.health()``
+      as JSON and ``/metrics`` with ``manager.render_metrics()``.
+      
+      ``/update`` hot swaps the consumers for ones with the new params,
+      see ``BaseManager.update``, unlike ``/restart``, which stops them
+      first.  It waits up to ``update_timeout`` seconds for the new ones
+      to connect and responds with the overlap and gap, as JSON.
       
+      ``/profile/start`` starts a ``sampler.Profiler`` in this process
+      and ``/profile/stop`` stops it and responds with the collapsed
+      stacks and the CPU time used by each kind of greenlet.  Slashes
+      in the path are mapped to underscores, so ``/profile/start`` is
+      handled by ``_profile_start``.
+        
     """
     
     __all__ = [
         'start',
         'stop',
-        'restart'
+        'restart',
+        'update',
+        'health',
+        'metrics',
+        'profile_start',
+        'profile_stop'
+    ]
+    
+    # the actions that can carry new params
+    param_actions = [
+        'start',
+        'restart',
+        'update'
     ]
     
+    # how long ``/update`` waits for the new consumers to connect
+    update_timeout = 60
+    
     def __init__(self, manager):
         self.manager = manager
+        self.profiler = Profiler()
         
     
     
@@ -528,20 +1252,48 @@ class BaseWSGIApp(object):
         self._start()
         
     
+    def _update(self):
+        result = self.manager.update().wait(self.update_timeout)
+        if result is None:
+            result = {'status': 'pending'}
+        return json.dumps(result, sort_keys=True) + '\r\n'
+        
+    
+    def _health(self):
+        return json.dumps(self.manager.health(), sort_keys=True) + '\r\n'
+        
+    
+    def _metrics(self):
+        return self.manager.render_metrics()
+        
+    
+    def _profile_start(self):
+        if not self.profiler.start():
+            return 'Already profiling\r\n'
+        
+    
+    def _profile_stop(self):
+        if not self.profiler.stop():
+            return 'Not profiling\r\n'
+        return self.profiler.collapsed()
+        
+    
     
     def handle_requests(self, env, start_response):
-        action = env['PATH_INFO'].replace('/', '')
+        action = env['PATH_INFO'].strip('/').replace('/', '_')
         if action in self.__all__:
             start_response('200 OK', [('Content-Type', 'text/plain')])
-            params = {}
-            body = env['wsgi.input'].read()
-            for name, values in cgi.parse_qs(body).iteritems():
-                l = []
-                l.extend(values)
-                params[name] = l
-            self.handle_request_params(action, params)
-            getattr(self, '_%s' % action)()
-            return ["OK\r\n"]
+            if action in self.param_actions:
+                params = {}
+                body = env['wsgi.input'].read()
+                for name, values in cgi.parse_qs(body).iteritems():
+                    l = []
+                    l.extend(values)
+                    params[name] = l
+                self.handle_request_params(action, params)
+            # actions can respond with something more useful than OK
+            response = getattr(self, '_%s' % action)()
+            return [response or "OK\r\n"]
         else:
             start_response('404 Not Found', [('Content-Type', 'text/plain')])
             return ['Not Found\r\n']
@@ -556,7 +1308,7 @@ class BaseWSGIApp(object):
         raise NotImplementedError
         
     
-    
-    
-    
+
+
+
 
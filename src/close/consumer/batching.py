@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""How big the batches ``process.PostingParsingQueueProcessor`` waits for
+  and posts are.
+  
+  ``BatchSizer`` tunes how many items to wait for, and to post at once,
+  towards a target webhook latency, and ``next_part`` picks the next part
+  of a claimed batch that's too big to post in one go, with an id that
+  always means the same items.
+"""
+
+class BatchSizer(object):
+    """Steers ``size`` between ``min_size`` and ``max_size`` so that
+      posting a batch takes about ``target_latency`` seconds: it grows by
+      ``growth`` after a full batch is posted in under half the target
+      and is cut by ``backoff`` after a post that was over the target, or
+      failed.  Partial batches, flushed by the linger, say nothing about
+      how big a batch the webhook can take, so don't grow it.
+      
+      With no ``target_latency``, the size stays where it started.
+    """
+    
+    def __init__(
+            self, size, min_size=1, max_size=1000, target_latency=0,
+            growth=0.1, backoff=0.5
+        ):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.size = min(max(size, min_size), self.max_size)
+        self.target_latency = target_latency
+        self.growth = growth
+        self.backoff = backoff
+        # its decisions, for ``render_metrics``
+        self.increases = 0
+        self.decreases = 0
+        
+    
+    def observe(self, num_items, elapsed, success=True):
+        """Adjust the size after posting ``num_items`` took ``elapsed``
+          seconds.
+        """
+        
+        if not self.target_latency:
+            return
+        if not success or elapsed > self.target_latency:
+            size = max(self.min_size, int(self.size * self.backoff))
+            if size < self.size:
+                self.decreases += 1
+            self.size = size
+        elif num_items >= self.size and elapsed < self.target_latency / 2:
+            size = min(self.max_size, self.size + max(1, int(self.size * self.growth)))
+            if size > self.size:
+                self.increases += 1
+            self.size = size
+        
+    
+
+
+
+def next_part(batch_id, items, start=0, max_items=0, max_bytes=0):
+    """The part of ``items`` from ``start`` on, of up to ``max_items`` and
+      ``max_bytes``, though always at least one item, as ``(id, items)``.
+      A batch that fits keeps its id, the parts of one that doesn't are
+      named for the range of items they hold, e.g.: ``<batch_id>.0-99``,
+      ``<batch_id>.100-149``.  So a part id always means the same items.
+      The caps may have changed by the time a part is retried, e.g.:
+      after a restart, so keep its bounds and post it again with
+      ``part_at``, rather than asking ``next_part`` for it again.
+    """
+    
+    end = start
+    size = 0
+    while end < len(items):
+        n = len(items[end])
+        if end > start and (
+                max_items and end - start >= max_items or
+                max_bytes and size + n > max_bytes
+            ):
+            break
+        size += n
+        end += 1
+    return part_at(batch_id, items, start, end)
+    
+    
+
+def part_at(batch_id, items, start, end):
+    """The part of ``items`` from ``start`` up to, but not including,
+      ``end``, named as ``next_part`` names it.
+    """
+    
+    if not start and end == len(items):
+        return batch_id, items
+    return '%s.%d-%d' % (batch_id, start, end - 1), items[start:end]
+    
+    
+
+
+
+
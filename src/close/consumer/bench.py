@@ -0,0 +1,1485 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the hot paths of the consumer and processor.
+  
+  Run them all, or just the ones you name, ala:
+      
+      python bench.py
+      python bench.py decoder --num-messages=50000
+        
+"""
+
+import gevent
+from gevent import event, socket
+
+import collections
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import ssl
+import time
+import urllib2
+
+from base import ChunkReadingMixin, BufferedChunkReadingMixin
+from framing import StreamParser
+from spill import SpillQueue
+from utils import monkey_patch, unicode_urlencode
+import encode
+import replay
+
+BENCHMARKS = []
+
+def benchmark(f):
+    """Register ``f`` as a benchmark that can be selected by name.
+    """
+    
+    BENCHMARKS.append(f)
+    return f
+    
+    
+
+def report(name, **kwargs):
+    """Print a single line of ``key=value`` results.
+    """
+    
+    values = []
+    for k, v in sorted(kwargs.iteritems()):
+        if isinstance(v, float):
+            v = '%.2f' % v
+        values.append('%s=%s' % (k, v))
+    print '%-36s %s' % (name, ' '.join(values))
+    
+    
+
+def percentile(values, p):
+    """Get the ``p``th percentile of a sorted list of ``values``.
+    """
+    
+    if not values:
+        return float('nan')
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+    
+    
+
+def load_stream(options):
+    """Read the recorded stream body from ``options.capture``, if 
+      provided, or generate one.
+    """
+    
+    if options.capture:
+        f = open(options.capture, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+    return replay.generate_stream(
+        options.num_messages,
+        max_chunk_size=options.max_chunk_size
+    )
+    
+    
+
+class FakeSocket(object):
+    """Serves a pre-recorded stream, handing back at most ``segment_size``
+      bytes per call, and counts the calls made to it.
+    """
+    
+    def __init__(self, data, segment_size=16384):
+        self.data = data
+        self.segment_size = segment_size
+        self.pos = 0
+        self.calls = 0
+        
+    
+    def recv(self, amt):
+        self.calls += 1
+        amt = min(amt, self.segment_size)
+        data = self.data[self.pos:self.pos + amt]
+        self.pos += len(data)
+        return data
+        
+    
+    def recv_into(self, view):
+        data = self.recv(len(view))
+        view[:len(data)] = data
+        return len(data)
+        
+    
+
+
+
+def _consume_length_delimited(reader):
+    """Read messages from ``reader`` the way ``consumer.Consumer``
+      does, until the stream runs dry.
+    """
+    
+    num_messages = 0
+    try:
+        while True:
+            line = reader._readline_chunked()
+            if line.isdigit():
+                reader._read_chunked(int(line))
+                num_messages += 1
+    except gevent.GreenletExit:
+        # the readers bail when the data runs out
+        pass
+    return num_messages
+    
+    
+
+@benchmark
+def decoder(options):
+    """Compare syscalls per message and messages per second of the
+      byte at a time ``ChunkReadingMixin`` against the buffered one.
+    """
+    
+    stream = load_stream(options)
+    for mixin in ChunkReadingMixin, BufferedChunkReadingMixin:
+        reader = type('Reader', (mixin,), {})()
+        reader.sock = FakeSocket(stream)
+        reader._reset_buffer()
+        started = time.time()
+        n = _consume_length_delimited(reader)
+        elapsed = time.time() - started
+        report(
+            'decoder.%s' % mixin.__name__,
+            messages=n,
+            syscalls_per_message=float(reader.sock.calls) / n,
+            messages_per_second=n / elapsed
+        )
+        
+    
+
+@benchmark
+def parser(options):
+    """Feed the stream to a ``framing.StreamParser`` in slices of
+      ``options.feed_size`` bytes and measure the throughput per MB fed.
+    """
+    
+    stream = load_stream(options)
+    size = options.feed_size
+    slices = [stream[i:i + size] for i in xrange(0, len(stream), size)]
+    parser = StreamParser(delimited='length')
+    n = 0
+    started = time.time()
+    for data in slices:
+        n += len(parser.feed(data))
+    elapsed = time.time() - started
+    megabytes = len(stream) / float(2 ** 20)
+    report(
+        'parser.feed_%s' % size,
+        messages=n,
+        messages_per_second=n / elapsed,
+        mb_per_second=megabytes / elapsed,
+        ms_per_mb=1000 * elapsed / megabytes
+    )
+    
+    
+
+
+@benchmark
+def spill(options):
+    """Compare pushing messages through an in memory deque with pushing 
+      them through a ``spill.SpillQueue``, then check that everything
+      acknowledged survives a "crash", i.e.: reopening the queue without
+      closing it.
+    """
+    
+    messages = StreamParser().feed(replay.generate_stream(1000))
+    n = options.num_messages
+    
+    items = collections.deque()
+    started = time.time()
+    for i in xrange(n):
+        items.append(messages[i % len(messages)])
+    while items:
+        items.popleft()
+    report('spill.memory', messages_per_second=n / (time.time() - started))
+    
+    directory = tempfile.mkdtemp(prefix='close.bench.')
+    try:
+        queue = SpillQueue(directory)
+        started = time.time()
+        for i in xrange(n):
+            queue.put(messages[i % len(messages)])
+        queue.sync()
+        read = 0
+        while read < n / 2:
+            queue.get()
+            read += 1
+            if not read % 100:
+                queue.commit()
+        queue.commit()
+        queue.sync()
+        elapsed = time.time() - started
+        recovered = SpillQueue(directory)
+        expected = [messages[i % len(messages)] for i in xrange(read, n)]
+        ok = [recovered.get() for i in xrange(len(recovered))] == expected
+        report(
+            'spill.disk',
+            messages_per_second=(n + read) / elapsed,
+            recovered=ok
+        )
+    finally:
+        shutil.rmtree(directory)
+        
+    
+
+
+def start_replay_server(options, *args):
+    """Start ``replay.py`` serving on ``options.replay_port`` in another
+      process and wait until it's accepting connections.
+    """
+    
+    path = os.path.splitext(replay.__file__)[0] + '.py'
+    args = [
+        sys.executable, path,
+        '--port', str(options.replay_port),
+        '--num-messages', str(min(options.num_messages, 10000)),
+        '--rate', str(options.rate),
+        '--logging', 'warning'
+    ] + list(args)
+    if options.secure:
+        args.append('--secure')
+    server = subprocess.Popen(args)
+    for i in xrange(100):
+        try:
+            sock = socket.create_connection(('localhost', options.replay_port))
+        except socket.error:
+            gevent.sleep(0.1)
+        else:
+            sock.close()
+            return server
+    server.kill()
+    raise Exception('Replay server failed to start')
+    
+    
+
+@benchmark
+def end_to_end(options):
+    """Run the real ``consumer.Consumer`` and ``consumer.Manager`` against
+      a ``replay.py`` server and measure messages per second, latency from
+      the server sending a message to ``Manager.handle_data`` completing, 
+      CPU and RSS.
+      
+      This is the regression gate for performance changes to the stream to
+      sink path.  Use ``--sink=null`` to leave redis out of it.
+    """
+    
+    from consumer import Consumer, Manager
+    
+    latencies = []
+    received = []
+    done = event.Event()
+    
+    class BenchManager(Manager):
+        def get_params(self):
+            return {'track': 'bench'}
+            
+        
+        def handle_data(self, data):
+            if options.sink == 'redis':
+                Manager.handle_data(self, data)
+            now = time.time()
+            received.append(now)
+            sent = replay.read_stamp(data)
+            if sent is not None:
+                latencies.append(now - sent)
+            if len(received) == options.num_messages:
+                done.set()
+        
+    
+    
+    server = start_replay_server(options, '--stamp')
+    try:
+        manager = BenchManager(
+            Consumer,
+            'localhost',
+            '/',
+            port=options.replay_port,
+            secure=options.secure,
+            # the replayed statuses repeat
+            dedup_window=0
+        )
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.time()
+        manager.start_a_consumer()
+        done.wait(timeout=options.timeout)
+        elapsed = time.time() - started
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        manager.stop_all_consumers()
+    finally:
+        server.kill()
+        
+    n = len(received)
+    if n < 2:
+        raise Exception('Only received %s messages' % n)
+    latencies.sort()
+    cpu = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+    report(
+        'end_to_end.%s' % options.sink,
+        messages=n,
+        messages_per_second=(n - 1) / (received[-1] - received[0]),
+        p50_latency_ms=1000 * percentile(latencies, 50),
+        p99_latency_ms=1000 * percentile(latencies, 99),
+        cpu_percent=100 * cpu / elapsed,
+        max_rss_mb=after.ru_maxrss / 1024.0,
+        dropped=manager.notification_queue.dropped,
+        blocked_seconds=manager.notification_queue.blocked
+    )
+    
+    
+
+
+@benchmark
+def shards(options):
+    """Run ``consumer.Manager`` with 1, 2, 4 and 8 shards against a
+      ``replay.py`` server and measure aggregate messages per second.
+      Each connection is replayed to at ``--rate``, so this shows how
+      splitting the predicates between streams gets past one stream's
+      rate limit, until the consumer runs out of CPU.
+    """
+    
+    from consumer import Consumer, Manager
+    
+    server = start_replay_server(options)
+    try:
+        for num_shards in 1, 2, 4, 8:
+            received = []
+            done = event.Event()
+            
+            class BenchManager(Manager):
+                def get_params(self):
+                    return {'track': ','.join('bench%d' % i for i in range(8))}
+                    
+                
+                def handle_data(self, data):
+                    if options.sink == 'redis':
+                        Manager.handle_data(self, data)
+                    received.append(time.time())
+                    if len(received) == options.num_messages:
+                        done.set()
+                
+            
+            
+            manager = BenchManager(
+                Consumer,
+                'localhost',
+                '/',
+                port=options.replay_port,
+                secure=options.secure,
+                num_shards=num_shards,
+                # each shard is sent the same statuses
+                dedup_window=0
+            )
+            manager.start_a_consumer()
+            done.wait(timeout=options.timeout)
+            manager.stop_all_consumers()
+            n = len(received)
+            if n < 2:
+                raise Exception('Only received %s messages' % n)
+            report(
+                'shards.%d' % num_shards,
+                messages=n,
+                messages_per_second=(n - 1) / (received[-1] - received[0])
+            )
+        
+    finally:
+        server.kill()
+        
+    
+
+def _consume_fake_stream(stream, expected, **kwargs):
+    """Feed ``stream`` through a ``consumer.Consumer`` into a
+      ``base.BaseManager``, made with ``kwargs``, that does nothing with
+      the data and return the CPU time it took to handle the ``expected``
+      number of messages, and the manager.  It all runs in this process,
+      so CPU time, unlike the wall clock, isn't thrown by whatever else
+      the machine is doing.
+    """
+    
+    from base import BaseManager
+    from consumer import Consumer
+    
+    class BenchManager(BaseManager):
+        handled = 0
+        
+        def handle_data(self, data):
+            self.handled += 1
+        
+    
+    
+    
+    manager = BenchManager(Consumer, 'localhost', '/', dedup_window=0, **kwargs)
+    consumer = Consumer(
+        'localhost',
+        '/',
+        notification_queue=manager.notification_queue,
+        metrics=manager.metrics,
+        tracer=manager.tracer
+    )
+    consumer.sock = FakeSocket(stream)
+    consumer._reset_buffer()
+    started = time.clock()
+    try:
+        consumer._consume_stream()
+    except gevent.GreenletExit:
+        # the stream ran dry
+        pass
+    while manager.handled < expected:
+        gevent.sleep(0)
+    return time.clock() - started, manager
+    
+    
+
+# single runs vary by far more than the overheads ``_timings`` is used
+# to measure, so take at least this many rounds' median
+MIN_TIMING_ROUNDS = 51
+
+def _timings(options, stream, variants):
+    """Run ``_consume_fake_stream`` with the kwargs of each of the
+      ``(name, kwargs)`` ``variants`` in turn, ``options.rounds`` times,
+      or ``MIN_TIMING_ROUNDS`` if that's more, and return the times taken,
+      by name, in round order.
+      
+      Every other round runs the variants in reverse, and each run starts
+      from a fresh collection, so that neither the order nor the garbage
+      left by the runs before counts against a variant.
+    """
+    
+    expected = len(StreamParser().feed(stream))
+    times = dict((name, []) for name, kwargs in variants)
+    for i in xrange(max(options.rounds, MIN_TIMING_ROUNDS)):
+        for name, kwargs in i % 2 and variants[::-1] or variants:
+            gc.collect()
+            elapsed, manager = _consume_fake_stream(stream, expected, **kwargs)
+            times[name].append(elapsed)
+        
+    return times
+    
+    
+
+def _overhead(times, name, base='off'):
+    """The median, and the spread, of how much slower, in percent, each
+      round of ``name`` was than the ``base`` run it went back to back
+      with.  Single runs vary by more than the overheads being measured,
+      so compare the median against the spread.
+    """
+    
+    overheads = sorted(
+        100 * (t - b) / b for t, b in zip(times[name], times[base])
+    )
+    return {
+        'overhead_percent': percentile(overheads, 50),
+        'overhead_min_percent': overheads[0],
+        'overhead_max_percent': overheads[-1]
+    }
+    
+    
+
+@benchmark
+def metrics(options):
+    """Feed the recorded stream through a ``consumer.Consumer`` into a
+      ``base.BaseManager`` that does nothing with the data, with and
+      without metrics, to show what the instrumentation costs.  The runs
+      alternate and the medians are reported, with the spread of the
+      overhead across ``--rounds``.
+    """
+    
+    stream = load_stream(options)
+    n = len(StreamParser().feed(stream))
+    times = _timings(options, stream, (
+            ('off', {'enable_metrics': False}),
+            ('on', {'enable_metrics': True})
+        )
+    )
+    for name in 'off', 'on':
+        report(
+            'metrics.%s' % name,
+            messages=n,
+            messages_per_second=n / percentile(sorted(times[name]), 50)
+        )
+    report('metrics.overhead', **_overhead(times, 'on'))
+    
+    
+
+@benchmark
+def tracing(options):
+    """Like the ``metrics`` benchmark, but with tracing off, tracing the
+      default one in a thousand messages, and tracing every message.
+    """
+    
+    stream = load_stream(options)
+    n = len(StreamParser().feed(stream))
+    variants = (
+        ('off', {'enable_metrics': False}),
+        ('sampled', {'enable_metrics': False, 'trace_sample_rate': 0.001}),
+        ('all', {'enable_metrics': False, 'trace_sample_rate': 1})
+    )
+    times = _timings(options, stream, variants)
+    for name, kwargs in variants:
+        report(
+            'tracing.%s' % name,
+            messages=n,
+            messages_per_second=n / percentile(sorted(times[name]), 50),
+            **_overhead(times, name)
+        )
+        
+    
+
+@benchmark
+def profiler(options):
+    """Feed the recorded stream through a consumer and manager, as in the
+      ``metrics`` benchmark, with and without a ``sampler.Profiler``
+      running, to show what sampling costs.
+    """
+    
+    from sampler import Profiler
+    
+    stream = load_stream(options)
+    n = len(StreamParser().feed(stream))
+    profiler = Profiler()
+    times = {'off': [], 'on': []}
+    for i in xrange(options.rounds):
+        for name in 'off', 'on':
+            if name == 'on':
+                profiler.start()
+            try:
+                elapsed, manager = _consume_fake_stream(
+                    stream,
+                    n,
+                    enable_metrics=False
+                )
+            finally:
+                profiler.stop()
+            times[name].append(elapsed)
+        
+    for name in 'off', 'on':
+        report(
+            'profiler.%s' % name,
+            messages=n,
+            messages_per_second=n / percentile(sorted(times[name]), 50)
+        )
+    report(
+        'profiler.overhead',
+        samples=sum(profiler.samples.values()),
+        **_overhead(times, 'on')
+    )
+    
+    
+
+# measures the asyncio engine, in a Python 3 interpreter, for the
+# ``engines`` benchmark
+_ASYNCIO_ENGINE_BENCH = """
+import asyncio, json, resource, ssl, sys, time
+import aio
+
+port, num_messages, secure, timeout = sys.argv[1:]
+num_messages = int(num_messages)
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+done = loop.create_future()
+received = []
+
+class BenchManager(aio.AsyncManager):
+    def get_params(self):
+        return {'track': 'bench'}
+        
+    def handle_data(self, data):
+        received.append(time.time())
+        if len(received) == num_messages and not done.done():
+            done.set_result(None)
+        
+class BenchConsumer(aio.AsyncConsumer):
+    def __init__(self, *args, **kwargs):
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        kwargs['ssl_context'] = context
+        super().__init__(*args, **kwargs)
+        
+manager = BenchManager(
+    BenchConsumer,
+    'localhost',
+    '/',
+    port=int(port),
+    secure=secure == '1',
+    loop=loop
+)
+before = resource.getrusage(resource.RUSAGE_SELF)
+started = time.time()
+manager.start_a_consumer()
+try:
+    loop.run_until_complete(asyncio.wait_for(done, float(timeout)))
+except asyncio.TimeoutError:
+    pass
+elapsed = time.time() - started
+after = resource.getrusage(resource.RUSAGE_SELF)
+manager.stop_all_consumers()
+print(json.dumps({
+    'received': received,
+    'cpu': (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime),
+    'elapsed': elapsed
+}))
+"""
+
+def _report_engine(name, received, cpu, elapsed):
+    n = len(received)
+    if n < 2:
+        raise Exception('Only received %s messages' % n)
+    report(
+        'engines.%s' % name,
+        messages=n,
+        messages_per_second=(n - 1) / (received[-1] - received[0]),
+        cpu_percent=100 * cpu / elapsed
+    )
+    
+    
+
+@benchmark
+def engines(options):
+    """Run the gevent engine, a ``consumer.Consumer`` and a
+      ``base.BaseManager``, and the asyncio engine, see ``aio.py``, in
+      ``--python3``, side by side against a ``replay.py`` server and
+      compare messages per second and CPU.  Neither does anything with
+      the data.
+    """
+    
+    from base import BaseManager
+    from consumer import Consumer
+    
+    received = []
+    done = event.Event()
+    
+    class BenchManager(BaseManager):
+        def get_params(self):
+            return {'track': 'bench'}
+            
+        
+        def handle_data(self, data):
+            received.append(time.time())
+            if len(received) == options.num_messages:
+                done.set()
+        
+    
+    
+    
+    server = start_replay_server(options)
+    try:
+        manager = BenchManager(
+            Consumer,
+            'localhost',
+            '/',
+            port=options.replay_port,
+            secure=options.secure,
+            dedup_window=0,
+            enable_metrics=False
+        )
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.time()
+        manager.start_a_consumer()
+        done.wait(timeout=options.timeout)
+        elapsed = time.time() - started
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        manager.stop_all_consumers()
+        cpu = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+        _report_engine('gevent', received, cpu, elapsed)
+        
+        process = subprocess.Popen(
+            [
+                options.python3, '-c', _ASYNCIO_ENGINE_BENCH,
+                str(options.replay_port),
+                str(options.num_messages),
+                options.secure and '1' or '0',
+                str(options.timeout)
+            ],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE
+        )
+        output = process.communicate()[0]
+        if process.returncode:
+            raise Exception('The asyncio engine failed')
+        result = json.loads(output)
+        _report_engine(
+            'asyncio',
+            result['received'],
+            result['cpu'],
+            result['elapsed']
+        )
+    finally:
+        server.kill()
+        
+    
+
+@benchmark
+def reconnect(options):
+    """Restart a ``base.BaseManager`` over and over against a ``replay.py
+      --secure`` stand-in, with ``--latency`` round trips, and measure the
+      handover window, from ``start_a_consumer`` to the new consumer
+      connecting: resolving the host every time, with it cached, see
+      ``connect.Connector``, and with a prewarmed spare connection.
+    """
+    
+    from base import BaseManager
+    from consumer import Consumer
+    
+    connected = event.Event()
+    
+    class BenchManager(BaseManager):
+        def get_params(self):
+            return {'track': 'bench'}
+            
+        
+        def handle_data(self, data):
+            pass
+            
+        
+        def _handle_connect(self, consumer_id):
+            current = self.shards[consumer_id][0] == self.generation
+            BaseManager._handle_connect(self, consumer_id)
+            if current:
+                connected.set()
+        
+    
+    
+    
+    args = ['--rate', '100', '--latency', str(options.latency)]
+    if not options.secure:
+        args.append('--secure')
+    server = start_replay_server(options, *args)
+    try:
+        for name, kwargs in (
+                ('resolve', {'dns_ttl': 0}),
+                ('cached', {}),
+                ('prewarm', {'prewarm': True})
+            ):
+            manager = BenchManager(
+                Consumer,
+                'localhost',
+                '/',
+                port=options.replay_port,
+                secure=True,
+                dedup_window=0,
+                enable_metrics=False,
+                **kwargs
+            )
+            handovers = []
+            for i in xrange(4 * options.rounds + 1):
+                # give the spare connection time to be replaced
+                gevent.sleep(max(0.1, 5 * options.latency))
+                connected.clear()
+                started = time.time()
+                manager.start_a_consumer()
+                if not connected.wait(timeout=options.timeout):
+                    raise Exception('The consumer failed to connect')
+                # the first connect is never prewarmed
+                if i:
+                    handovers.append(time.time() - started)
+            manager.stop_all_consumers()
+            handovers.sort()
+            report(
+                'reconnect.%s' % name,
+                p50_ms=1000 * percentile(handovers, 50),
+                p99_ms=1000 * percentile(handovers, 99),
+                dials=manager.connector.dials,
+                dns_lookups=manager.connector.dns_lookups,
+                prewarmed=manager.connector.spares_used
+            )
+    finally:
+        server.kill()
+        
+    
+
+@benchmark
+def update(options):
+    """Swap the consumers of a ``base.BaseManager``, streaming from a
+      ``replay.py`` stand-in with ``--latency`` round trips, the way
+      ``/restart`` does, stopping them then starting new ones, and with
+      ``/update``'s hot swap, and measure the longest gap between
+      messages each time, against that of a steady stream, and the
+      overlap and gap the manager reports.
+      Then fire off a burst of updates and count how many swaps they
+      cost.
+    """
+    
+    from base import BaseManager
+    from consumer import Consumer
+    
+    received = []
+    
+    class BenchManager(BaseManager):
+        def get_params(self):
+            return {'track': 'bench'}
+            
+        
+        def handle_data(self, data):
+            received.append(time.time())
+        
+    
+    
+    
+    def longest_gap(since):
+        times = received[since - 1:]
+        return max(b - a for a, b in zip(times, times[1:]))
+        
+    
+    server = start_replay_server(
+        options,
+        '--rate', '1000',
+        '--latency', str(options.latency)
+    )
+    try:
+        manager = BenchManager(
+            Consumer,
+            'localhost',
+            '/',
+            port=options.replay_port,
+            secure=options.secure,
+            dedup_window=0,
+            enable_metrics=False,
+            min_update_interval=0.5
+        )
+        manager.start_a_consumer()
+        while not received:
+            gevent.sleep(0.1)
+        for name in 'steady', 'restart', 'hot_swap':
+            gaps = []
+            reported = []
+            for i in xrange(options.rounds):
+                gevent.sleep(1)
+                since = len(received)
+                if name == 'restart':
+                    manager.stop_all_consumers()
+                    manager.start_a_consumer()
+                elif name == 'hot_swap':
+                    result = manager.update().get(timeout=options.timeout)
+                    reported.append(result)
+                gevent.sleep(1)
+                gaps.append(longest_gap(since))
+            gaps.sort()
+            kwargs = {}
+            if reported:
+                kwargs['reported_overlap_ms'] = 1000 * max(
+                    r['overlap_seconds'] for r in reported
+                )
+                kwargs['reported_gap_ms'] = 1000 * max(
+                    r['gap_seconds'] for r in reported
+                )
+            report(
+                'update.%s' % name,
+                p50_gap_ms=1000 * percentile(gaps, 50),
+                max_gap_ms=1000 * gaps[-1],
+                **kwargs
+            )
+        gevent.sleep(1)
+        swaps = manager.num_updates
+        coalesced = manager.num_coalesced
+        results = []
+        for i in xrange(20):
+            results.append(manager.update())
+            gevent.sleep(0.05)
+        for result in results:
+            result.get(timeout=options.timeout)
+        report(
+            'update.burst',
+            requests=len(results),
+            swaps=manager.num_updates - swaps,
+            coalesced=manager.num_coalesced - coalesced
+        )
+        manager.stop_all_consumers()
+    finally:
+        server.kill()
+        
+    
+
+@benchmark
+def dedup(options):
+    """Time getting the ids out of statuses that start with their id, as
+      the Streaming API's do, and ones that don't, and checking them
+      against a full ``dedup.Deduplicator``, and report how much memory
+      it's using.
+    """
+    
+    from dedup import Deduplicator, extract_id
+    
+    messages = StreamParser().feed(load_stream(options))
+    leading = [
+        '{"created_at":"Sat Jun 19 12:00:00 +0000 2010","id":%d,%s' % (
+            10 ** 17 + i,
+            message[1:]
+        ) for i, message in enumerate(messages)
+    ]
+    for name, statuses in ('leading_id', leading), ('nested_id', messages):
+        started = time.time()
+        for status in statuses:
+            extract_id(status)
+        elapsed = time.time() - started
+        report(
+            'dedup.extract_id.%s' % name,
+            statuses_per_second=len(statuses) / elapsed
+        )
+    deduplicator = Deduplicator(window=3600, max_size=len(leading))
+    started = time.time()
+    for status in leading + leading:
+        deduplicator.seen(status)
+    elapsed = time.time() - started
+    report(
+        'dedup.seen',
+        statuses_per_second=2 * len(leading) / elapsed,
+        duplicates=deduplicator.duplicates,
+        remembered=len(deduplicator),
+        memory_mb=deduplicator.memory() / 2.0 ** 20
+    )
+    
+    
+
+@benchmark
+def webhook(options):
+    """Compare posting batches to a ``replay.py --webhook`` stand-in with
+      a new ``urllib2`` request per batch, the way the processor used to,
+      against posting them over its pool of keep-alive connections.
+    """
+    
+    from process import PostingParsingQueueProcessor
+    
+    context = None
+    scheme = 'http'
+    if options.secure:
+        context = ssl._create_unverified_context()
+        scheme = 'https'
+    url = '%s://localhost:%s/hooks/handle_status' % (scheme, options.replay_port)
+    messages = StreamParser().feed(replay.generate_stream(options.batch_size))
+    processor = PostingParsingQueueProcessor('bench', options.batch_size, url)
+    processor.pool.context = context
+    
+    def post_with_urllib2(items):
+        data = unicode_urlencode({'items': items})
+        request = urllib2.Request(url, data=data, headers=processor.headers)
+        kwargs = context and {'context': context} or {}
+        status = urllib2.urlopen(request, **kwargs).getcode()
+        return 200 <= status < 300
+        
+    
+    server = start_replay_server(options, '--webhook')
+    try:
+        for name, post in ('urllib2', post_with_urllib2), ('pool', processor._post):
+            started = time.time()
+            for i in xrange(options.num_batches):
+                if not post(messages):
+                    raise Exception('Failed to post batch')
+            elapsed = time.time() - started
+            report(
+                'webhook.%s' % name,
+                batches=options.num_batches,
+                batches_per_second=options.num_batches / elapsed
+            )
+    finally:
+        server.kill()
+    report('webhook.pool', connects=processor.pool.num_connects)
+    
+    
+
+
+@benchmark
+def batching(options):
+    """Write items to a redis list, ala ``consumer.Batcher``, and have a
+      ``process.PostingParsingQueueProcessor`` post them to a ``replay.py
+      --webhook`` stand-in, first with a fixed batch size of 10, then
+      with a ``max_linger`` and tuning the batch size towards a
+      ``target_latency``: for a trickle of items, where the linger
+      matters, and a flood, where the tuning does.  Reports items per
+      second, the latency from writing an item to posting it, the posts
+      made and the batch size it ended up at.  Needs redis.
+    """
+    
+    from backends import ListBackend, make_redis
+    from process import PostingParsingQueueProcessor
+    
+    context = None
+    scheme = 'http'
+    if options.secure:
+        context = ssl._create_unverified_context()
+        scheme = 'https'
+    url = '%s://localhost:%s/hooks/handle_status' % (scheme, options.replay_port)
+    status = replay.generate_status(0)
+    redis = make_redis()
+    data_key = 'close.consumer.bench.data'
+    notification_key = 'close.consumer.bench.notify'
+    
+    def clear():
+        redis.delete(
+            data_key,
+            notification_key,
+            '%s.bench' % data_key,
+            '%s.bench.id' % data_key
+        )
+        
+    
+    server = start_replay_server(options, '--webhook')
+    try:
+        for traffic, rate, num_items in (
+                ('trickle', 50, 100),
+                ('flood', 0, options.num_messages)
+            ):
+            for name, kwargs in (
+                    ('fixed', {}),
+                    ('adaptive', {
+                            'max_linger': 0.05,
+                            'target_latency': 0.02,
+                            'max_items': 1000
+                        }
+                    )
+                ):
+                clear()
+                processor = PostingParsingQueueProcessor(
+                    'bench',
+                    10,
+                    url,
+                    backend=ListBackend(redis, data_key, notification_key),
+                    trace_log_interval=0,
+                    **kwargs
+                )
+                processor.pool.context = context
+                latencies = []
+                done = event.Event()
+                post = processor._post
+                
+                def _post(items, batch_id=None):
+                    items = list(items)
+                    success = post(items, batch_id)
+                    if success:
+                        now = time.time()
+                        for item in items:
+                            latencies.append(now - float(item.split(' ', 1)[0]))
+                        if len(latencies) >= num_items:
+                            done.set()
+                    return success
+                    
+                
+                processor._post = _post
+                loop = gevent.spawn(processor.loop_forever)
+                started = time.time()
+                if rate:
+                    for i in xrange(num_items):
+                        processor.backend.write(['%f %s' % (time.time(), status)])
+                        gevent.sleep(1.0 / rate)
+                else:
+                    for i in xrange(0, num_items, 100):
+                        n = min(100, num_items - i)
+                        processor.backend.write(
+                            ['%f %s' % (time.time(), status)] * n
+                        )
+                        gevent.sleep(0)
+                done.wait(timeout=options.timeout)
+                elapsed = time.time() - started
+                loop.kill()
+                clear()
+                latencies.sort()
+                if not latencies:
+                    raise Exception('Nothing was posted')
+                report(
+                    'batching.%s.%s' % (traffic, name),
+                    items_per_second=len(latencies) / elapsed,
+                    p50_latency_ms=1000 * percentile(latencies, 50),
+                    p99_latency_ms=1000 * percentile(latencies, 99),
+                    posts=processor.num_posts['ok'],
+                    batch_size=processor.sizer.size
+                )
+    finally:
+        server.kill()
+        
+    
+
+
+@benchmark
+def parse(options):
+    """Compare statuses per second reduced by ``parse.parse_item`` against
+      ``parse.parse_item_slowly``, taking the median of ``--rounds`` runs
+      each, in alternating order, checking their output is the same, and
+      count the statuses ``ujson`` decodes.  The edge cases are covered by
+      ``tests/test_parse.py``.
+    """
+    
+    import parse
+    
+    messages = StreamParser().feed(load_stream(options))
+    variants = [parse.parse_item_slowly, parse.parse_item]
+    rates = dict((f, []) for f in variants)
+    results = {}
+    for i in xrange(options.rounds):
+        for f in i % 2 and variants[::-1] or variants:
+            gc.collect()
+            started = time.time()
+            results[f] = [f(message) for message in messages]
+            rates[f].append(len(messages) / (time.time() - started))
+        
+    for f in variants:
+        rates[f].sort()
+        report(
+            'parse.%s' % f.__name__,
+            statuses=len(messages),
+            statuses_per_second=percentile(rates[f], 50),
+            min_statuses_per_second=rates[f][0],
+            max_statuses_per_second=rates[f][-1]
+        )
+    mismatches = 0
+    for a, b in zip(results[parse.parse_item_slowly], results[parse.parse_item]):
+        if a != b:
+            mismatches += 1
+    decoder = parse.ujson is None and parse.json.__name__ or 'ujson'
+    fast = len([m for m in messages if not parse._lone_surrogate.search(m)])
+    report(
+        'parse.parse_item',
+        decoder=decoder,
+        mismatches=mismatches,
+        fast_path_percent=100.0 * fast / len(messages)
+    )
+    
+    
+
+@benchmark
+def projection(options):
+    """Time compiling projections of various widths and the statuses per
+      second the compiled item parsers reduce.
+    """
+    
+    import parse
+    
+    messages = StreamParser().feed(load_stream(options))
+    specs = (
+        ('narrow', 'id,text'),
+        ('default', parse.DEFAULT_PROJECTION),
+        ('wide', ','.join([
+                    parse.DEFAULT_PROJECTION,
+                    'created_at',
+                    'source',
+                    'user.name',
+                    'user.followers_count',
+                    'user.friends_count',
+                    'user.lang'
+                ]
+            )
+        )
+    )
+    for name, spec in specs:
+        started = time.time()
+        item_parser = parse.make_item_parser(spec)
+        compile_elapsed = time.time() - started
+        started = time.time()
+        for message in messages:
+            item_parser(message)
+        elapsed = time.time() - started
+        report(
+            'projection.%s' % name,
+            compile_ms=compile_elapsed * 1000,
+            statuses_per_second=len(messages) / elapsed
+        )
+        
+    
+
+
+@benchmark
+def parse_pool(options):
+    """Compare statuses per second parsed inline against parsing them in
+      a ``parallel.ParsingPool`` of 1, 2, 4 and 8 worker processes, in
+      batches of ``--parse-batch-size``.
+    """
+    
+    import parse
+    from parallel import ParsingPool
+    
+    messages = StreamParser().feed(load_stream(options))
+    size = options.parse_batch_size
+    batches = [messages[i:i + size] for i in xrange(0, len(messages), size)]
+    started = time.time()
+    for batch in batches:
+        map(parse.parse_item, batch)
+    report(
+        'parse_pool.inline',
+        statuses_per_second=len(messages) / (time.time() - started)
+    )
+    for num_workers in 1, 2, 4, 8:
+        pool = ParsingPool(
+            parse.parse_item,
+            num_workers=num_workers,
+            chunksize=options.parse_chunksize
+        )
+        try:
+            started = time.time()
+            for batch in batches:
+                pool.map(batch)
+            elapsed = time.time() - started
+        finally:
+            pool.close()
+        report(
+            'parse_pool.%d' % num_workers,
+            cpus=multiprocessing.cpu_count(),
+            statuses_per_second=len(messages) / elapsed
+        )
+        
+    
+
+
+@benchmark
+def payload(options):
+    """Compare the bytes on the wire and the CPU time to encode a batch,
+      per 1k statuses, for each wire format and compression, against url
+      encoding the whole batch in one go, the way the processor used to.
+    """
+    
+    messages = StreamParser().feed(load_stream(options))
+    per_k = 1000.0 / len(messages)
+    
+    def measure(name, f):
+        started = time.clock()
+        size = f()
+        elapsed = time.clock() - started
+        report(
+            'payload.%s' % name,
+            kb_per_1k=size * per_k / 1024,
+            cpu_ms_per_1k=elapsed * per_k * 1000
+        )
+        
+    
+    measure(
+        'urlencode',
+        lambda: len(unicode_urlencode({'items': '[%s]' % ','.join(messages)}))
+    )
+    for format in encode.FORMATS:
+        for compression in (None,) + encode.COMPRESSIONS:
+            name = compression and '%s.%s' % (format, compression) or format
+            measure(name, lambda: sum(
+                    len(piece) for piece in encode.encode(
+                        messages,
+                        format,
+                        compression
+                    )
+                )
+            )
+        
+    
+
+
+
+# imports a module, in a fresh interpreter, for the ``startup`` benchmark
+_IMPORT_MODULE = """
+import sys, time
+started = time.time()
+__import__(sys.argv[1])
+elapsed = time.time() - started
+from gevent import monkey
+print elapsed, len(sys.modules), int(monkey.is_module_patched('socket'))
+"""
+
+@benchmark
+def startup(options):
+    """Time starting the ``close-consume`` and ``close-process`` entry
+      points, ``consumer.py`` and ``process.py``, in fresh interpreters:
+      importing the module and running it with ``--help``, which parses
+      the options and exits.  Reports the modules loaded by the import
+      and whether it monkey patched ``socket``, which it shouldn't.
+      
+      ``python -X importtime`` needs Python 3.7, so this times the whole
+      import instead.
+    """
+    
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    for name in 'consumer', 'process':
+        import_times = []
+        help_times = []
+        for i in xrange(options.rounds):
+            output = subprocess.check_output(
+                [sys.executable, '-c', _IMPORT_MODULE, name],
+                cwd=cwd
+            )
+            elapsed, num_modules, patched = output.split()
+            import_times.append(float(elapsed))
+            started = time.time()
+            subprocess.check_call(
+                [sys.executable, '%s.py' % name, '--help'],
+                cwd=cwd,
+                stdout=open(os.devnull, 'w')
+            )
+            help_times.append(time.time() - started)
+        report(
+            'startup.%s' % name,
+            import_ms=1000 * min(import_times),
+            help_ms=1000 * min(help_times),
+            modules=int(num_modules),
+            patched=patched == '1'
+        )
+        
+    
+
+
+def parse_options():
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option(
+        '--logging',
+        dest='log_level',
+        action='store',
+        type='string',
+        default='warning'
+    )
+    parser.add_option(
+        '--num-messages',
+        dest='num_messages',
+        action='store',
+        type='int',
+        help='how many messages to push through each benchmark',
+        default=20000
+    )
+    parser.add_option(
+        '--capture',
+        dest='capture',
+        action='store',
+        type='string',
+        help='a recorded, chunk transfer encoded, stream body to use',
+        default=''
+    )
+    parser.add_option(
+        '--max-chunk-size',
+        dest='max_chunk_size',
+        action='store',
+        type='int',
+        help='split generated messages across chunks of this size',
+        default=0
+    )
+    parser.add_option(
+        '--feed-size',
+        dest='feed_size',
+        action='store',
+        type='int',
+        help='how many bytes at a time to feed the parser',
+        default=65536
+    )
+    parser.add_option(
+        '--python3',
+        dest='python3',
+        action='store',
+        type='string',
+        help='the Python 3 interpreter to run the asyncio engine in',
+        default='python3'
+    )
+    parser.add_option(
+        '--latency',
+        dest='latency',
+        action='store',
+        type='float',
+        help='the round trip time for the replay server to emulate, in seconds',
+        default=0.02
+    )
+    parser.add_option(
+        '--rounds',
+        dest='rounds',
+        action='store',
+        type='int',
+        help='how many times to repeat benchmarks that compare small differences',
+        default=5
+    )
+    parser.add_option(
+        '--replay-port',
+        dest='replay_port',
+        action='store',
+        type='int',
+        help='the local port to run the replay server on',
+        default=8383
+    )
+    parser.add_option(
+        '--rate',
+        dest='rate',
+        action='store',
+        type='int',
+        help='messages per second for the replay server to send, 0 for flat out',
+        default=0
+    )
+    parser.add_option(
+        '--secure',
+        dest='secure',
+        action='store_true',
+        help='have the replay server use TLS',
+        default=False
+    )
+    parser.add_option(
+        '--sink',
+        dest='sink',
+        action='store',
+        type='choice',
+        choices=['redis', 'null'],
+        help='write the data to ``redis`` or just drop it',
+        default='redis'
+    )
+    parser.add_option(
+        '--parse-batch-size',
+        dest='parse_batch_size',
+        action='store',
+        type='int',
+        help='how many statuses to hand the parsing pool at a time',
+        default=1000
+    )
+    parser.add_option(
+        '--parse-chunksize',
+        dest='parse_chunksize',
+        action='store',
+        type='int',
+        help='how many statuses to hand each parse worker at a time',
+        default=100
+    )
+    parser.add_option(
+        '--batch-size',
+        dest='batch_size',
+        action='store',
+        type='int',
+        help='how many items to post to the webhook at a time',
+        default=10
+    )
+    parser.add_option(
+        '--num-batches',
+        dest='num_batches',
+        action='store',
+        type='int',
+        help='how many batches to post to the webhook',
+        default=500
+    )
+    parser.add_option(
+        '--timeout',
+        dest='timeout',
+        action='store',
+        type='float',
+        help='how long to give the end to end benchmarks to complete',
+        default=60
+    )
+    return parser.parse_args()
+    
+    
+def main():
+    monkey_patch()
+    options, names = parse_options()
+    logging.basicConfig(
+        level=getattr(
+            logging,
+            options.log_level.upper()
+        )
+    )
+    
+    for f in BENCHMARKS:
+        if not names or f.__name__ in names:
+            f(options)
+        
+    
+
+
+
+if __name__ == '__main__':
+    main()
+    
+    
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Opens the consumers' connections to the Streaming API, so that a
+  reconnect, or the handover to a new generation of consumers, pays for
+  as little as possible:
+  
+  #. the addresses the host resolves to are cached for ``dns_ttl``
+     seconds, and forgotten when connecting to them fails
+  #. the consumers share one ``SSLContext``, though Python 2's ``ssl``
+     module can't resume TLS sessions, so every connection does the full
+     handshake, which ``prewarm`` takes out of the handover
+  #. with ``prewarm``, a spare connection, with the TCP and TLS handshakes
+     already done, is kept ready for the next consumer that connects
+      
+  The spare connection doesn't send the request: it's the request that
+  authenticates and opens the stream, which would count against the
+  account's connection limit.
+"""
+
+import gevent
+from gevent import event, socket, ssl
+
+import errno
+import logging
+import time
+
+def _is_fresh(sock):
+    """A connection nobody's written to shouldn't have anything to read,
+      apart from TLS 1.3 session tickets, which the ``ssl`` module reads
+      for us, if it has then the server's hung up on it.
+    """
+    
+    timeout = sock.gettimeout()
+    sock.settimeout(0)
+    try:
+        sock.recv(1)
+    except ssl.SSLWantReadError:
+        return True
+    except socket.error, err:
+        return err.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+    finally:
+        sock.settimeout(timeout)
+    return False
+    
+    
+
+
+class Connector(object):
+    """Connects to ``host``:``port``, over TLS if ``secure``.  Shared by a
+      manager's consumers, see ``BaseManager``.
+      
+      A spare connection is replaced once it's ``max_spare_age`` seconds
+      old, before the server times it out for not sending a request.
+    """
+    
+    def __init__(
+            self, host, port, secure=True, timeout=61, dns_ttl=60,
+            prewarm=False, max_spare_age=15
+        ):
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.timeout = timeout
+        self.dns_ttl = dns_ttl
+        self.prewarm = prewarm
+        self.max_spare_age = max_spare_age
+        self.context = None
+        if secure:
+            # no verification, as with the ``ssl.wrap_socket`` this
+            # replaces
+            self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        # what it's been up to, for ``BaseManager.render_metrics``
+        self.dns_lookups = 0
+        self.dials = 0
+        self.spares_used = 0
+        self._addresses = None
+        self._resolved_at = 0
+        self._spare = None
+        self._spare_at = 0
+        self._taken = event.Event()
+        self._warmer = None
+        
+    
+    
+    def resolve(self):
+        """The ``getaddrinfo`` results for the host, cached for
+          ``dns_ttl`` seconds.
+        """
+        
+        now = time.time()
+        if self._addresses is None or now - self._resolved_at >= self.dns_ttl:
+            self.dns_lookups += 1
+            self._addresses = socket.getaddrinfo(
+                self.host,
+                self.port,
+                0,
+                socket.SOCK_STREAM
+            )
+            self._resolved_at = now
+        return self._addresses
+        
+    
+    def forget(self):
+        """Resolve the host again next time, e.g.: when connecting to it
+          has failed.
+        """
+        
+        self._addresses = None
+        
+    
+    
+    def _wrap(self, raw_sock):
+        return self.context.wrap_socket(raw_sock, server_hostname=self.host)
+        
+    
+    def _dial(self):
+        """Open a new connection, trying each address in turn.
+        """
+        
+        self.dials += 1
+        err = None
+        for family, type_, proto, _, address in self.resolve():
+            raw_sock = socket.socket(family, type_, proto)
+            try:
+                raw_sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                # we only write the handshake and the request, so there's
+                # nothing for Nagle's algorithm to save
+                raw_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                raw_sock.settimeout(self.timeout)
+                raw_sock.connect(address)
+                if self.secure:
+                    return self._wrap(raw_sock)
+                return raw_sock
+            except socket.error, err:
+                raw_sock.close()
+        self.forget()
+        raise err or socket.error('%s resolved to nothing' % self.host)
+        
+    
+    def _take_spare(self):
+        sock = self._spare
+        if sock is None:
+            return None
+        self._spare = None
+        self._taken.set()
+        if time.time() - self._spare_at < self.max_spare_age and _is_fresh(sock):
+            self.spares_used += 1
+            return sock
+        sock.close()
+        return None
+        
+    
+    def _keep_warm(self):
+        """Keep a spare connection no older than ``max_spare_age``.
+        """
+        
+        while True:
+            self._taken.clear()
+            age = time.time() - self._spare_at
+            if self._spare is None or age >= self.max_spare_age:
+                if self._spare is not None:
+                    self._spare.close()
+                    self._spare = None
+                try:
+                    self._spare = self._dial()
+                except socket.error, err:
+                    logging.info('failed to prewarm a connection: %s' % err)
+                    gevent.sleep(1)
+                    continue
+                self._spare_at = time.time()
+                age = 0
+            self._taken.wait(self.max_spare_age - age)
+        
+    
+    
+    def connect(self):
+        """A connected socket, the spare one, if there is one and it's
+          still good, or a new one.
+        """
+        
+        sock = self._take_spare()
+        if sock is None:
+            sock = self._dial()
+        if self.prewarm and self._warmer is None:
+            self._warmer = gevent.spawn(self._keep_warm)
+        return sock
+        
+    
+    def close(self):
+        """Stop keeping a spare connection.
+        """
+        
+        if self._warmer is not None:
+            self._warmer.kill()
+            self._warmer = None
+        if self._spare is not None:
+            self._spare.close()
+            self._spare = None
+        
+    
+
+
+
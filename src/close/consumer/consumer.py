@@ -6,20 +6,21 @@
   .. _redis: http://code.google.com/p/redis/
 """
 
+from backends import make_backend, make_redis
 from base import BaseConsumer, BaseManager, BaseWSGIApp
+from keys import BACKENDS, FOLLOW_KEY, TRACK_KEY
+from queues import BLOCK, DROP_NEWEST, DROP_OLDEST, POLICIES, SPILL
+from spill import SpillQueue
+from trace import Traced
+from utils import monkey_patch
 
 import logging
+import os
+import sys
+import time
 
 import gevent
-
-from redis import Redis
-r = Redis()
-
-NAMESPACE = u'close.consumer.'
-FOLLOW_KEY = u'%sfollow' % NAMESPACE
-TRACK_KEY = u'%strack' % NAMESPACE
-DATA_KEY = u'%sdata' % NAMESPACE
-NOTIFICATION_KEY = u'%snotify' % NAMESPACE
+from gevent import event, sleep
 
 class Consumer(BaseConsumer):
     """Gets data delimited_ by length.
@@ -27,26 +28,196 @@ class Consumer(BaseConsumer):
       .. _delimited: http://apiwiki.twitter.com/Streaming-API-Documentation#delimited
     """
     
-    def get_data(self):
-        line = self._readline_chunked()
-        if line.isdigit():
-            return self._read_chunked(int(line))
+    delimited = 'length'
+    
+    
+
+
+class Batcher(object):
+    """Gathers items and writes them to the ``backend`` in batches.  The
+      default, a ``backends.ListBackend`` on ``DATA_KEY``, uses a single,
+      pipelined, multi-value ``RPUSH`` (which requires redis >= 2.4),
+      followed by a single notification per batch.
+      
+      A batch is flushed as soon as it has ``max_batch_size`` items, or 
+      when the first item in it has been waiting for ``max_linger`` 
+      seconds, whichever comes first.  Batches are written in order by
+      a single greenlet.
+      
+      If provided with a ``spill.SpillQueue``, then when redis is down, or
+      more than ``max_pending`` items are waiting to be written, the items
+      are moved to disk and written back, in order, once redis catches up.
+      Without one, at most ``max_pending`` items are held in memory and the
+      ``policy``, see ``queues.POLICIES``, decides what happens to the next:
+      ``add`` waits for room, or the oldest or newest item is dropped.  The
+      ``spill`` policy has nothing to spill to, so it waits too.  Keeps
+      count of the items ``dropped`` and of the seconds spent ``blocked``.
+      
+      If ``trace``, the ``trace.Traced`` items are written in their
+      envelopes.  Traced items that are spilled lose their trace.
+    """
+    
+    def __init__(
+            self, max_batch_size=100, max_linger=0.05, retry_delay=1,
+            spill=None, max_pending=10000, trace=False, backend=None,
+            policy=BLOCK
+        ):
+        self.max_batch_size = max_batch_size
+        self.max_linger = max_linger
+        self.retry_delay = retry_delay
+        self.spill = spill
+        self.max_pending = max_pending
+        self.policy = policy
+        self.trace = trace
+        self.backend = backend or make_backend(make_redis())
+        self.items = []
+        self.dropped = 0
+        self.blocked = 0.0
+        self._ready = event.Event()
+        self._not_full = event.Event()
+        self._flusher = gevent.spawn(self._flush_forever)
+        
+    
+    
+    def _flush_forever(self):
+        while True:
+            self._ready.clear()
+            if not self.items and not self.spill:
+                self._ready.wait()
+            if not self.spill and len(self.items) < self.max_batch_size:
+                self._ready.clear()
+                self._ready.wait(self.max_linger)
+            try:
+                if self.spill is not None and len(self.items) > self.max_pending:
+                    logging.warning('Sink is lagging, spilling to disk')
+                    self._spill()
+                if self.spill:
+                    self._drain()
+                else:
+                    self.flush()
+            except Exception, err:
+                logging.warning('Failed to flush batch, retrying')
+                logging.warning(err, exc_info=True)
+                if self.spill is not None:
+                    self._spill()
+                sleep(self.retry_delay)
         
     
     
+    def _write(self, items):
+        if self.trace:
+            items = list(items)
+            for i, item in enumerate(items):
+                if isinstance(item, Traced):
+                    item.stamp('rpush')
+                    items[i] = item.envelope()
+        self.backend.write(items)
+        
+    
+    def _spill(self):
+        """Move the items waiting in memory onto the end of the spill queue
+          and make sure they're on disk.
+        """
+        
+        for item in self.items:
+            self.spill.put(item)
+        del self.items[:]
+        self.spill.sync()
+        
+    
+    def _drain(self):
+        """Write the spilled items, oldest first.
+        """
+        
+        while self.spill:
+            n = min(len(self.spill), self.max_batch_size)
+            items = [self.spill.get() for i in xrange(n)]
+            try:
+                self._write(items)
+            except:
+                self.spill.rollback()
+                raise
+            self.spill.commit()
+        self.spill.sync()
+        
+    
+    def flush(self):
+        """Write up to ``max_batch_size`` items.  If that fails, they're
+          put back at the front of the batch.
+        """
+        
+        items = self.items[:self.max_batch_size]
+        del self.items[:self.max_batch_size]
+        if not items:
+            return
+        try:
+            self._write(items)
+        except:
+            self.items[:0] = items
+            raise
+        self._not_full.set()
+        
+    
+    def full(self):
+        return self.spill is None and len(self.items) >= self.max_pending
+        
+    
+    def add(self, item):
+        """Add ``item`` to the next batch, applying the ``policy`` if
+          there's no spill queue and ``max_pending`` items are waiting.
+        """
+        
+        if self.full():
+            if self.policy == DROP_NEWEST:
+                self.dropped += 1
+                return
+            elif self.policy == DROP_OLDEST:
+                del self.items[0]
+                self.dropped += 1
+            else:
+                started = time.time()
+                while self.full():
+                    self._not_full.clear()
+                    self._not_full.wait()
+                self.blocked += time.time() - started
+        self.items.append(item)
+        n = len(self.items)
+        if n == 1 or n >= self.max_batch_size:
+            self._ready.set()
+        
+    
+
 
 
 class Manager(BaseManager):
-    """Generate the filter predicates and handle the data.
+    """Generate the filter predicates, from the ``redis`` client passed
+      in, or one on localhost, and handle the data.
     """
     
+    def __init__(self, *args, **kwargs):
+        self.redis = kwargs.pop('redis', None) or make_redis()
+        spill = None
+        if kwargs.get('spill_dir'):
+            spill = SpillQueue(os.path.join(kwargs['spill_dir'], 'sink'))
+        self.batcher = Batcher(
+            max_batch_size=kwargs.pop('max_batch_size', 100),
+            max_linger=kwargs.pop('max_linger', 0.05),
+            spill=spill,
+            max_pending=kwargs.get('queue_size', 10000),
+            policy=kwargs.get('overload_policy', BLOCK),
+            trace=bool(kwargs.get('trace_sample_rate')),
+            backend=kwargs.pop('backend', None) or make_backend(self.redis)
+        )
+        super(Manager, self).__init__(*args, **kwargs)
+        
+    
     def get_params(self):
         """Get the predicates from redis.
         """
         
         params = {}
-        follow = r.get(FOLLOW_KEY)
-        track = r.get(TRACK_KEY)
+        follow = self.redis.get(FOLLOW_KEY)
+        track = self.redis.get(TRACK_KEY)
         if follow:
             params['follow'] = follow
         if track:
@@ -56,17 +227,33 @@ class Manager(BaseManager):
     
     def handle_data(self, data):
         """Append the data to a redis list and notify that 
-          we've done so.
+          we've done so, in batches.
         """
         
-        r.rpush(DATA_KEY, data)
-        r.rpush(NOTIFICATION_KEY, 1)
+        self.batcher.add(data)
         
     
+    def dropped(self):
+        return super(Manager, self).dropped() + self.batcher.dropped
+        
     
+    def blocked(self):
+        return super(Manager, self).blocked() + self.batcher.blocked
+        
+    
+
 
 
 class WSGIApp(BaseWSGIApp):
+    """Saves the predicates to the ``redis`` client passed in, or one on
+      localhost.
+    """
+    
+    def __init__(self, manager, redis=None):
+        super(WSGIApp, self).__init__(manager)
+        self.redis = redis or make_redis()
+        
+    
     def handle_request_params(self, action, params):
         """Save the predicates.
         """
@@ -78,15 +265,15 @@ class WSGIApp(BaseWSGIApp):
         follow = params.get('follow', None)
         track = params.get('track', None)
         if follow is not None:
-            r.set(FOLLOW_KEY, ','.join(map(str, follow)))
+            self.redis.set(FOLLOW_KEY, ','.join(map(str, follow)))
         if track is not None:
-            r.set(TRACK_KEY, ','.join(map(str, track)))
+            self.redis.set(TRACK_KEY, ','.join(map(str, track)))
         
-        
-    
     
 
 
+
+
 def parse_options():
     from optparse import OptionParser
     parser = OptionParser()
@@ -113,6 +300,52 @@ def parse_options():
         help='the path you want the streaming API ``Consumer.conn`` to request',
         default='/1/statuses/filter.json?delimited=length'
     )
+    parser.add_option(
+        '--stream-port',
+        dest='stream_port',
+        action='store',
+        type='int',
+        help='the port you want the ``Consumer`` to connect to, if not the default',
+        default=0
+    )
+    parser.add_option(
+        '--insecure',
+        dest='secure',
+        action='store_false',
+        help='connect to the streaming API over plain http rather than https',
+        default=True
+    )
+    parser.add_option(
+        '--min-update-interval',
+        dest='min_update_interval',
+        action='store',
+        type='float',
+        help='the fewest seconds between reconnecting for /update requests',
+        default=10
+    )
+    parser.add_option(
+        '--max-overlap',
+        dest='max_overlap',
+        action='store',
+        type='float',
+        help='the most seconds to wait for new consumers to stream data before retiring the old ones',
+        default=5
+    )
+    parser.add_option(
+        '--dns-ttl',
+        dest='dns_ttl',
+        action='store',
+        type='float',
+        help='how many seconds to cache the streaming API host\'s addresses for',
+        default=60
+    )
+    parser.add_option(
+        '--prewarm',
+        dest='prewarm',
+        action='store_true',
+        help='keep a spare connection to the streaming API open, ready to reconnect with',
+        default=False
+    )
     parser.add_option(
         '--username',
         dest='username',
@@ -137,6 +370,133 @@ def parse_options():
         help='the local port you want to expose the ``WSGIApp`` on',
         default=8282
     )
+    parser.add_option(
+        '--redis-host',
+        dest='redis_host',
+        action='store',
+        type='string',
+        help='the host of the redis the predicates and data are kept in',
+        default='localhost'
+    )
+    parser.add_option(
+        '--redis-port',
+        dest='redis_port',
+        action='store',
+        type='int',
+        default=6379
+    )
+    parser.add_option(
+        '--redis-db',
+        dest='redis_db',
+        action='store',
+        type='int',
+        default=0
+    )
+    parser.add_option(
+        '--max-batch-size',
+        dest='max_batch_size',
+        action='store',
+        type='int',
+        help='the most items to write to redis in one go',
+        default=100
+    )
+    parser.add_option(
+        '--max-linger',
+        dest='max_linger',
+        action='store',
+        type='float',
+        help='the most seconds an item can wait to be written to redis',
+        default=0.05
+    )
+    parser.add_option(
+        '--queue-size',
+        dest='queue_size',
+        action='store',
+        type='int',
+        help='the most notifications to hold in memory',
+        default=10000
+    )
+    parser.add_option(
+        '--overload-policy',
+        dest='overload_policy',
+        action='store',
+        type='choice',
+        choices=list(POLICIES),
+        help='what to do with data when the queue is full: %s' % ', '.join(POLICIES),
+        default='block'
+    )
+    parser.add_option(
+        '--spill-dir',
+        dest='spill_dir',
+        action='store',
+        type='string',
+        help='where to spill data to when using the spill overload policy, or when redis is down, in a worker.<index> directory for each of the --workers',
+        default=''
+    )
+    parser.add_option(
+        '--shards',
+        dest='num_shards',
+        action='store',
+        type='int',
+        help='split the follow and track predicates between up to this many streams',
+        default=1
+    )
+    parser.add_option(
+        '--dedup-window',
+        dest='dedup_window',
+        action='store',
+        type='float',
+        help='drop messages seen in the last this many seconds, or 0 not to',
+        default=30
+    )
+    parser.add_option(
+        '--dedup-size',
+        dest='dedup_size',
+        action='store',
+        type='int',
+        help='the most messages to remember for deduplication',
+        default=100000
+    )
+    parser.add_option(
+        '--no-metrics',
+        dest='enable_metrics',
+        action='store_false',
+        help='don\'t keep the counters served at /metrics',
+        default=True
+    )
+    parser.add_option(
+        '--backend',
+        dest='backend',
+        action='store',
+        type='choice',
+        choices=BACKENDS,
+        help='queue the data in a redis %s' % ' or '.join(BACKENDS),
+        default='list'
+    )
+    parser.add_option(
+        '--trace-sample-rate',
+        dest='trace_sample_rate',
+        action='store',
+        type='float',
+        help='trace this fraction of the messages through to the webhook',
+        default=0
+    )
+    parser.add_option(
+        '--workers',
+        dest='num_workers',
+        action='store',
+        type='int',
+        help='split the predicates between this many worker processes',
+        default=0
+    )
+    parser.add_option(
+        '--worker-index',
+        dest='worker_index',
+        action='store',
+        type='int',
+        help='used by the supervisor to start a worker process',
+        default=None
+    )
     parser.add_option(
         '--serve-and-start',
         dest='should_start_consumer',
@@ -150,13 +510,17 @@ def parse_options():
         action='store_false', 
         help='don\'t start a consumer by default'
     )
-    return parser.parse_args()[0]
+    options = parser.parse_args()[0]
+    # the workers would all spill into the same ``./notifications``
+    if options.num_workers and options.overload_policy == SPILL and \
+            not options.spill_dir:
+        parser.error('--overload-policy=spill needs a --spill-dir with --workers')
+    return options
     
-
-def main():
-    from gevent import wsgi
     
+def main():
     options = parse_options()
+    monkey_patch()
     logging.basicConfig(
         level=getattr(
             logging, 
@@ -164,28 +528,70 @@ def main():
         )
     )
     
-    kwargs = {}
+    redis = make_redis(options.redis_host, options.redis_port, options.redis_db)
+    kwargs = {
+        'secure': options.secure,
+        'dns_ttl': options.dns_ttl,
+        'prewarm': options.prewarm,
+        'min_update_interval': options.min_update_interval,
+        'max_overlap': options.max_overlap,
+        'max_batch_size': options.max_batch_size,
+        'max_linger': options.max_linger,
+        'queue_size': options.queue_size,
+        'overload_policy': options.overload_policy,
+        'spill_dir': options.spill_dir or None,
+        'num_shards': options.num_shards,
+        'dedup_window': options.dedup_window,
+        'dedup_size': options.dedup_size,
+        'enable_metrics': options.enable_metrics,
+        'trace_sample_rate': options.trace_sample_rate,
+        'redis': redis,
+        'backend': make_backend(redis, options.backend)
+    }
+    if options.stream_port:
+        kwargs['port'] = options.stream_port
     if options.username:
         kwargs['username'] = options.username
     if options.password:
         kwargs['password'] = options.password
-    
-    manager = Manager(Consumer, options.host, options.path, **kwargs)
+        
+    if options.num_workers and options.worker_index is not None:
+        # we're a worker, taking orders from the supervisor
+        from supervisor import run_worker
+        if options.spill_dir:
+            kwargs['spill_dir'] = os.path.join(
+                options.spill_dir,
+                'worker.%d' % options.worker_index
+            )
+        kwargs['worker_slice'] = (options.worker_index, options.num_workers)
+        manager = Manager(Consumer, options.host, options.path, **kwargs)
+        run_worker(manager)
+        return
+    elif options.num_workers:
+        from supervisor import Supervisor
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        make_command = lambda index, count: [
+            sys.executable, script
+        ] + sys.argv[1:] + ['--worker-index', str(index)]
+        manager = Supervisor(make_command, num_workers=options.num_workers)
+    else:
+        manager = Manager(Consumer, options.host, options.path, **kwargs)
     if options.should_start_consumer:
         manager.start_a_consumer()
-    
-    app = WSGIApp(manager=manager)
-    server = wsgi.WSGIServer(('', options.port), app.handle_requests)
+        
+    from gevent.pywsgi import WSGIServer
+    app = WSGIApp(manager=manager, redis=redis)
+    server = WSGIServer(('', options.port), app.handle_requests)
     
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
-    
+        
     
 
 
 if __name__ == '__main__':
     main()
     
-
+    
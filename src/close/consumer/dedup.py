@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Drop the duplicate messages that overlapping consumers receive, e.g.:
+  during a low latency restart, or when a status matches the predicates
+  of more than one shard.
+"""
+
+import hashlib
+import re
+import sys
+import time
+
+try:
+    from ujson import loads as _loads
+except ImportError:
+    try:
+        from simplejson import loads as _loads
+    except ImportError:
+        from json import loads as _loads
+        
+    
+
+# the scalar ``"key": value`` pairs a status might start with
+_SCALAR = r'"[^"\\]*"\s*:\s*(?:"[^"\\]*(?:\\.[^"\\]*)*"|-?[\d.eE+-]+|true|false|null)\s*,\s*'
+# a top level ``id`` that comes before any nested objects or arrays
+_LEADING_ID = re.compile(r'\{\s*(?:%s)*?"id"\s*:\s*(-?\d+)\s*[,}]' % _SCALAR)
+
+# the bytes taken up by each key in the index
+ID_SIZE = sys.getsizeof(2 ** 62)
+DIGEST_SIZE = sys.getsizeof(hashlib.md5().digest())
+
+def extract_id(data):
+    """Get the top level ``id`` out of a JSON status, or ``None`` if there
+      isn't one.
+      
+      Statuses from the Streaming API start with ``created_at`` and ``id``,
+      so the ``id`` can usually be matched without parsing the status.
+      Otherwise it's decoded with the fastest JSON library available, as
+      that's quicker than scanning for a top level ``id`` in Python.
+    """
+    
+    match = _LEADING_ID.match(data)
+    if match:
+        return int(match.group(1))
+    try:
+        status = _loads(data)
+    except (ValueError, OverflowError):
+        return None
+    if isinstance(status, dict):
+        key = status.get('id')
+        if type(key) in (int, long):
+            return key
+    return None
+    
+    
+
+class Deduplicator(object):
+    """Remembers the messages seen in roughly the last ``window`` seconds,
+      or the last ``max_size`` messages, if that's fewer, in a pair of
+      rotating sets.
+      
+      Messages are keyed by their status id, see ``extract_id``, or by a
+      digest of the whole message if they don't have one, e.g.: deletion
+      notices, so the index holds ints and 16 byte strings rather than the
+      messages themselves.
+      
+      Keeps count of the ``duplicates`` dropped.
+    """
+    
+    def __init__(self, window=30, max_size=100000):
+        self.window = window
+        self.max_size = max_size
+        self.duplicates = 0
+        self._current = set()
+        self._previous = set()
+        # how many of the keys in each set are digests
+        self._digests = [0, 0]
+        self._rotated_at = time.time()
+        
+    
+    def _rotate(self):
+        self._previous = self._current
+        self._current = set()
+        self._digests = [0, self._digests[0]]
+        self._rotated_at = time.time()
+        
+    
+    def seen(self, data):
+        """Record ``data``, returning whether it's a duplicate.
+        """
+        
+        key = extract_id(data)
+        is_digest = key is None
+        if is_digest:
+            key = hashlib.md5(data).digest()
+        if key in self._current or key in self._previous:
+            self.duplicates += 1
+            return True
+        # each set covers half the window
+        if len(self._current) >= self.max_size / 2 or \
+                time.time() - self._rotated_at >= self.window / 2.0:
+            self._rotate()
+        self._current.add(key)
+        self._digests[0] += is_digest
+        return False
+        
+    
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+        
+    
+    def memory(self):
+        """Roughly how many bytes the index is using.
+        """
+        
+        size = 0
+        for keys, digests in zip((self._current, self._previous), self._digests):
+            size += sys.getsizeof(keys)
+            size += digests * DIGEST_SIZE + (len(keys) - digests) * ID_SIZE
+        return size
+        
+    
+
+
+
+
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Wire formats for the batches ``process.py`` posts.
+  
+  ``encode`` yields the body a piece at a time, so it can be streamed
+  to the socket chunk transfer encoded rather than built up in memory,
+  ala:
+      
+      headers.update(content_headers('ndjson', 'gzip'))
+      pool.request('POST', url, lambda: encode(items, 'ndjson', 'gzip'), headers)
+      
+  The items are expected to be JSON strings, e.g.: the output of
+  ``parse.parse_item``.
+"""
+
+import struct
+import urllib
+import zlib
+
+FORM = 'form'
+JSON = 'json'
+NDJSON = 'ndjson'
+BINARY = 'binary'
+FORMATS = (FORM, JSON, NDJSON, BINARY)
+
+GZIP = 'gzip'
+DEFLATE = 'deflate'
+COMPRESSIONS = (GZIP, DEFLATE)
+
+CONTENT_TYPES = {
+    FORM: 'application/x-www-form-urlencoded',
+    JSON: 'application/json',
+    NDJSON: 'application/x-ndjson',
+    BINARY: 'application/octet-stream'
+}
+
+# each item in the ``binary`` format is prefixed with its length
+LENGTH_PREFIX = struct.Struct('>I')
+
+def _utf8(item):
+    if isinstance(item, unicode):
+        return item.encode('utf-8')
+    return item
+    
+    
+
+def _pieces(items, format):
+    """Yield the uncompressed body, a piece at a time.
+    """
+    
+    if format == FORM:
+        # a single ``items`` field, holding a JSON array
+        yield 'items='
+        yield urllib.quote_plus('[')
+        comma = urllib.quote_plus(',')
+        for i, item in enumerate(items):
+            if i:
+                yield comma
+            yield urllib.quote_plus(_utf8(item))
+        yield urllib.quote_plus(']')
+    elif format == JSON:
+        yield '['
+        for i, item in enumerate(items):
+            if i:
+                yield ','
+            yield _utf8(item)
+        yield ']'
+    elif format == NDJSON:
+        for item in items:
+            yield _utf8(item)
+            yield '\n'
+    elif format == BINARY:
+        pack = LENGTH_PREFIX.pack
+        for item in items:
+            item = _utf8(item)
+            yield pack(len(item))
+            yield item
+    else:
+        raise ValueError(format)
+        
+    
+
+def _compress(pieces, compression, level=6):
+    if compression == GZIP:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == DEFLATE:
+        compressor = zlib.compressobj(level)
+    else:
+        raise ValueError(compression)
+    for piece in pieces:
+        data = compressor.compress(piece)
+        if data:
+            yield data
+    yield compressor.flush()
+    
+    
+
+def encode(items, format=JSON, compression=None, chunk_size=65536):
+    """Yield the body for ``items`` in the given wire ``format``, optionally
+      compressed, in pieces of roughly ``chunk_size`` bytes.
+    """
+    
+    pieces = _pieces(items, format)
+    if compression:
+        pieces = _compress(pieces, compression)
+    buf = []
+    size = 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
+        
+    
+
+def content_headers(format, compression=None):
+    """The ``Content-Type`` and, if compressed, ``Content-Encoding``
+      headers for a body in the given wire ``format``.
+    """
+    
+    headers = {'Content-Type': CONTENT_TYPES[format]}
+    if compression:
+        headers['Content-Encoding'] = compression
+    return headers
+    
+    
+
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Push style parser for a chunk transfer encoded Streaming API body.
+  
+  The parser doesn't do any io: feed it whatever bytes you have, in
+  whatever sized slices they arrive, and it hands back the complete
+  messages, keeping track of chunk sizes, CRLFs and length prefixes
+  between calls.  That means the same parser can be driven by a gevent
+  socket, an asyncio protocol or a recorded stream, ala:
+      
+      parser = StreamParser(delimited='length')
+      for data in iter(lambda: f.read(65536), ''):
+          for message in parser.feed(data):
+              handle(message)
+      
+  
+  Doesn't depend on gevent.
+"""
+
+# longest chunk size or length prefix line we'll accept before giving up
+MAX_LINE = 1024
+
+class FramingError(ValueError):
+    """Raised when the stream can't be parsed, e.g.: on losing chunk sync.
+    """
+    
+    
+
+class StreamParser(object):
+    """Parses messages out of a stream body that's ``delimited`` by
+      ``'length'``, i.e.: each message is preceded by a line giving its
+      length in bytes, or by ``'newline'``.  Blank keep alive lines are
+      skipped.
+      
+      If ``chunked``, the body is first decoded from chunked transfer
+      encoding.  ``self.closed`` is set when the last chunk arrives.
+    """
+    
+    def __init__(self, delimited='length', chunked=True):
+        if delimited not in ('length', 'newline'):
+            raise ValueError(delimited)
+        self.delimited = delimited
+        self.chunked = chunked
+        self.closed = False
+        self.num_chunks = 0
+        # chunk decoding state
+        self.chunk_left = None
+        self._crlf = 0
+        self._size_line = bytearray()
+        # message framing state
+        self._length = None
+        self._line = bytearray()
+        self._payload = bytearray()
+        
+    
+    
+    def feed(self, data, start=0, end=None):
+        """Parse ``data[start:end]`` and return a list of the messages
+          completed by it.
+          
+          ``data`` can be a ``bytes`` or ``bytearray``, so you can feed
+          the parser straight from a buffer you ``recv_into``.  Messages
+          are copied out of it, so it's safe to reuse the buffer as soon
+          as this returns.
+        """
+        
+        if end is None:
+            end = len(data)
+        view = memoryview(data)
+        messages = []
+        if not self.chunked:
+            self._frame(data, view, start, end, messages)
+            return messages
+        pos = start
+        while pos < end and not self.closed:
+            if self._crlf:
+                n = min(self._crlf, end - pos)
+                self._crlf -= n
+                pos += n
+            elif self.chunk_left is None:
+                i = data.find(b'\n', pos, end)
+                if i == -1:
+                    self._size_line += view[pos:end]
+                    if len(self._size_line) > MAX_LINE:
+                        raise FramingError('Lost chunk sync')
+                    break
+                line = bytes(self._size_line + view[pos:i])
+                del self._size_line[:]
+                pos = i + 1
+                try:
+                    self.chunk_left = int(line.split(b';')[0].strip(), 16)
+                except ValueError:
+                    raise FramingError('Lost chunk sync')
+                if not self.chunk_left:
+                    self.closed = True
+                self.num_chunks += 1
+            else:
+                n = min(self.chunk_left, end - pos)
+                self._frame(data, view, pos, pos + n, messages)
+                self.chunk_left -= n
+                pos += n
+                if not self.chunk_left:
+                    self.chunk_left = None
+                    self._crlf = 2
+        return messages
+        
+    
+    def _frame(self, data, view, pos, end, messages):
+        """Parse the messages out of the decoded body ``data[pos:end]``.
+        """
+        
+        by_length = self.delimited == 'length'
+        while pos < end:
+            if self._length is None:
+                i = data.find(b'\n', pos, end)
+                if i == -1:
+                    self._line += view[pos:end]
+                    if by_length and len(self._line) > MAX_LINE:
+                        raise FramingError('Lost length sync')
+                    break
+                if self._line:
+                    line = bytes(self._line + view[pos:i]).strip()
+                    del self._line[:]
+                else:
+                    line = view[pos:i].tobytes().strip()
+                pos = i + 1
+                if not by_length:
+                    if line:
+                        messages.append(line)
+                elif line.isdigit() and int(line):
+                    self._length = int(line)
+            else:
+                need = self._length - len(self._payload)
+                n = min(need, end - pos)
+                if n == need and not self._payload:
+                    # the common case: the whole message is in ``data``
+                    messages.append(view[pos:pos + n].tobytes())
+                    self._length = None
+                else:
+                    self._payload += view[pos:pos + n]
+                    if n == need:
+                        messages.append(bytes(self._payload))
+                        del self._payload[:]
+                        self._length = None
+                pos += n
+        
+    
+
+
+
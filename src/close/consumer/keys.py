@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""The redis keys the consumer writes to and the processor reads from.
+  
+  Just constants, so tools can import them without gevent being patched
+  in or a redis client being created.
+"""
+
+NAMESPACE = u'close.consumer.'
+FOLLOW_KEY = u'%sfollow' % NAMESPACE
+TRACK_KEY = u'%strack' % NAMESPACE
+DATA_KEY = u'%sdata' % NAMESPACE
+NOTIFICATION_KEY = u'%snotify' % NAMESPACE
+STREAM_KEY = u'%sstream' % NAMESPACE
+
+# the names of the ``backends``
+BACKENDS = ('list', 'stream')
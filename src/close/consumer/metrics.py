@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Counters, gauges and histograms for the consumer, exported in the
+  Prometheus text format.
+  
+  The hot path just bumps plain attributes, so there are no locks, which
+  greenlets don't need, and nothing is allocated per message.
+"""
+
+import bisect
+
+PREFIX = 'close_consumer_'
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1
+)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, v) for k, v in sorted(labels.iteritems())
+    )
+    
+    
+
+def render_family(name, kind, help, samples):
+    """The lines for a metric called ``PREFIX + name``, with a
+      ``(labels, value)`` pair per sample.
+    """
+    
+    name = PREFIX + name
+    lines = [
+        '# HELP %s %s' % (name, help),
+        '# TYPE %s %s' % (name, kind)
+    ]
+    for labels, value in samples:
+        lines.append('%s%s %s' % (name, _format_labels(labels), value))
+    return lines
+    
+    
+
+class Histogram(object):
+    """Counts observations into fixed buckets, ala a Prometheus histogram.
+    """
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        
+    
+    def quantile(self, q):
+        """The upper bound of the bucket the ``q``th quantile falls in,
+          or ``None`` if nothing's been observed.
+        """
+        
+        total = sum(self.counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+        
+    
+    def render(self, name, labels={}):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            bucket_labels = dict(labels, le=bound)
+            lines.append('%s_bucket%s %s' % (
+                    name,
+                    _format_labels(bucket_labels),
+                    total
+                )
+            )
+        lines.append('%s_sum%s %r' % (name, _format_labels(labels), self.sum))
+        lines.append('%s_count%s %s' % (name, _format_labels(labels), total))
+        return lines
+        
+    
+
+
+
+class Metrics(object):
+    """Shared by a manager and its consumers, which update the attributes
+      directly.
+      
+      The backoff delays are gauges of the most recent value set by any
+      of the consumers.  The data handler's latency is sampled, see
+      ``BaseManager.latency_sample_rate``, so its histogram counts fewer
+      calls than ``messages``.  There's no rate: scrapers work it out from
+      ``messages_total``, so they don't reset each other's window.
+    """
+    
+    def __init__(self):
+        self.bytes_received = 0
+        self.messages = 0
+        self.chunks = 0
+        # why consumers have had to reconnect
+        self.reconnects = {'tcp': 0, 'http': 0, 'exit': 0}
+        # the current backoff delays
+        self.tcp_ip_delay = 0
+        self.http_delay = 0
+        self.exit_delay = 0
+        # how long the manager's handlers take, by event
+        self.handler_latency = {
+            'data': Histogram(),
+            'connect': Histogram(),
+            'stream': Histogram(),
+            'exit': Histogram()
+        }
+        
+    
+    def render(self, counters={}, gauges={}):
+        """Render the metrics, plus any ``counters`` and ``gauges`` that
+          are kept elsewhere, e.g.: the queue depth, in the Prometheus
+          text format.  The extras map a name to a ``(help, value)`` pair.
+        """
+        
+        lines = []
+        
+        def add(name, kind, help, samples):
+            lines.extend(render_family(name, kind, help, samples))
+            
+        
+        add('bytes_received_total', 'counter', 'Bytes read from the stream.',
+            [({}, self.bytes_received)])
+        add('messages_total', 'counter', 'Messages parsed out of the stream.',
+            [({}, self.messages)])
+        add('chunks_total', 'counter', 'Transfer encoding chunks read.',
+            [({}, self.chunks)])
+        add('reconnects_total', 'counter', 'Reconnections, by cause.',
+            [({'cause': k}, v) for k, v in sorted(self.reconnects.iteritems())])
+        add('backoff_delay_seconds', 'gauge', 'The current backoff delays.', [
+                ({'cause': 'tcp'}, self.tcp_ip_delay),
+                ({'cause': 'http'}, self.http_delay),
+                ({'cause': 'exit'}, self.exit_delay)
+            ]
+        )
+        for kind, extras in (('counter', counters), ('gauge', gauges)):
+            for name, (help, value) in sorted(extras.iteritems()):
+                add(name, kind, help, [({}, value)])
+        name = PREFIX + 'handler_latency_seconds'
+        lines.append('# HELP %s How long handling each event took.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for event, histogram in sorted(self.handler_latency.iteritems()):
+            lines.extend(histogram.render(name, {'event': event}))
+        return '\n'.join(lines) + '\n'
+        
+    
+
+
+
+
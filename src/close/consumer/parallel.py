@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Parse items in a pool of worker processes, so parsing isn't limited
+  to the one core the gevent loop runs on.
+"""
+
+import gevent
+from gevent import queue, socket
+
+import cPickle as pickle
+import fcntl
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+
+from utils import parse_each
+
+# each message between the processes is prefixed with its length
+HEADER = struct.Struct('>I')
+
+class WorkerError(Exception):
+    """Raised when a worker process goes away, or fails, part way through
+      a chunk of items.
+    """
+    
+    
+
+
+def _read_exactly(fd, n):
+    """Blocking read of ``n`` bytes from ``fd``, or ``''`` at the end.
+    """
+    
+    chunks = []
+    while n:
+        data = os.read(fd, n)
+        if not data:
+            return ''
+        chunks.append(data)
+        n -= len(data)
+    return ''.join(chunks)
+    
+    
+
+def _work(item_parser, fd, inherited):
+    """The worker process: read chunks of items from ``fd``, parse them
+      with ``item_parser`` and write back the results, in order, and how
+      many items it failed on.
+    """
+    
+    # leave ctrl-c to the parent and don't hold the other workers'
+    # sockets open
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for other in inherited:
+        os.close(other)
+    # gevent made the socket non-blocking
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+    try:
+        while True:
+            header = _read_exactly(fd, HEADER.size)
+            if not header:
+                return
+            items = pickle.loads(_read_exactly(fd, HEADER.unpack(header)[0]))
+            try:
+                reply = True, parse_each(item_parser, items)
+            except Exception, err:
+                logging.warning(err, exc_info=True)
+                reply = False, repr(err)
+            data = pickle.dumps(reply, 2)
+            data = HEADER.pack(len(data)) + data
+            while data:
+                data = data[os.write(fd, data):]
+    except OSError, err:
+        # the parent went away or gave up on us
+        logging.debug(err)
+        
+    
+
+
+
+class ParsingPool(object):
+    """Parses items with ``item_parser`` in ``num_workers`` processes.
+      
+      ``map`` splits the items into chunks of ``chunksize`` and hands them
+      out to the idle workers, waiting cooperatively for the results, so
+      the gevent loop, e.g.: posting the previous batch, carries on in the
+      meantime.
+      
+      The workers are forked, so ``item_parser`` doesn't need to be
+      picklable.  Items it fails on come back as ``None`` and are counted
+      in ``num_errors``.
+    """
+    
+    def __init__(self, item_parser, num_workers=4, chunksize=100):
+        self.item_parser = item_parser
+        self.num_workers = num_workers
+        self.chunksize = chunksize
+        self.num_errors = 0
+        self._socks = {}
+        self._idle = queue.Queue()
+        for i in xrange(num_workers):
+            self._idle.put(self._spawn())
+        
+    
+    
+    def _spawn(self):
+        sock, child = socket.socketpair()
+        process = multiprocessing.Process(
+            target=_work,
+            args=(
+                self.item_parser,
+                child.fileno(),
+                [s.fileno() for s in self._socks.values()] + [sock.fileno()]
+            )
+        )
+        process.daemon = True
+        process.start()
+        child.close()
+        self._socks[process] = sock
+        return process
+        
+    
+    def _recv_exactly(self, sock, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        pos = 0
+        while pos < n:
+            received = sock.recv_into(view[pos:])
+            if not received:
+                raise WorkerError('Worker process went away')
+            pos += received
+        return bytes(buf)
+        
+    
+    def _call(self, items):
+        process = self._idle.get()
+        sock = self._socks[process]
+        try:
+            data = pickle.dumps(items, 2)
+            sock.sendall(HEADER.pack(len(data)) + data)
+            header = self._recv_exactly(sock, HEADER.size)
+            ok, reply = pickle.loads(
+                self._recv_exactly(sock, HEADER.unpack(header)[0])
+            )
+        except (socket.error, WorkerError, gevent.GreenletExit):
+            # the worker is in an unknown state, so replace it
+            self._discard(process)
+            self._idle.put(self._spawn())
+            raise
+        self._idle.put(process)
+        if not ok:
+            raise WorkerError(reply)
+        results, num_errors = reply
+        self.num_errors += num_errors
+        return results
+        
+    
+    def _discard(self, process):
+        self._socks.pop(process).close()
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        
+    
+    
+    def map(self, items):
+        """Parse ``items`` and return the results in the same order.
+        """
+        
+        items = list(items)
+        if not items:
+            return []
+        chunksize = self.chunksize
+        greenlets = [
+            gevent.spawn(self._call, items[i:i + chunksize])
+            for i in xrange(0, len(items), chunksize)
+        ]
+        try:
+            gevent.joinall(greenlets, raise_error=True)
+        finally:
+            gevent.killall(greenlets)
+        results = []
+        for g in greenlets:
+            results.extend(g.value)
+        return results
+        
+    
+    def close(self):
+        for process in self._socks.keys():
+            self._discard(process)
+        
+    
+
+
+
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A pool of persistent, HTTP/1.1 keep-alive, connections.
+"""
+
+import httplib
+import logging
+import socket
+import time
+import urlparse
+
+# raised when reusing a connection the server has since closed
+STALE_ERRORS = (
+    httplib.BadStatusLine,
+    httplib.CannotSendRequest,
+    httplib.ResponseNotReady,
+    socket.error
+)
+
+class ConnectionPool(object):
+    """Keeps up to ``size`` idle keep-alive connections per host, so that
+      requests don't pay for a new TCP connection and TLS handshake each
+      time.  Connections that have been idle for more than ``idle_timeout``
+      seconds are closed rather than reused.
+      
+      If a reused connection turns out to have been closed by the server,
+      the request is retried once on a new connection, rather than being
+      reported as failed.
+      
+      Python 2's ``ssl`` module can't resume TLS sessions, so the saving
+      for https urls comes from reusing the connections themselves.  Pass
+      an ``ssl.SSLContext`` as ``context`` to share TLS settings between
+      them.
+    """
+    
+    def __init__(self, size=4, idle_timeout=30, timeout=60, context=None):
+        self.size = size
+        self.context = context
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.num_connects = 0
+        self.num_reconnects = 0
+        self._idle = {}
+        
+    
+    
+    def _connect(self, key):
+        scheme, host, port = key
+        self.num_connects += 1
+        if scheme == 'https':
+            kwargs = {}
+            if self.context is not None:
+                kwargs['context'] = self.context
+            return httplib.HTTPSConnection(
+                host,
+                port,
+                timeout=self.timeout,
+                **kwargs
+            )
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+        
+    
+    def _get(self, key):
+        """Get an idle connection to ``key``, or a new one, and whether
+          it's being reused.
+        """
+        
+        idle = self._idle.get(key, [])
+        while idle:
+            connection, last_used = idle.pop()
+            if time.time() - last_used < self.idle_timeout:
+                return connection, True
+            connection.close()
+        return self._connect(key), False
+        
+    
+    def _put(self, key, connection):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.size:
+            idle.append((connection, time.time()))
+        else:
+            connection.close()
+        
+    
+    def _send(self, connection, method, path, body, headers):
+        """Send the request and read the whole response, which has to be
+          done before the connection can be reused.
+        """
+        
+        if callable(body):
+            self._send_chunked(connection, method, path, body(), headers)
+        else:
+            connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        return response, response.read()
+        
+    
+    def _send_chunked(self, connection, method, path, pieces, headers):
+        """Send the request with a chunk transfer encoded body, writing
+          each of the ``pieces`` to the socket as it's produced.
+        """
+        
+        connection.putrequest(method, path)
+        for name, value in headers.iteritems():
+            connection.putheader(name, value)
+        connection.putheader('Transfer-Encoding', 'chunked')
+        # the headers go out with the first chunk and the last chunk with
+        # the end marker, so a small body is sent in a single write rather
+        # than waiting on a delayed ack
+        pending = ''
+        sent_headers = False
+        for piece in pieces:
+            if not piece:
+                continue
+            if pending:
+                if sent_headers:
+                    connection.send(pending)
+                else:
+                    connection.endheaders(pending)
+                    sent_headers = True
+            pending = '%x\r\n%s\r\n' % (len(piece), piece)
+        pending += '0\r\n\r\n'
+        if sent_headers:
+            connection.send(pending)
+        else:
+            connection.endheaders(pending)
+        
+    
+    
+    def request(self, method, url, body=None, headers={}):
+        """Make a request and return the response status and body.
+          
+          ``body`` can be a string, or a callable that returns an iterable
+          of strings, which are streamed to the server chunk transfer
+          encoded.  It's called again if the request has to be retried.
+        """
+        
+        parts = urlparse.urlsplit(url)
+        port = parts.port or (parts.scheme == 'https' and 443 or 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+            
+        connection, reused = self._get(key)
+        try:
+            response, data = self._send(connection, method, path, body, headers)
+        except STALE_ERRORS, err:
+            connection.close()
+            if not reused or isinstance(err, socket.timeout):
+                raise
+            logging.debug('reconnecting stale connection: %s' % err)
+            self.num_reconnects += 1
+            connection = self._connect(key)
+            try:
+                response, data = self._send(connection, method, path, body, headers)
+            except:
+                connection.close()
+                raise
+        except:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._put(key, connection)
+        return response.status, data
+        
+    
+    def close(self):
+        for idle in self._idle.itervalues():
+            for connection, last_used in idle:
+                connection.close()
+        self._idle = {}
+        
+    
+
+
+
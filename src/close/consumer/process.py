@@ -11,139 +11,402 @@
 import gevent
 from gevent import sleep
 
-from consumer import r, DATA_KEY, NOTIFICATION_KEY
-
+import httplib
 import logging
-import urllib2
+import socket
+import time
 
-from utils import generate_auth_header, unicode_urlencode
+from backends import make_backend, make_redis
+from batching import BatchSizer, next_part, part_at
+from encode import content_headers, encode, FORM, FORMATS, COMPRESSIONS
+from keys import BACKENDS
+from metrics import Histogram, PREFIX, render_family
+from pool import ConnectionPool
+from trace import open_envelopes, TraceStats, TRACE_BUCKETS
+from utils import generate_auth_header, monkey_patch, parse_each
 
 class PostingParsingQueueProcessor(object):
-    """Uses redis' `blocking pop command`_ to accept notifications
-      on ``NOTIFICATION_KEY``.  If there are ``self.num_items`` in 
-      ``DATA_KEY``, moves the items into a ``self.ready_key`` list, 
-      optionally parses the items and posts them off to a url provided.
+    """Claims batches of items from the ``backend``, optionally parses
+      the items and posts them off to a url provided.
+      
+      With the default ``backends.ListBackend``, uses redis' `blocking pop
+      command`_ to accept notifications on ``NOTIFICATION_KEY``.  If there
+      are ``self.num_items`` in ``DATA_KEY``, moves all of the items into
+      a ready list.  With a ``backends.StreamBackend``, reads up to
+      ``num_items`` at a time from the stream, as part of a consumer
+      group.
+      
+      Keeps up to ``concurrency`` batches in flight at once, each in its
+      own slot, e.g.: ready list, with its own retry backoff.  A batch
+      stays in its slot until it's been posted, so if the process dies
+      mid-flight the batch is posted again on restart.  Each batch is
+      given an id, sent in the ``X-Batch-Id`` header, that stays the same
+      across retries and restarts, so the receiving end can ignore a
+      batch it's already seen.
+      
+      Items the ``item_parser`` fails on are logged and skipped.  If
+      ``parse_workers`` are provided, items are parsed in a pool of that
+      many processes, see ``parallel.ParsingPool``.  Each batch in flight
+      then has a second slot, that the next batch is claimed into, and
+      parsed in the pool, while this one's being posted.
+      
+      The batches are posted in the wire ``format`` and ``compression``
+      given, see ``encode.encode``, streamed chunk transfer encoded.
+      
+      The number of items to wait for starts at ``num_items``.  Given a
+      ``target_latency``, it's tuned by a ``batching.BatchSizer``, up to
+      ``max_items``, towards posts that take that many seconds.  Given a
+      ``max_linger``, fewer items are claimed once the first has been
+      waiting that many seconds, so a trickle of items isn't held up.  A
+      claimed batch with more than ``max_items`` items, or ``max_bytes``,
+      is posted in parts, see ``batching.next_part``.  When tuning, the
+      tuned size caps the parts too, as under load a ``ListBackend``
+      claims everything that's built up, however many that is.  The
+      bounds of the part in flight are stored with the batch, so a failed
+      part is retried, even after a restart, with the same items and id.
+      What the tuning decides is served at ``/metrics``, see
+      ``handle_requests``.
+      
+      Items that were traced through the consumer, see ``trace.py``, are
+      taken out of their envelopes and, once they've been posted, their
+      stage latencies are logged every ``trace_log_interval`` seconds.
       
       You can run multiple processor instances, as long as you pass them
-      different ``ready_list_id``s via ``--ready-list-id=...``.
+      different ``ready_list_id``s via ``--ready-list-id=...``, which
+      names their slots.
       
       .. _`blocking pop command`: http://code.google.com/p/redis/wiki/BlpopCommand
     """
     
     def __init__(
             self, ready_list_id, num_items, url, headers={}, username=None, password=None,
-            item_parser=None, min_sleep=2, max_sleep=3600
+            item_parser=None, min_sleep=2, max_sleep=3600, pool_size=4,
+            idle_timeout=30, concurrency=1, format=FORM, compression=None,
+            parse_workers=0, parse_chunksize=100, trace_log_interval=60,
+            backend=None, max_items=0, max_bytes=0, max_linger=0,
+            target_latency=0
         ):
-        self.ready_key = '%s.%s' % (DATA_KEY, ready_list_id)
+        self.ready_list_id = ready_list_id
+        self.backend = backend or make_backend(make_redis())
+        self.concurrency = concurrency
         self.num_items = num_items
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_linger = max_linger
+        self.sizer = BatchSizer(
+            num_items,
+            max_size=max_items or 100 * num_items,
+            target_latency=target_latency
+        )
         self.url = url
+        self.format = format
+        self.compression = compression
+        headers = dict(headers)
         if username and password:
             headers['Authorization'] = generate_auth_header(username, password)
+        headers.update(content_headers(format, compression))
         self.headers = headers
+        self.pool = ConnectionPool(
+            size=max(pool_size, concurrency),
+            idle_timeout=idle_timeout
+        )
         self.item_parser = item_parser
-        self.delay = min_sleep
+        self.parsing_pool = None
+        if item_parser and parse_workers:
+            # only pay for multiprocessing when it's used
+            from parallel import ParsingPool
+            self.parsing_pool = ParsingPool(
+                item_parser,
+                num_workers=parse_workers,
+                chunksize=parse_chunksize
+            )
+        # with a parsing pool, the next batches are claimed into the
+        # second ``concurrency`` slots, see ``deliver_forever``
+        self.num_slots = concurrency
+        if self.parsing_pool is not None:
+            self.num_slots *= 2
+        self.slots = self.backend.slots(ready_list_id, self.num_slots)
         self.min_sleep = min_sleep
         self.max_sleep = max_sleep
+        self.trace_log_interval = trace_log_interval
+        self.trace_stats = TraceStats()
+        # for ``render_metrics``
+        self.num_batches = 0
+        self.num_lingered = 0
+        self.num_posts = {'ok': 0, 'failed': 0}
+        self.num_items_posted = 0
+        self.num_parse_errors = 0
+        self.post_latency = Histogram(TRACE_BUCKETS)
         
     
     
-    def _incr_delay(self):
-        """Increments the delay exponentially until it
+    def _incr_delay(self, delay):
+        """Increments the ``delay`` exponentially until it
           reaches ``self.max_sleep``.
         """
         
-        if self.delay < self.max_sleep:
-            self.delay += self.delay
-            if self.delay > self.max_sleep:
-                self.delay = self.max_sleep
-            
+        return min(delay + delay, self.max_sleep)
         
     
-    def _reset_delay(self):
-        """Resets the delay to ``self.min_sleep``.
+    
+    def _post(self, items, batch_id=None):
+        """Post the items to ``self.url`` over a pooled, keep-alive
+          connection.  Returns whether the post succeeded.
         """
         
-        if self.delay > self.min_sleep:
-            self.delay = self.min_sleep
-            
-        
-    
-    
-    def _post(self, items):
-        data = unicode_urlencode({'items': items})
-        request = urllib2.Request(
-            self.url, 
-            data=data,
-            headers=self.headers
-        )
-        status = urllib2.urlopen(request).getcode()
+        items = list(items)
+        data = lambda: encode(items, self.format, self.compression)
+        headers = self.headers
+        if batch_id is not None:
+            headers = dict(headers)
+            headers['X-Batch-Id'] = batch_id
+        try:
+            status, body = self.pool.request(
+                'POST',
+                self.url,
+                body=data,
+                headers=headers
+            )
+        except (httplib.HTTPException, socket.error), err:
+            logging.warning(err, exc_info=True)
+            return False
         logging.debug(status)
         return 200 <= status < 300
         
     
     def _parse(self, items):
         """If we've been provided with an ``item_parser`` function, use
-          it to parse the item.
+          it to parse the items, in the parsing pool if there is one.
+          Returns the results in order, with ``None`` for the items it
+          failed on.
         """
         
         if not self.item_parser:
-            for item in items:
-                yield item
-        else:
-            for item in items:
-                parsed_item = self.item_parser(item)
-                if parsed_item:
-                    yield parsed_item
-                
-            
+            return items
+        parsed_items = None
+        if self.parsing_pool:
+            from parallel import WorkerError
+            try:
+                parsed_items = self.parsing_pool.map(items)
+            except WorkerError, err:
+                logging.warning('Parsing pool failed, parsing the batch here')
+                logging.warning(err, exc_info=True)
+        if parsed_items is None:
+            parsed_items, num_errors = parse_each(self.item_parser, items)
+            self.num_parse_errors += num_errors
+        return parsed_items
         
     
     
-    def loop_forever(self):
-        logging.info('starting to loop forever')
-        READY_KEY = self.ready_key
-        NUM_ITEMS = self.num_items
+    
+    
+    def _read_batch(self, slot, resume_only=False):
+        """The batch in flight in ``slot``, or, unless ``resume_only``,
+          the next one it claims.
+        """
+        
+        sizer = self.sizer
         while True:
-            logging.debug('.')
-            should_post = True
-            # if there's nothing in READY_KEY
-            if not r.llen(READY_KEY):
-                # block waiting for notifications
-                logging.debug('blocking waiting for %s' % NOTIFICATION_KEY)
-                r.blpop([NOTIFICATION_KEY])
-                # on notification, if there are num_items in the data list
-                n = r.llen(DATA_KEY)
-                logging.debug(n)
-                if n < NUM_ITEMS:
-                    should_post = False
+            batch = self.backend.read_pending(slot, sizer.max_size)
+            if batch is not None or resume_only:
+                return batch
+            # block waiting for a new batch
+            num_items = sizer.size
+            batch = self.backend.claim(slot, num_items, self.max_linger)
+            if batch is not None:
+                self.num_batches += 1
+                if len(batch.items) < num_items:
+                    self.num_lingered += 1
+                return batch
+        
+    
+    def _prepare(self, slot, resume_only=False):
+        """Read the next batch for ``slot``, see ``_read_batch``, and
+          parse it.  Returns ``(batch, read_at, items, parsed_items,
+          traces)``, or ``None`` if ``resume_only`` and there wasn't one.
+        """
+        
+        batch = self._read_batch(slot, resume_only)
+        if batch is None:
+            return None
+        read_at = time.time()
+        items, traces = open_envelopes(batch.items)
+        logging.debug(items)
+        return batch, read_at, items, self._parse(items), traces
+        
+    
+    def _deliver(self, batch, read_at, items, parsed_items, traces):
+        """Post the batch, in parts if need be, retrying with a backoff
+          until it's been posted, then acknowledge it.
+        """
+        
+        sizer = self.sizer
+        delay = self.min_sleep
+        while True:
+            # carry on from the part in flight
+            success = True
+            offset = batch.part and batch.part[0] or 0
+            while offset < len(items):
+                if batch.part is not None and batch.part[0] == offset:
+                    # it may have been posted already, so post the same
+                    # items, with the same id
+                    part_id, part = part_at(batch.id, items, *batch.part)
                 else:
-                    # move them into READY_KEY, neatly clearing DATA_KEY
-                    # in the same fell swoop
-                    r.rename(DATA_KEY, READY_KEY)
-            if should_post:
-                # read the items from READY_KEY
-                items = r.lrange(READY_KEY, 0, -1)
-                logging.debug(items)
-                # try to post them off
-                success = self._post(self._parse(items))
-                logging.debug(success)
-                if success:
-                    self._reset_delay()
-                    r.delete(READY_KEY)
-                else: 
-                    # deliberately leave the items in READY_KEY
-                    self._incr_delay()
-                    sleep(self.delay)
-                
-            
+                    max_items = self.max_items
+                    if sizer.target_latency:
+                        max_items = sizer.size
+                    part_id, part = next_part(
+                        batch.id,
+                        items,
+                        offset,
+                        max_items,
+                        self.max_bytes
+                    )
+                    self.backend.save_part(batch, offset, offset + len(part))
+                part_items = parsed_items[offset:offset + len(part)]
+                if self.item_parser:
+                    part_items = [item for item in part_items if item]
+                started = time.time()
+                success = self._post(part_items, part_id)
+                elapsed = time.time() - started
+                sizer.observe(len(part), elapsed, success)
+                self.post_latency.observe(elapsed)
+                if not success:
+                    self.num_posts['failed'] += 1
+                    break
+                self.num_posts['ok'] += 1
+                self.num_items_posted += len(part)
+                offset += len(part)
+            logging.debug(success)
+            if success:
+                break
+            # deliberately leave the batch in its slot
+            sleep(delay)
+            delay = self._incr_delay(delay)
+        self.backend.ack(batch)
+        posted_at = time.time()
+        for stamps in traces:
+            self.trace_stats.record(
+                stamps + [('lrange', read_at), ('post', posted_at)]
+            )
+        
+    
+    def deliver_forever(self, slot, resume_only=False, ahead=None):
+        """Keep posting batches through ``slot``.  If ``resume_only``,
+          stop once the batch already in it has been posted.
+          
+          Given an ``ahead`` slot, the next batch is claimed into, and
+          parsed in, that one while this one's being posted, and then the
+          two swap places.
+        """
         
+        prepared = self._prepare(slot, resume_only)
+        while prepared is not None:
+            if ahead is None:
+                self._deliver(*prepared)
+                prepared = self._prepare(slot, resume_only)
+                continue
+            next_batch = gevent.spawn(self._prepare, ahead)
+            try:
+                self._deliver(*prepared)
+                prepared = next_batch.get()
+            finally:
+                next_batch.kill()
+            slot, ahead = ahead, slot
+        
+    
+    def parse_errors(self):
+        """How many items the item parser has failed on, here or in the
+          parsing pool.
+        """
+        
+        num_errors = self.num_parse_errors
+        if self.parsing_pool is not None:
+            num_errors += self.parsing_pool.num_errors
+        return num_errors
+        
+    
+    def render_metrics(self):
+        """How the batching is going, in the Prometheus text format.
+        """
+        
+        sizer = self.sizer
+        lines = []
+        for name, kind, help, samples in (
+                ('processor_batches_total', 'counter', 'Batches claimed.',
+                    [({}, self.num_batches)]),
+                ('processor_batches_lingered_total', 'counter',
+                    'Batches claimed short, once they had lingered.',
+                    [({}, self.num_lingered)]),
+                ('processor_posts_total', 'counter', 'Posts to the webhook.',
+                    [({'result': k}, v) for k, v in sorted(self.num_posts.iteritems())]),
+                ('processor_items_posted_total', 'counter',
+                    'Items posted to the webhook.',
+                    [({}, self.num_items_posted)]),
+                ('processor_parse_errors_total', 'counter',
+                    'Items skipped because the item parser failed on them.',
+                    [({}, self.parse_errors())]),
+                ('processor_batch_size', 'gauge',
+                    'How many items to wait for.',
+                    [({}, sizer.size)]),
+                ('processor_batch_size_changes_total', 'counter',
+                    'Times the batch size has been tuned, by direction.',
+                    [({'direction': 'up'}, sizer.increases),
+                     ({'direction': 'down'}, sizer.decreases)]),
+                ('processor_target_latency_seconds', 'gauge',
+                    'How long a post should take, or 0 not to tune.',
+                    [({}, sizer.target_latency)])
+            ):
+            lines.extend(render_family(name, kind, help, samples))
+        name = PREFIX + 'processor_post_latency_seconds'
+        lines.append('# HELP %s How long each post took.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        lines.extend(self.post_latency.render(name))
+        return '\n'.join(lines) + '\n'
+        
+    
+    def handle_requests(self, env, start_response):
+        """A WSGI app serving ``render_metrics`` at ``/metrics``.
+        """
+        
+        if env['PATH_INFO'].strip('/') != 'metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not Found\r\n']
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [self.render_metrics()]
         
     
     
+    def loop_forever(self):
+        logging.info('starting to loop forever, %d batches at a time' % self.concurrency)
+        greenlets = []
+        orphans = self.backend.orphaned_slots(self.ready_list_id, self.num_slots)
+        for slot in orphans:
+            logging.info('resuming %s' % slot)
+            greenlets.append(gevent.spawn(self.deliver_forever, slot, True))
+        concurrency = self.concurrency
+        for i, slot in enumerate(self.slots[:concurrency]):
+            ahead = None
+            if self.parsing_pool is not None:
+                ahead = self.slots[concurrency + i]
+            greenlets.append(gevent.spawn(self.deliver_forever, slot, ahead=ahead))
+        if self.trace_log_interval:
+            greenlets.append(
+                gevent.spawn(self.trace_stats.log_forever, self.trace_log_interval)
+            )
+        try:
+            gevent.joinall(greenlets, raise_error=True)
+        finally:
+            gevent.killall(greenlets)
+        
+    
+
+
 
 
 def parse_options():
     from optparse import OptionParser
+    from parse import DEFAULT_PROJECTION
     parser = OptionParser()
     parser.add_option(
         '--logging',
@@ -166,6 +429,136 @@ def parse_options():
         type='int',
         default=10
     )
+    parser.add_option(
+        '--max-items',
+        dest='max_items',
+        action='store',
+        type='int',
+        help='the most items to post at once, and to tune the batch size up to, or 0 for no limit',
+        default=0
+    )
+    parser.add_option(
+        '--max-bytes',
+        dest='max_bytes',
+        action='store',
+        type='int',
+        help='the most bytes of items to post at once, or 0 for no limit',
+        default=0
+    )
+    parser.add_option(
+        '--max-linger',
+        dest='max_linger',
+        action='store',
+        type='float',
+        help='post fewer than the batch size once they\'ve waited this many seconds, or 0 to wait for a full batch',
+        default=0
+    )
+    parser.add_option(
+        '--target-latency',
+        dest='target_latency',
+        action='store',
+        type='float',
+        help='tune how many items to wait for, and to post at once, so posts take this many seconds, or 0 not to',
+        default=0
+    )
+    parser.add_option(
+        '--metrics-port',
+        dest='metrics_port',
+        action='store',
+        type='int',
+        help='the local port to serve /metrics on, or 0 not to',
+        default=0
+    )
+    parser.add_option(
+        '--backend',
+        dest='backend',
+        action='store',
+        type='choice',
+        choices=BACKENDS,
+        help='read the data from a redis %s' % ' or '.join(BACKENDS),
+        default='list'
+    )
+    parser.add_option(
+        '--redis-host',
+        dest='redis_host',
+        action='store',
+        type='string',
+        help='the host of the redis the data is queued in',
+        default='localhost'
+    )
+    parser.add_option(
+        '--redis-port',
+        dest='redis_port',
+        action='store',
+        type='int',
+        default=6379
+    )
+    parser.add_option(
+        '--redis-db',
+        dest='redis_db',
+        action='store',
+        type='int',
+        default=0
+    )
+    parser.add_option(
+        '--concurrency',
+        dest='concurrency',
+        action='store',
+        type='int',
+        help='how many batches to keep in flight at once',
+        default=1
+    )
+    parser.add_option(
+        '--fields',
+        dest='fields',
+        action='store',
+        type='string',
+        help='comma separated, dotted, paths of the status fields to post, '
+            'defaults to %default',
+        default=DEFAULT_PROJECTION
+    )
+    parser.add_option(
+        '--parse-workers',
+        dest='parse_workers',
+        action='store',
+        type='int',
+        help='parse items in this many worker processes, rather than inline, overlapping with posting the batch before',
+        default=0
+    )
+    parser.add_option(
+        '--parse-chunksize',
+        dest='parse_chunksize',
+        action='store',
+        type='int',
+        help='how many items to hand a parse worker at a time',
+        default=100
+    )
+    parser.add_option(
+        '--format',
+        dest='format',
+        action='store',
+        type='choice',
+        choices=FORMATS,
+        help='the wire format to post batches in: %s' % ', '.join(FORMATS),
+        default=FORM
+    )
+    parser.add_option(
+        '--compression',
+        dest='compression',
+        action='store',
+        type='choice',
+        choices=COMPRESSIONS,
+        help='compress the batches with %s' % ' or '.join(COMPRESSIONS),
+        default=None
+    )
+    parser.add_option(
+        '--trace-log-interval',
+        dest='trace_log_interval',
+        action='store',
+        type='float',
+        help='log the latencies of traced messages every this many seconds',
+        default=60
+    )
     parser.add_option(
         '--url',
         dest='url',
@@ -173,6 +566,22 @@ def parse_options():
         type='string',
         default='https://closeapp.appspot.com/hooks/handle_status'
     )
+    parser.add_option(
+        '--pool-size',
+        dest='pool_size',
+        action='store',
+        type='int',
+        help='the most idle keep-alive connections to keep open per host',
+        default=4
+    )
+    parser.add_option(
+        '--idle-timeout',
+        dest='idle_timeout',
+        action='store',
+        type='float',
+        help='close keep-alive connections that have been idle this many seconds',
+        default=30
+    )
     parser.add_option(
         '--username',
         dest='username',
@@ -188,11 +597,12 @@ def parse_options():
         default=''
     )
     return parser.parse_args()[0]
-
+    
 def main():
-    from parse import parse_item
+    from parse import make_item_parser
     
     options = parse_options()
+    monkey_patch()
     logging.basicConfig(
         level=getattr(
             logging, 
@@ -206,18 +616,42 @@ def main():
         options.url, 
         username=options.username, 
         password=options.password,
-        item_parser=parse_item
+        item_parser=make_item_parser(options.fields),
+        pool_size=options.pool_size,
+        idle_timeout=options.idle_timeout,
+        concurrency=options.concurrency,
+        format=options.format,
+        compression=options.compression,
+        parse_workers=options.parse_workers,
+        parse_chunksize=options.parse_chunksize,
+        trace_log_interval=options.trace_log_interval,
+        max_items=options.max_items,
+        max_bytes=options.max_bytes,
+        max_linger=options.max_linger,
+        target_latency=options.target_latency,
+        backend=make_backend(
+            make_redis(options.redis_host, options.redis_port, options.redis_db),
+            options.backend
+        )
     )
     
+    if options.metrics_port:
+        from gevent.pywsgi import WSGIServer
+        server = WSGIServer(
+            ('', options.metrics_port),
+            processor.handle_requests
+        )
+        server.start()
+        
     try:
         processor.loop_forever()
     except KeyboardInterrupt:
         pass
-    
+        
     
 
 
 if __name__ == '__main__':
     main()
-
-
+    
+    
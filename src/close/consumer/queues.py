@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A bounded notification queue with a selectable overload policy.
+"""
+
+from gevent import event
+
+import cPickle as pickle
+import collections
+import time
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+SPILL = 'spill'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, SPILL)
+
+class NotificationQueue(object):
+    """Queue of ``{event_name: data}`` notifications that holds at most
+      ``maxsize`` data items in memory.  When it's full, the ``policy``
+      decides what happens to the next data item:
+      
+      #. ``block``: the caller waits for room, so a consumer stops
+         reading and the stream host sees TCP backpressure
+      #. ``drop-oldest``: the oldest data item is thrown away
+      #. ``drop-newest``: the new data item is thrown away
+      #. ``spill``: the item is written to a ``spill.SpillQueue``
+         and read back, in order, as room becomes available, 
+         including after a restart
+      
+      Control notifications, e.g.: ``connect`` and ``exit``, are never
+      dropped or blocked and are handed out ahead of the data.
+      
+      Keeps count of the items ``dropped`` and ``spilled`` and of the
+      seconds spent ``blocked``.
+    """
+    
+    def __init__(self, maxsize=10000, policy=BLOCK, spill=None):
+        if policy not in POLICIES:
+            raise ValueError(policy)
+        if policy == SPILL and spill is None:
+            raise ValueError('The spill policy needs a spill queue')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spill = spill
+        self.dropped = 0
+        self.spilled = 0
+        self.blocked = 0.0
+        self._control = collections.deque()
+        self._items = collections.deque()
+        self._not_empty = event.Event()
+        self._not_full = event.Event()
+        # pick up anything left spilled by a previous run
+        self._refill()
+        
+    
+    def __len__(self):
+        n = len(self._control) + len(self._items)
+        if self.spill is not None:
+            n += len(self.spill)
+        return n
+        
+    
+    def full(self):
+        return len(self._items) >= self.maxsize
+        
+    
+    
+    def put(self, item, droppable=True):
+        """Add ``item``, applying the overload policy if it's a
+          ``droppable`` data item and the queue is full.
+        """
+        
+        if not droppable:
+            self._control.append(item)
+        elif self.policy == SPILL and (self.spill or self.full()):
+            self.spill.put(pickle.dumps(item, 2))
+            self.spilled += 1
+        elif not self.full():
+            self._items.append(item)
+        elif self.policy == BLOCK:
+            started = time.time()
+            while self.full():
+                self._not_full.clear()
+                self._not_full.wait()
+            self.blocked += time.time() - started
+            self._items.append(item)
+        elif self.policy == DROP_OLDEST:
+            self._items.popleft()
+            self._items.append(item)
+            self.dropped += 1
+        else:
+            self.dropped += 1
+        self._not_empty.set()
+        
+    
+    def get(self):
+        """Remove and return the next item, waiting for one if need be.
+        """
+        
+        while not self._control and not self._items:
+            self._not_empty.clear()
+            self._not_empty.wait()
+        if self._control:
+            return self._control.popleft()
+        item = self._items.popleft()
+        if self.spill:
+            self._refill()
+        else:
+            self._not_full.set()
+        return item
+        
+    
+    def _refill(self):
+        """Move spilled items back into memory, while there's room.
+        """
+        
+        if not self.spill:
+            return
+        while self.spill and not self.full():
+            self._items.append(pickle.loads(self.spill.get()))
+        self.spill.commit()
+        self._not_empty.set()
+        
+    
+
+
+
@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A local stand-in for the Streaming API that replays a recorded stream.
+  
+  Record a capture of the raw, chunk transfer encoded, stream body with
+  e.g.: ``curl --raw -d track=... 'https://stream.twitter.com/1/statuses/
+  filter.json?delimited=length' > capture``, then serve it with::
+      
+      python replay.py --capture=capture --rate=2000 --secure
+      
+  and point the consumer at it with::
+      
+      close-consume --host=localhost --stream-port=8383 --path=/
+      
+  If you don't provide a capture, a synthetic one is generated.
+"""
+
+import gevent
+
+from gevent import sleep, socket, ssl
+
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+    
+from base import BufferedChunkReadingMixin
+from framing import StreamParser
+from utils import monkey_patch
+
+# stamped messages start with the time they were sent
+STAMP_PREFIX = '{"replay_ts":'
+
+def read_stamp(data):
+    """Get the time a stamped message was sent, or ``None``.
+    """
+    
+    if data.startswith(STAMP_PREFIX):
+        return float(data[len(STAMP_PREFIX):data.index(',')])
+        
+    
+
+
+def generate_status(i):
+    """Generate a plausible looking, roughly 2KB, status update.
+    """
+    
+    user_id = random.randint(1, 10 ** 9)
+    return json.dumps({
+            'created_at': 'Sat Jun 19 12:00:00 +0000 2010',
+            'id': 10 ** 10 + i,
+            'text': u'status %s %s' % (i, u'☃ lorem ipsum ' * 8),
+            'source': '<a href="http://example.com" rel="nofollow">web</a>',
+            'truncated': False,
+            'in_reply_to_status_id': None,
+            'in_reply_to_user_id': None,
+            'in_reply_to_screen_name': None,
+            'favorited': False,
+            'geo': None,
+            'coordinates': None,
+            'place': None,
+            'contributors': None,
+            'retweeted_status': None,
+            'user': {
+                'id': user_id,
+                'screen_name': 'user%s' % user_id,
+                'name': 'User %s' % user_id,
+                'description': 'x' * 160,
+                'profile_image_url': 'http://example.com/%s.png' % user_id,
+                'url': None,
+                'followers_count': 100,
+                'friends_count': 100,
+                'statuses_count': 1000,
+                'created_at': 'Sat Jun 19 12:00:00 +0000 2010',
+                'lang': 'en',
+                'location': 'x' * 30,
+                'time_zone': 'London',
+                'utc_offset': 0,
+                'protected': False,
+                'verified': False
+            }
+        }
+    )
+    
+    
+
+def generate_stream(num_messages, keep_alive_every=100, max_chunk_size=None):
+    """Generate a ``delimited=length`` stream body, chunk transfer
+      encoded the way the Streaming API sends it, i.e.: one chunk
+      per message with the occasional blank keep alive line.
+      
+      If ``max_chunk_size`` is provided, messages are split across
+      chunks of at most that many bytes.
+    """
+    
+    chunks = []
+    for i in xrange(num_messages):
+        if keep_alive_every and not i % keep_alive_every:
+            chunks.append('2\r\n\r\n\r\n')
+        data = generate_status(i)
+        message = '%d\r\n%s' % (len(data), data)
+        size = max_chunk_size or len(message)
+        for j in xrange(0, len(message), size):
+            piece = message[j:j + size]
+            chunks.append('%x\r\n%s\r\n' % (len(piece), piece))
+    return ''.join(chunks)
+    
+    
+
+def read_capture(path):
+    """Parse the messages out of a recorded stream body.
+    """
+    
+    parser = StreamParser(delimited='length')
+    messages = []
+    f = open(path, 'rb')
+    try:
+        for data in iter(lambda: f.read(65536), ''):
+            messages.extend(parser.feed(data))
+    finally:
+        f.close()
+    return messages
+    
+    
+
+def generate_certificate(directory=None):
+    """Generate a self-signed certificate, using ``openssl``, and return
+      the paths to the cert and key files.
+    """
+    
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='close.replay.')
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-days', '1', '-subj', '/CN=localhost',
+            '-keyout', keyfile, '-out', certfile
+        ],
+        stdout=open(os.devnull, 'w'),
+        stderr=subprocess.STDOUT
+    )
+    return certfile, keyfile
+    
+    
+
+
+def serve_forever(handle, port, host=''):
+    """Accept connections on ``port``, handling each one in a new greenlet.
+    """
+    
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+    while True:
+        sock, address = listener.accept()
+        # don't let Nagle's algorithm hold small responses back behind,
+        # e.g.: unacked TLS session tickets
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        gevent.spawn(handle, sock, address)
+        
+    
+
+
+class ReplayServer(object):
+    """Serves ``messages`` to each client that connects, chunk transfer
+      encoded and ``delimited=length``, at ``rate`` messages per second
+      (or as fast as possible if ``rate`` is ``0``).
+      
+      If ``loop``, the messages are replayed over and over, otherwise
+      the stream is ended after one pass.  If ``stamp``, each message is
+      prefixed with the time it was sent, see ``read_stamp``.  If a
+      ``certfile`` and ``keyfile`` are provided, serves over TLS.
+      
+      A ``latency`` of more than ``0`` emulates a network with that round
+      trip time: the server waits one round trip for the TCP handshake,
+      two for the TLS handshake and one before responding to the request.
+    """
+    
+    # how often to wake up and send the messages that are due
+    tick = 0.01
+    
+    def __init__(
+            self, messages, rate=0, loop=True, stamp=False,
+            certfile=None, keyfile=None, latency=0
+        ):
+        self.messages = messages
+        self.rate = rate
+        self.loop = loop
+        self.stamp = stamp
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.latency = latency
+        self.num_connections = 0
+        
+    
+    def _read_request(self, sock):
+        """Read and discard the request headers and body.
+        """
+        
+        data = ''
+        while '\r\n\r\n' not in data:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise gevent.GreenletExit('Connection closed by client')
+            data += chunk
+        head, body = data.split('\r\n\r\n', 1)
+        for line in head.split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+                while len(body) < length:
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        break
+                    body += chunk
+        logging.debug(head)
+        
+    
+    def _frame(self, data):
+        if self.stamp and data.startswith('{'):
+            data = '%s%.6f,%s' % (STAMP_PREFIX, time.time(), data[1:])
+        message = '%d\r\n%s' % (len(data), data)
+        return '%x\r\n%s\r\n' % (len(message), message)
+        
+    
+    def _stream(self, sock):
+        messages = self.messages
+        i = 0
+        started = time.time()
+        sent = 0
+        while True:
+            if self.rate:
+                due = int((time.time() - started) * self.rate) - sent
+                if not due:
+                    sleep(self.tick)
+                    continue
+            else:
+                due = 256
+            frames = []
+            for _ in xrange(due):
+                if i == len(messages):
+                    if not self.loop:
+                        break
+                    i = 0
+                frames.append(self._frame(messages[i]))
+                i += 1
+            if frames:
+                sock.sendall(''.join(frames))
+                sent += len(frames)
+            if len(frames) < due:
+                sock.sendall('0\r\n\r\n')
+                return
+            if not self.rate:
+                sleep(0)
+        
+    
+    def handle(self, sock, address):
+        self.num_connections += 1
+        logging.info('replaying to %s:%s' % address)
+        try:
+            if self.latency:
+                sleep(self.latency)
+            if self.certfile:
+                if self.latency:
+                    sleep(2 * self.latency)
+                sock = ssl.wrap_socket(
+                    sock,
+                    server_side=True,
+                    certfile=self.certfile,
+                    keyfile=self.keyfile
+                )
+            self._read_request(sock)
+            if self.latency:
+                sleep(self.latency)
+            sock.sendall('\r\n'.join([
+                        'HTTP/1.1 200 OK',
+                        'Content-Type: application/json',
+                        'Transfer-Encoding: chunked',
+                        '', ''
+                    ]
+                )
+            )
+            self._stream(sock)
+        except (socket.error, gevent.GreenletExit), err:
+            logging.info(err)
+        finally:
+            sock.close()
+        
+    
+    def serve_forever(self, port, host=''):
+        serve_forever(self.handle, port, host=host)
+        
+    
+
+
+
+
+class Webhook(object):
+    """A stand-in for the webhook that ``process.py`` posts batches to.
+      Reads each request, whether its body is sent with a content length
+      or chunk transfer encoded, and responds with ``200 OK``, keeping the
+      connection alive.
+    """
+    
+    def __init__(self, certfile=None, keyfile=None):
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.num_requests = 0
+        self.num_bytes = 0
+        
+    
+    def handle(self, sock, address):
+        if self.certfile:
+            sock = ssl.wrap_socket(
+                sock,
+                server_side=True,
+                certfile=self.certfile,
+                keyfile=self.keyfile
+            )
+        reader = BufferedChunkReadingMixin()
+        reader.sock = sock
+        reader._reset_buffer()
+        try:
+            while True:
+                reader._safe_readline()
+                headers = {}
+                while True:
+                    line = reader._safe_readline()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if headers.get('transfer-encoding') == 'chunked':
+                    body = reader._read_chunked(None)
+                    # toss the blank line after the last chunk
+                    reader._safe_readline()
+                else:
+                    body = reader._safe_read(int(headers.get('content-length', 0)))
+                self.num_requests += 1
+                self.num_bytes += len(body)
+                sock.sendall('HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nOK\r\n')
+        except (socket.error, gevent.GreenletExit), err:
+            logging.debug(err)
+        finally:
+            sock.close()
+        
+    
+    def serve_forever(self, port, host=''):
+        serve_forever(self.handle, port, host=host)
+        
+    
+    
+
+
+
+def parse_options():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option(
+        '--logging',
+        dest='log_level',
+        action='store',
+        type='string',
+        default='info'
+    )
+    parser.add_option(
+        '--port',
+        dest='port',
+        action='store',
+        type='int',
+        help='the local port to serve the stream on',
+        default=8383
+    )
+    parser.add_option(
+        '--capture',
+        dest='capture',
+        action='store',
+        type='string',
+        help='a recorded, chunk transfer encoded, stream body to replay',
+        default=''
+    )
+    parser.add_option(
+        '--num-messages',
+        dest='num_messages',
+        action='store',
+        type='int',
+        help='how many messages to generate, if there\'s no capture',
+        default=10000
+    )
+    parser.add_option(
+        '--rate',
+        dest='rate',
+        action='store',
+        type='int',
+        help='messages per second, or 0 for as fast as possible',
+        default=0
+    )
+    parser.add_option(
+        '--once',
+        dest='loop',
+        action='store_false',
+        help='end the stream after replaying the messages once',
+        default=True
+    )
+    parser.add_option(
+        '--stamp',
+        dest='stamp',
+        action='store_true',
+        help='prefix each message with the time it was sent',
+        default=False
+    )
+    parser.add_option(
+        '--latency',
+        dest='latency',
+        action='store',
+        type='float',
+        help='emulate a network with this round trip time, in seconds',
+        default=0
+    )
+    parser.add_option(
+        '--webhook',
+        dest='webhook',
+        action='store_true',
+        help='stand in for the webhook ``process.py`` posts to instead',
+        default=False
+    )
+    parser.add_option(
+        '--secure',
+        dest='secure',
+        action='store_true',
+        help='serve over TLS, using a self-signed cert unless provided',
+        default=False
+    )
+    parser.add_option(
+        '--certfile',
+        dest='certfile',
+        action='store',
+        type='string',
+        default=''
+    )
+    parser.add_option(
+        '--keyfile',
+        dest='keyfile',
+        action='store',
+        type='string',
+        default=''
+    )
+    return parser.parse_args()[0]
+    
+    
+def main():
+    options = parse_options()
+    monkey_patch()
+    logging.basicConfig(
+        level=getattr(
+            logging,
+            options.log_level.upper()
+        )
+    )
+    
+    certfile = options.certfile or None
+    keyfile = options.keyfile or None
+    if options.secure and not certfile:
+        certfile, keyfile = generate_certificate()
+        
+    if options.webhook:
+        logging.info('standing in for the webhook on port %s' % options.port)
+        try:
+            Webhook(certfile=certfile, keyfile=keyfile).serve_forever(options.port)
+        except KeyboardInterrupt:
+            pass
+        return
+        
+    if options.capture:
+        messages = read_capture(options.capture)
+    else:
+        parser = StreamParser(delimited='length')
+        messages = parser.feed(generate_stream(options.num_messages))
+        
+    server = ReplayServer(
+        messages,
+        rate=options.rate,
+        loop=options.loop,
+        stamp=options.stamp,
+        certfile=certfile,
+        keyfile=keyfile,
+        latency=options.latency
+    )
+    logging.info('replaying %s messages on port %s' % (
+            len(messages),
+            options.port
+        )
+    )
+    try:
+        server.serve_forever(options.port)
+    except KeyboardInterrupt:
+        pass
+        
+    
+
+
+
+if __name__ == '__main__':
+    main()
+    
+    
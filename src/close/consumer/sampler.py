@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A sampling profiler that can be switched on and off inside a running
+  process, see ``BaseWSGIApp``'s ``/profile/start`` and ``/profile/stop``.
+  
+  ``SIGPROF`` fires every ``interval`` seconds of CPU time and the stack of
+  whichever greenlet is running is counted, under the name of the
+  greenlet, e.g.: ``Consumer.run`` or ``Manager._handle_event``, so the
+  samples add up to the CPU time each kind of greenlet is using.  Time
+  spent waiting on the network doesn't use CPU, so isn't sampled.
+  
+  The stacks are reported in the collapsed format ``flamegraph.pl`` and
+  speedscope read, ala:
+      
+      curl -s localhost:8282/profile/start
+      sleep 30
+      curl -s localhost:8282/profile/stop | grep -v '^#' | flamegraph.pl > cpu.svg
+      
+  The lines starting with ``#`` sum up the CPU time by greenlet.
+"""
+
+from gevent.hub import get_hub, getcurrent
+
+import os
+import signal
+import time
+
+# don't walk runaway recursion all the way down
+MAX_DEPTH = 128
+
+def greenlet_name(greenlet):
+    """Name a greenlet after what it's running, e.g.: ``Consumer.run``.
+    """
+    
+    if greenlet is get_hub():
+        return 'hub'
+    if greenlet.parent is None:
+        return 'main'
+    run = getattr(greenlet, '_run', None) or getattr(greenlet, 'run', None)
+    args = getattr(greenlet, 'args', None)
+    if getattr(run, 'im_self', None) is None and args and \
+            getattr(args[0], 'im_self', None) is not None:
+        # a wrapper around the callable it was passed, e.g.: a gevent
+        # server's handler
+        run = args[0]
+    name = getattr(run, '__name__', None) or type(greenlet).__name__
+    owner = getattr(run, 'im_self', None)
+    if owner is not None:
+        name = '%s.%s' % (type(owner).__name__, name)
+    return name
+    
+    
+
+def _format_code(code):
+    return '%s (%s:%d)' % (
+        code.co_name,
+        os.path.basename(code.co_filename),
+        code.co_firstlineno
+    )
+    
+    
+
+
+class Profiler(object):
+    """Samples the running greenlet's stack every ``interval`` seconds of
+      CPU time, between ``start`` and ``stop``.
+    """
+    
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.running = False
+        self.samples = {}
+        self.started_at = None
+        self.stopped_at = None
+        self._previous_handler = None
+        
+    
+    def _sample(self, signum, frame):
+        codes = []
+        while frame is not None and len(codes) < MAX_DEPTH:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        key = (greenlet_name(getcurrent()), tuple(codes))
+        self.samples[key] = self.samples.get(key, 0) + 1
+        
+    
+    def start(self):
+        """Start sampling, returning ``False`` if we already were.
+        """
+        
+        if self.running:
+            return False
+        self.samples = {}
+        self.started_at = time.time()
+        self.stopped_at = None
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        # don't interrupt system calls, just sample when they return
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+        return True
+        
+    
+    def stop(self):
+        """Stop sampling, returning ``False`` if we weren't.
+        """
+        
+        if not self.running:
+            return False
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        self.stopped_at = time.time()
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        self.running = False
+        return True
+        
+    
+    
+    def cpu_by_greenlet(self):
+        """The CPU seconds sampled in each kind of greenlet, as a list of
+          ``(name, seconds)``, busiest first.
+        """
+        
+        counts = {}
+        for (name, codes), n in self.samples.iteritems():
+            counts[name] = counts.get(name, 0) + n
+        return sorted(
+            [(name, n * self.interval) for name, n in counts.iteritems()],
+            key=lambda item: -item[1]
+        )
+        
+    
+    def collapsed(self):
+        """The samples as collapsed stacks, rooted at the greenlet's name,
+          preceded by ``#`` lines summing up the CPU time by greenlet.
+        """
+        
+        elapsed = 0
+        if self.started_at is not None:
+            elapsed = (self.stopped_at or time.time()) - self.started_at
+        cpu = self.cpu_by_greenlet()
+        total = sum(seconds for name, seconds in cpu)
+        lines = ['# %.3fs cpu sampled in %.3fs' % (total, elapsed)]
+        for name, seconds in cpu:
+            lines.append('# %s: %.3fs cpu, %.1f%%' % (
+                    name,
+                    seconds,
+                    100 * seconds / (total or 1)
+                )
+            )
+        stacks = {}
+        for (name, codes), n in self.samples.iteritems():
+            stack = ';'.join(
+                [name] + [_format_code(code) for code in reversed(codes)]
+            )
+            stacks[stack] = stacks.get(stack, 0) + n
+        for stack, n in sorted(stacks.iteritems()):
+            lines.append('%s %d' % (stack, n))
+        return '\n'.join(lines) + '\n'
+        
+    
+
+
+
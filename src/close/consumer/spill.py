@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Durable, on disk, overflow for when items arrive faster than they can
+  be handled, or when the place they're going to is down.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+HEADER = struct.Struct('>I')
+
+SEGMENT_PREFIX = 'segment.'
+CURSOR = 'cursor'
+
+class SpillQueue(object):
+    """Append only FIFO queue of byte strings, stored in a ``directory`` of
+      fixed size, memory mapped, segment files.
+      
+      Each record is prefixed with its length plus one, so a zero length
+      marks the end of the data written to a segment.  The length is written
+      after the data, so a torn write just looks like the end of the data.
+      
+      ``put`` appends an item.  The segment being written to is ``msync``ed
+      every ``sync_every`` items or ``sync_interval`` seconds, or when you
+      call ``sync``.  Items are acknowledged, i.e.: will survive a crash, once
+      they've been synced.
+      
+      ``get`` reads the next item.  Reads aren't final until you ``commit``
+      them: until then you can ``rollback`` to re-read them.  The committed
+      read position is saved when syncing, so after a crash items are read
+      at least once.  Segments are deleted as soon as they've been read and
+      committed.
+    """
+    
+    def __init__(
+            self, directory, segment_size=16 * 2 ** 20, sync_every=1000,
+            sync_interval=1.0
+        ):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._unsynced = 0
+        self._synced_at = time.time()
+        self._recover()
+        
+    
+    
+    def _path(self, segment):
+        return os.path.join(self.directory, '%s%020d' % (SEGMENT_PREFIX, segment))
+        
+    
+    def _map(self, segment, size=None):
+        """Memory map ``segment``, creating it with ``size`` bytes, or
+          ``self.segment_size``, if need be.
+        """
+        
+        f = open(self._path(segment), 'a+b')
+        try:
+            if size is not None or not os.fstat(f.fileno()).st_size:
+                f.truncate(size or self.segment_size)
+            return mmap.mmap(f.fileno(), 0)
+        finally:
+            f.close()
+        
+    
+    def _read_cursor(self):
+        try:
+            f = open(os.path.join(self.directory, CURSOR), 'rb')
+        except IOError:
+            return None
+        try:
+            segment, offset = f.read().split()
+            return int(segment), int(offset)
+        finally:
+            f.close()
+        
+    
+    def _write_cursor(self):
+        path = os.path.join(self.directory, CURSOR)
+        f = open(path + '.tmp', 'wb')
+        try:
+            f.write('%d %d' % (self._committed[0], self._committed[1]))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+        
+    
+    def _scan(self, m, offset):
+        """Count the records in ``m`` from ``offset`` and return the count
+          and the offset of the end of the data.
+        """
+        
+        n = 0
+        while offset + HEADER.size <= len(m):
+            size, = HEADER.unpack_from(m, offset)
+            end = offset + HEADER.size + size - 1
+            if not size or end > len(m):
+                break
+            offset = end
+            n += 1
+        return n, offset
+        
+    
+    def _recover(self):
+        """Find the committed read position and the end of the data, and
+          count the items in between.
+        """
+        
+        segments = sorted(
+            int(name[len(SEGMENT_PREFIX):])
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX)
+        )
+        cursor = self._read_cursor()
+        if cursor is None or cursor[0] not in segments:
+            cursor = segments and (segments[0], 0) or (0, 0)
+        for segment in segments:
+            if segment < cursor[0]:
+                os.remove(self._path(segment))
+        segments = [s for s in segments if s >= cursor[0]] or [cursor[0]]
+        self._count = 0
+        for segment in segments:
+            m = self._map(segment)
+            start = segment == cursor[0] and cursor[1] or 0
+            n, end = self._scan(m, start)
+            self._count += n
+            if segment == segments[-1]:
+                self._wseg, self._wmap, self._wpos = segment, m, end
+            else:
+                m.close()
+        self._committed = cursor
+        self._uncommitted = 0
+        self._rseg = None
+        self._rmap = None
+        self.rollback()
+        
+    
+    
+    def __len__(self):
+        """The number of items that haven't been read.
+        """
+        
+        return self._count
+        
+    
+    def put(self, data):
+        need = HEADER.size + len(data)
+        if self._wpos + need > len(self._wmap):
+            self._roll(need)
+        m = self._wmap
+        pos = self._wpos
+        m[pos + HEADER.size:pos + need] = data
+        m[pos:pos + HEADER.size] = HEADER.pack(len(data) + 1)
+        self._wpos = pos + need
+        self._count += 1
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or \
+                time.time() - self._synced_at >= self.sync_interval:
+            self.sync()
+        
+    
+    def _roll(self, need):
+        """Move on to a new segment, big enough for ``need`` bytes.
+        """
+        
+        self._wmap.flush()
+        if self._wseg != self._rseg:
+            self._wmap.close()
+        self._wseg += 1
+        self._wmap = self._map(self._wseg, size=max(self.segment_size, need))
+        self._wpos = 0
+        
+    
+    def sync(self):
+        """Make everything put and committed so far durable.
+        """
+        
+        self._wmap.flush()
+        self._write_cursor()
+        self._unsynced = 0
+        self._synced_at = time.time()
+        
+    
+    
+    def _open_reader(self, segment, offset):
+        if self._rmap is not None and self._rmap is not self._wmap:
+            self._rmap.close()
+        self._rseg = segment
+        if segment == self._wseg:
+            self._rmap = self._wmap
+        else:
+            self._rmap = self._map(segment)
+        self._rpos = offset
+        
+    
+    def get(self):
+        """Return the next item, or ``None`` if there isn't one.
+        """
+        
+        if not self._count:
+            return None
+        while True:
+            m = self._rmap
+            pos = self._rpos
+            size = 0
+            if pos + HEADER.size <= len(m):
+                size, = HEADER.unpack_from(m, pos)
+            if size:
+                end = pos + HEADER.size + size - 1
+                self._rpos = end
+                self._count -= 1
+                self._uncommitted += 1
+                return m[pos + HEADER.size:end]
+            self._open_reader(self._rseg + 1, 0)
+        
+    
+    def commit(self):
+        """Mark everything read so far as done, deleting any segments
+          that have been read all the way through.
+        """
+        
+        for segment in xrange(self._committed[0], self._rseg):
+            os.remove(self._path(segment))
+        self._committed = (self._rseg, self._rpos)
+        self._uncommitted = 0
+        
+    
+    def rollback(self):
+        """Go back to the last committed read position.
+        """
+        
+        self._count += self._uncommitted
+        self._uncommitted = 0
+        self._open_reader(*self._committed)
+        
+    
+    def close(self):
+        self.sync()
+        if self._rmap is not self._wmap:
+            self._rmap.close()
+        self._wmap.close()
+        
+    
+
+
+
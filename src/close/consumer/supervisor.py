@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Run consumers in several processes, so they can use more than one core.
+  
+  The ``Supervisor`` starts ``num_workers`` processes, each running its own
+  manager, which takes its slice of the predicates, see
+  ``BaseManager.worker_slice``.  It stands in for the manager passed to a
+  ``BaseWSGIApp``, fanning ``/start``, ``/stop`` and ``/restart`` out to
+  the workers, and restarts any worker that dies.
+  
+  Each worker calls ``run_worker`` with its manager, which reports the
+  manager's ``health()`` back every ``interval`` seconds.  The supervisor
+  and each worker talk over a socket pair, that's the worker's stdin and
+  stdout, a JSON object per line.
+  
+  ``/metrics`` renders the workers' reports as metrics labelled with the
+  worker's index.
+  
+  The workers are started afresh, with ``make_command(index, count)``,
+  rather than forked, as a fork would inherit the supervisor's greenlets
+  and listening sockets.
+"""
+
+import gevent
+from gevent import event, socket
+
+import logging
+import subprocess
+import time
+
+from metrics import render_family
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+    
+def _send(sock, message):
+    sock.sendall(json.dumps(message) + '\n')
+    
+    
+
+def _read_messages(sock):
+    for line in iter(sock.makefile('rb').readline, ''):
+        yield json.loads(line)
+        
+    
+
+def run_worker(manager, interval=1):
+    """Run ``manager`` as a worker, doing what the supervisor, on the other
+      end of stdin and stdout, says and reporting back every ``interval``
+      seconds, until the supervisor goes away.
+    """
+    
+    sock = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    
+    def report():
+        while True:
+            _send(sock, {'health': manager.health()})
+            gevent.sleep(interval)
+        
+    
+    reporter = gevent.spawn(report)
+    try:
+        for message in _read_messages(sock):
+            action = message['action']
+            logging.info('worker %s: %s' % (manager.worker_slice, action))
+            if action == 'start':
+                manager.start_a_consumer()
+            elif action == 'stop':
+                manager.stop_all_consumers()
+            elif action == 'update':
+                manager.update()
+    except socket.error, err:
+        logging.debug(err)
+    finally:
+        reporter.kill()
+        manager.stop_all_consumers()
+        
+    
+
+
+
+class Worker(object):
+    """The supervisor's handle on a worker process.
+    """
+    
+    def __init__(self, index, process, sock):
+        self.index = index
+        self.process = process
+        self.sock = sock
+        self.health = {}
+        self.messages_per_second = 0.0
+        self.reported_at = None
+        
+    
+    def update(self, health):
+        now = time.time()
+        if self.reported_at is not None and now > self.reported_at:
+            messages = health['messages'] - self.health.get('messages', 0)
+            self.messages_per_second = messages / (now - self.reported_at)
+        self.health = health
+        self.reported_at = now
+        
+    
+
+
+
+
+class Supervisor(object):
+    """Starts ``num_workers`` processes, running ``make_command(index,
+      num_workers)``, and restarts them if they die.
+      
+      Quacks enough like a ``BaseManager`` to be handed to a
+      ``BaseWSGIApp``.
+    """
+    
+    # how long to wait before restarting a worker that died
+    restart_delay = 1
+    
+    def __init__(self, make_command, num_workers=2):
+        self.make_command = make_command
+        self.num_workers = num_workers
+        self.started = False
+        self.workers = {}
+        for index in range(num_workers):
+            self._spawn(index)
+        
+    
+    
+    def _spawn(self, index):
+        sock, child = socket.socketpair()
+        process = subprocess.Popen(
+            self.make_command(index, self.num_workers),
+            stdin=child.fileno(),
+            stdout=child.fileno(),
+            close_fds=True
+        )
+        child.close()
+        worker = Worker(index, process, sock)
+        self.workers[index] = worker
+        gevent.spawn(self._listen, worker)
+        logging.info('started worker %s, pid %s' % (index, process.pid))
+        if self.started:
+            self._send(worker, 'start')
+        
+    
+    def _listen(self, worker):
+        """Read the worker's reports until it goes away, then replace it.
+        """
+        
+        try:
+            for message in _read_messages(worker.sock):
+                if 'health' in message:
+                    worker.update(message['health'])
+        except (socket.error, ValueError), err:
+            logging.warning(err)
+        worker.sock.close()
+        if self.workers.get(worker.index) is not worker:
+            return
+        logging.warning('worker %s exited unexpectedly' % worker.index)
+        while worker.process.poll() is None:
+            gevent.sleep(0.1)
+        gevent.sleep(self.restart_delay)
+        if self.workers.get(worker.index) is worker:
+            self._spawn(worker.index)
+        
+    
+    def _send(self, worker, action):
+        try:
+            _send(worker.sock, {'action': action})
+        except socket.error, err:
+            # it'll be restarted and told to start, if need be
+            logging.warning('failed to tell worker %s to %s: %s' % (
+                    worker.index,
+                    action,
+                    err
+                )
+            )
+        
+    
+    
+    def start_a_consumer(self):
+        self.started = True
+        for worker in self.workers.values():
+            self._send(worker, 'start')
+        
+    
+    def update(self):
+        """Have each worker hot swap its consumers.  They report how it
+          went in their health.
+        """
+        
+        self.started = True
+        for worker in self.workers.values():
+            self._send(worker, 'update')
+        result = event.AsyncResult()
+        result.set({'status': 'sent', 'workers': len(self.workers)})
+        return result
+        
+    
+    def stop_all_consumers(self):
+        self.started = False
+        for worker in self.workers.values():
+            self._send(worker, 'stop')
+        
+    
+    def health(self):
+        """The health of each worker, as last reported, and the totals.
+        """
+        
+        workers = []
+        for index, worker in sorted(self.workers.items()):
+            health = dict(worker.health)
+            health['index'] = index
+            health['pid'] = worker.process.pid
+            health['alive'] = worker.process.poll() is None
+            health['messages_per_second'] = worker.messages_per_second
+            workers.append(health)
+        return {
+            'workers': workers,
+            'messages': sum(w.get('messages', 0) for w in workers),
+            'messages_per_second': sum(w['messages_per_second'] for w in workers)
+        }
+        
+    
+    def render_metrics(self):
+        """The workers' health, as last reported, in the Prometheus text
+          format.
+        """
+        
+        workers = self.health()['workers']
+        lines = []
+        for key, kind, help in (
+                ('alive', 'gauge', 'Whether the worker is running.'),
+                ('messages', 'counter', 'Messages passed on to handle_data.'),
+                ('messages_per_second', 'gauge', 'Messages per second.'),
+                ('consumers', 'gauge', 'Consumers running.'),
+                ('connected', 'gauge', 'Shards that have connected.'),
+                ('queued', 'gauge', 'Notifications waiting to be handled.'),
+                ('dropped', 'counter', 'Notifications dropped.'),
+                ('duplicates', 'counter', 'Duplicate messages dropped.')
+            ):
+            samples = [
+                ({'worker': w['index']}, int(w[key]) if key == 'alive' else w[key])
+                for w in workers if key in w
+            ]
+            if samples:
+                name = 'worker_%s' % key
+                if kind == 'counter':
+                    name += '_total'
+                lines.extend(render_family(name, kind, help, samples))
+        return '\n'.join(lines) + '\n'
+        
+    
+    def close(self):
+        """Stop the workers, which exit when their socket is closed.
+        """
+        
+        workers = self.workers.values()
+        self.workers = {}
+        for worker in workers:
+            worker.sock.close()
+        for worker in workers:
+            for i in range(50):
+                if worker.process.poll() is not None:
+                    break
+                gevent.sleep(0.1)
+            else:
+                worker.process.kill()
+        
+    
+
+
+
+
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Trace a sample of the messages from the socket read to the webhook
+  acknowledging them.
+  
+  A ``Tracer`` picks one in every so many of the messages a consumer
+  reads and swaps them for ``Traced`` messages, which are still strings,
+  so the rest of the pipeline doesn't notice, but pick up the time they
+  reach each stage as they go:
+      
+      recv -> notify -> handle_data -> rpush -> lrange -> post
+      
+  The ``Batcher`` writes a traced message to redis wrapped in an
+  envelope, ala:
+      
+      #trace recv=1287501234.512000,notify=...,rpush=...
+      {"text": ...}
+      
+  which the processor opens, see ``open_envelopes``, and ``parse_item``
+  strips.  The processor adds up the time spent between each stage in a
+  ``TraceStats``.  If the consumer and processor run on different
+  machines, the stages either side of redis are only as accurate as
+  their clocks.
+"""
+
+import gevent
+
+import logging
+import time
+
+from metrics import Histogram
+
+STAGES = ('recv', 'notify', 'handle_data', 'rpush', 'lrange', 'post')
+
+ENVELOPE_PREFIX = '#trace '
+
+# upper bounds, in seconds, of the stage latency buckets, which need to
+# go higher than the handler latency's to cover batching and retries
+TRACE_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300
+)
+
+class Traced(str):
+    """A message that's being traced, with the ``(stage, time)`` it
+      reached each stage so far in ``stamps``.
+    """
+    
+    def stamp(self, stage):
+        self.stamps.append((stage, time.time()))
+        
+    
+    def envelope(self):
+        """The message, wrapped up with its stamps, to write to redis.
+        """
+        
+        return '%s%s\n%s' % (
+            ENVELOPE_PREFIX,
+            ','.join('%s=%.6f' % stamp for stamp in self.stamps),
+            self
+        )
+        
+    
+
+
+def strip_envelope(item):
+    """``item`` without its trace envelope, if it has one.
+    """
+    
+    if item.startswith(ENVELOPE_PREFIX):
+        return item[item.index('\n') + 1:]
+    return item
+    
+    
+
+def open_envelopes(items):
+    """Take the trace envelopes off ``items``, returning the items and a
+      list of the stamps found in the envelopes.
+    """
+    
+    stamps = []
+    for i, item in enumerate(items):
+        if item.startswith(ENVELOPE_PREFIX):
+            header, items[i] = item[len(ENVELOPE_PREFIX):].split('\n', 1)
+            try:
+                stamps.append([
+                        (stage, float(t)) for stage, t in (
+                            pair.split('=') for pair in header.split(',')
+                        )
+                    ]
+                )
+            except ValueError:
+                logging.warning('invalid trace envelope: %r' % header)
+    return items, stamps
+    
+    
+
+
+
+class Tracer(object):
+    """Picks one in every ``1 / sample_rate`` messages to trace.
+      
+      Sampling works on the list of messages from each read, rather than
+      message by message, so the messages that aren't traced cost next to
+      nothing.
+    """
+    
+    def __init__(self, sample_rate=0.001):
+        self.interval = max(1, int(round(1 / sample_rate)))
+        self.num_traced = 0
+        self._countdown = self.interval
+        
+    
+    def trace(self, messages, received_at):
+        """Swap the sampled ``messages`` for ``Traced`` ones, in place,
+          stamped as received at ``received_at``.
+        """
+        
+        n = len(messages)
+        self._countdown -= n
+        while self._countdown <= 0:
+            i = n - 1 + self._countdown
+            message = Traced(messages[i])
+            message.stamps = [('recv', received_at)]
+            messages[i] = message
+            self.num_traced += 1
+            self._countdown += self.interval
+        
+    
+
+
+
+class TraceStats(object):
+    """Latency histograms of the time between each stage, and from end to
+      end, for the traced messages.
+    """
+    
+    def __init__(self):
+        self.num_traced = 0
+        self._reset()
+        
+    
+    def _reset(self):
+        self.histograms = {}
+        for start, end in zip(STAGES, STAGES[1:]) + [('recv', 'post')]:
+            self.histograms['%s>%s' % (start, end)] = Histogram(TRACE_BUCKETS)
+        
+    
+    def record(self, stamps):
+        """Add a traced message's ``stamps`` to the histograms.
+        """
+        
+        times = dict(stamps)
+        previous = None
+        for stage in STAGES:
+            if stage not in times:
+                continue
+            if previous is not None:
+                key = '%s>%s' % (previous, stage)
+                if key in self.histograms:
+                    self.histograms[key].observe(times[stage] - times[previous])
+            previous = stage
+        if 'recv' in times and 'post' in times:
+            self.histograms['recv>post'].observe(times['post'] - times['recv'])
+        self.num_traced += 1
+        
+    
+    def summary(self):
+        """A one line summary of the 50th and 99th percentiles for each
+          pair of stages, in milliseconds, e.g.: ``recv>notify=0.1/0.5``.
+        """
+        
+        values = []
+        for start, end in zip(STAGES, STAGES[1:]) + [('recv', 'post')]:
+            key = '%s>%s' % (start, end)
+            histogram = self.histograms[key]
+            if not sum(histogram.counts):
+                continue
+            values.append('%s=%g/%g' % (
+                    key,
+                    1000 * histogram.quantile(0.5),
+                    1000 * histogram.quantile(0.99)
+                )
+            )
+        return ' '.join(values)
+        
+    
+    def log_forever(self, interval=60):
+        """Log a summary of the messages traced in each ``interval``.
+        """
+        
+        while True:
+            gevent.sleep(interval)
+            num_traced = self.num_traced
+            if num_traced:
+                logging.info('traced %d messages, p50/p99 ms: %s' % (
+                        num_traced,
+                        self.summary()
+                    )
+                )
+            self.num_traced = 0
+            self._reset()
+        
+    
+
+
+
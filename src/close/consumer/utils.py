@@ -6,10 +6,34 @@
 
 import base64
 import hashlib
+import logging
 import random
 import time
 import urllib
 
+def monkey_patch():
+    """Make the standard library cooperative, with ``gevent.monkey``.
+      The entry points call this once they've parsed their options, so
+      importing a module never patches anything.
+      
+      By then ``socket``, ``ssl`` and ``threading`` have been imported,
+      e.g.: by ``redis`` and ``logging``, which is safe because:
+      
+      #. our own modules use ``gevent.socket`` and ``gevent.ssl``
+         directly, rather than relying on the patching
+      #. ``redis``, ``httplib`` and ``pool`` look up ``socket.socket``,
+         ``socket.create_connection`` and ``ssl.SSLContext`` when they
+         connect, not at import, so they get the patched versions
+      #. nothing starts a thread or spawns a greenlet at import and
+         ``patch_all`` swaps the locks ``logging`` has already made for
+         cooperative ones
+    """
+    
+    from gevent import monkey
+    monkey.patch_all()
+    
+    
+
 def unicode_urlencode(params):
     if isinstance(params, dict):
         params = params.items()
@@ -36,5 +60,25 @@ def generate_hash(algorithm='sha1', s=None):
 def generate_auth_header(username, password):
     auth = base64.b64encode(u'%s:%s' % (username, password))
     return 'Basic %s' % auth
+    
+
+
+def parse_each(item_parser, items):
+    """Parse each of ``items`` with ``item_parser``, logging and skipping,
+      i.e.: returning ``None`` for, the ones it fails on.  Returns the results
+      and how many failed.
+    """
+    
+    results = []
+    num_errors = 0
+    for item in items:
+        try:
+            results.append(item_parser(item))
+        except Exception, err:
+            logging.warning('Failed to parse item, skipping it')
+            logging.warning(err, exc_info=True)
+            results.append(None)
+            num_errors += 1
+    return results, num_errors
 
 
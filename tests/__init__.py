@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests, run with the Python and gevent the package runs on, ala:
+      
+      python -m unittest discover -s tests -t .
+      
+  The modules import each other by name, so put them on the path.
+"""
+
+import os
+import sys
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), '..', 'src', 'close', 'consumer')
+)
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the ``backends`` against a redis-server on localhost, or skip them
+  if there isn't one.  They use keys under ``close.consumer.test.``, in
+  db ``15``, and delete them when they're done.
+"""
+
+import time
+import unittest
+
+import gevent
+from redis.exceptions import ConnectionError, ResponseError
+
+from backends import ListBackend, StreamBackend, make_redis
+from process import PostingParsingQueueProcessor
+
+PREFIX = 'close.consumer.test.'
+
+redis = make_redis(db=15)
+
+def setUpModule():
+    try:
+        redis.ping()
+    except ConnectionError:
+        raise unittest.SkipTest('no redis-server on localhost:6379')
+        
+    
+
+
+class BackendTestCase(unittest.TestCase):
+    
+    def tearDown(self):
+        keys = redis.keys('%s*' % PREFIX)
+        if keys:
+            redis.delete(*keys)
+        
+    
+    def items(self, n, start=0):
+        return ['item %d' % i for i in xrange(start, start + n)]
+        
+    
+    def claim(self, backend, slot, num_items, max_linger=0, timeout=5):
+        """Claim until there's a batch, as ``deliver_forever`` does.
+        """
+        
+        with gevent.Timeout(timeout):
+            while True:
+                batch = backend.claim(slot, num_items, max_linger)
+                if batch is not None:
+                    return batch
+        
+    
+    def assertPartKept(self, backend, slot):
+        """The part saved for a batch is read back with it, and forgotten
+          once the batch is acknowledged.
+        """
+        
+        backend.write(self.items(5))
+        batch = self.claim(backend, slot, 5)
+        self.assertEqual(batch.part, None)
+        backend.save_part(batch, 2, 4)
+        self.assertEqual(batch.part, (2, 4))
+        self.assertEqual(backend.read_pending(slot, 5).part, (2, 4))
+        backend.ack(batch)
+        backend.write(self.items(5))
+        self.assertEqual(self.claim(backend, slot, 5).part, None)
+        
+    
+
+
+
+class TestListBackend(BackendTestCase):
+    
+    def setUp(self):
+        self.backend = ListBackend(redis, PREFIX + 'data', PREFIX + 'notify')
+        self.slot = self.backend.slots('test', 1)[0]
+        
+    
+    def test_claim_waits_for_num_items(self):
+        self.backend.write(self.items(3))
+        self.assertEqual(self.backend.claim(self.slot, 5), None)
+        self.backend.write(self.items(2, start=3))
+        batch = self.backend.claim(self.slot, 5)
+        self.assertEqual(batch.items, self.items(5))
+        self.assertEqual(redis.llen(PREFIX + 'data'), 0)
+        
+    
+    def test_pending_until_acked(self):
+        self.backend.write(self.items(5))
+        batch = self.claim(self.backend, self.slot, 5)
+        pending = self.backend.read_pending(self.slot, 5)
+        self.assertEqual(pending.id, batch.id)
+        self.assertEqual(pending.items, batch.items)
+        self.backend.ack(batch)
+        self.assertEqual(self.backend.read_pending(self.slot, 5), None)
+        
+    
+    def test_linger(self):
+        self.backend.write(self.items(2))
+        started = time.time()
+        batch = self.claim(self.backend, self.slot, 10, max_linger=0.05)
+        self.assertTrue(time.time() - started >= 0.05)
+        self.assertEqual(batch.items, self.items(2))
+        
+    
+    def test_linger_clears_notifications(self):
+        """Lingering doesn't pop the notifications, so claiming the items
+          clears them.
+        """
+        
+        for i in xrange(5):
+            self.backend.write(self.items(1, start=i))
+        batch = self.claim(self.backend, self.slot, 10, max_linger=0.05)
+        self.assertEqual(batch.items, self.items(5))
+        self.assertEqual(redis.llen(PREFIX + 'notify'), 0)
+        
+    
+    def test_linger_per_slot(self):
+        """Each slot lingers by its own clock.
+        """
+        
+        slots = self.backend.slots('test', 2)
+        # a notification each, so neither slot blocks
+        self.backend.write(self.items(1))
+        self.backend.write(self.items(1, start=1))
+        started = time.time()
+        self.assertEqual(self.backend.claim(slots[0], 10, 0.2), None)
+        # the other slot sees the items too, but starts its own clock
+        self.assertEqual(self.backend.claim(slots[1], 10, 0.2), None)
+        batch = self.claim(self.backend, slots[0], 10, max_linger=0.2)
+        self.assertEqual(batch.slot, slots[0])
+        self.assertTrue(time.time() - started < 0.4)
+        
+    
+    def test_part_kept(self):
+        self.assertPartKept(self.backend, self.slot)
+        
+    
+    def test_orphaned_slots(self):
+        slots = self.backend.slots('test', 3)
+        self.backend.write(self.items(5))
+        self.claim(self.backend, slots[2], 5)
+        self.assertEqual(self.backend.orphaned_slots('test', 2), [slots[2]])
+        self.assertEqual(self.backend.orphaned_slots('test', 3), [])
+        
+    
+
+
+
+class TestStreamBackend(BackendTestCase):
+    
+    def setUp(self):
+        try:
+            redis.xlen(PREFIX + 'stream')
+        except ResponseError:
+            self.skipTest('redis-server < 5.0 has no streams')
+        self.backend = StreamBackend(redis, PREFIX + 'stream')
+        self.slot = self.backend.slots('test', 1)[0]
+        
+    
+    def test_reads_items_written_before_the_group(self):
+        self.backend.write(self.items(3))
+        batch = self.backend.claim(self.slot, 10)
+        self.assertEqual(batch.items, self.items(3))
+        self.assertEqual(batch.id, '%s:%s' % (batch.keys[0], batch.keys[-1]))
+        
+    
+    def test_claims_at_most_num_items(self):
+        self.backend.write(self.items(7))
+        first = self.backend.claim(self.slot, 5)
+        second = self.backend.claim(self.slot, 5)
+        self.assertEqual(first.items, self.items(5))
+        self.assertEqual(second.items, self.items(2, start=5))
+        
+    
+    def test_pending_until_acked(self):
+        self.backend.write(self.items(5))
+        batch = self.backend.claim(self.slot, 5)
+        pending = self.backend.read_pending(self.slot, 5)
+        self.assertEqual(pending.id, batch.id)
+        self.assertEqual(pending.items, batch.items)
+        self.backend.ack(batch)
+        self.assertEqual(self.backend.read_pending(self.slot, 5), None)
+        # acked entries are deleted, as well as acknowledged
+        self.assertEqual(redis.xlen(PREFIX + 'stream'), 0)
+        self.assertEqual(
+            redis.xpending(PREFIX + 'stream', 'processors')['pending'],
+            0
+        )
+        
+    
+    def test_part_kept(self):
+        self.assertPartKept(self.backend, self.slot)
+        
+    
+    def test_deleted_while_pending(self):
+        self.backend.write(self.items(3))
+        batch = self.backend.claim(self.slot, 3)
+        redis.xdel(PREFIX + 'stream', batch.keys[1])
+        pending = self.backend.read_pending(self.slot, 3)
+        self.assertEqual(pending.id, batch.id)
+        self.assertEqual(pending.items, ['item 0', 'item 2'])
+        self.backend.ack(pending)
+        self.assertEqual(self.backend.read_pending(self.slot, 3), None)
+        
+    
+    def test_reclaims_orphaned_slots(self):
+        """A slot left with a batch in flight, by running with a higher
+          concurrency, is found, and its batch read again.
+        """
+        
+        slots = self.backend.slots('test', 3)
+        self.backend.write(self.items(4))
+        batch = self.backend.claim(slots[2], 4)
+        self.assertEqual(self.backend.orphaned_slots('test', 2), [slots[2]])
+        self.assertEqual(self.backend.orphaned_slots('test', 3), [])
+        pending = self.backend.read_pending(slots[2], 4)
+        self.assertEqual(pending.id, batch.id)
+        self.backend.ack(pending)
+        self.assertEqual(self.backend.orphaned_slots('test', 2), [])
+        
+    
+    def test_linger_tops_up(self):
+        self.backend.write(self.items(2))
+        gevent.spawn_later(0.02, self.backend.write, self.items(3, start=2))
+        batch = self.backend.claim(self.slot, 5, max_linger=1)
+        self.assertEqual(batch.items, self.items(5))
+        self.assertEqual(batch.id, '%s:%s' % (batch.keys[0], batch.keys[-1]))
+        
+    
+    def test_linger_settles_for_fewer(self):
+        self.backend.write(self.items(2))
+        started = time.time()
+        batch = self.backend.claim(self.slot, 5, max_linger=0.05)
+        self.assertTrue(time.time() - started >= 0.05)
+        self.assertEqual(batch.items, self.items(2))
+        
+    
+
+
+
+class Crash(Exception):
+    pass
+    
+
+
+class TestResumingParts(BackendTestCase):
+    """A batch that was being posted in parts when the processor died is
+      carried on with the same parts, whatever the caps are on restart.
+    """
+    
+    def setUp(self):
+        self.backend = ListBackend(redis, PREFIX + 'data', PREFIX + 'notify')
+        
+    
+    def processor(self, max_items, post):
+        processor = PostingParsingQueueProcessor(
+            'test', 10, 'http://localhost/', backend=self.backend,
+            max_items=max_items, min_sleep=0
+        )
+        processor._post = post
+        return processor
+        
+    
+    def test_resumes_the_part_in_flight(self):
+        posted = []
+        def post(items, part_id):
+            posted.append(part_id)
+            if len(posted) == 2:
+                raise Crash
+            return True
+        processor = self.processor(4, post)
+        slot = processor.slots[0]
+        self.backend.write(self.items(14))
+        batch = self.claim(self.backend, slot, 10)
+        self.assertRaises(Crash, processor.deliver_forever, slot, True)
+        # restarted with bigger parts, which only apply to the next part
+        def post(items, part_id):
+            posted.append(part_id)
+            return True
+        self.processor(6, post).deliver_forever(slot, True)
+        self.assertEqual(posted, [
+            '%s.0-3' % batch.id,
+            '%s.4-7' % batch.id,
+            '%s.4-7' % batch.id,
+            '%s.8-13' % batch.id
+        ])
+        self.assertEqual(self.backend.read_pending(slot, 10), None)
+        
+    
+
+
+
+class TestParsingAhead(BackendTestCase):
+    """With a parsing pool, the next batch is claimed and parsed while the
+      one before it is being posted, even with a ``concurrency`` of one.
+    """
+    
+    def setUp(self):
+        self.backend = ListBackend(redis, PREFIX + 'data', PREFIX + 'notify')
+        claim = self.backend.claim
+        def _claim(slot, num_items, max_linger=0):
+            # the redis client isn't patched to be cooperative, so don't
+            # block the other greenlets waiting for a notification
+            if not redis.llen(PREFIX + 'notify'):
+                gevent.sleep(0.001)
+                return None
+            return claim(slot, num_items, max_linger)
+        self.backend.claim = _claim
+        self.processor = PostingParsingQueueProcessor(
+            'test', 5, 'http://localhost/', backend=self.backend,
+            item_parser=str.upper, parse_workers=1, trace_log_interval=0
+        )
+        self.addCleanup(self.processor.parsing_pool.close)
+        
+    
+    def test_parses_the_next_batch_while_posting(self):
+        processor = self.processor
+        self.assertEqual(len(processor.slots), 2)
+        events = []
+        parse = processor._parse
+        def _parse(items):
+            parsed_items = parse(items)
+            events.append('parsed')
+            return parsed_items
+        posted = []
+        def _post(items, part_id):
+            events.append('post')
+            if not posted:
+                # the second batch is claimed and parsed before the first
+                # has been posted
+                self.backend.write(self.items(5, start=5))
+                with gevent.Timeout(5):
+                    while events.count('parsed') < 2:
+                        gevent.sleep(0.001)
+            posted.append(items)
+            return True
+        processor._parse = _parse
+        processor._post = _post
+        self.backend.write(self.items(5))
+        loop = gevent.spawn(processor.loop_forever)
+        try:
+            with gevent.Timeout(5):
+                while len(posted) < 2:
+                    gevent.sleep(0.001)
+        finally:
+            loop.kill()
+        self.assertEqual(events, ['parsed', 'post', 'parsed', 'post'])
+        self.assertEqual(posted, [
+            [item.upper() for item in self.items(5)],
+            [item.upper() for item in self.items(5, start=5)]
+        ])
+        
+    
+
+
+
+if __name__ == '__main__':
+    unittest.main()
+    
\ No newline at end of file
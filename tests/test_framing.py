@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test that ``framing.StreamParser`` gets the same messages out of a
+  stream however it's sliced up, including chunk size lines, CRLFs and
+  length prefixes that are split across reads.
+"""
+
+import random
+import unittest
+
+from framing import FramingError, StreamParser
+
+MESSAGES = [
+    '{"id": 1, "text": "hi"}',
+    '{"id": 2, "text": "%s"}' % ('x' * 300),
+    '{"delete": {"status": {"id": 3}}}',
+    '{"id": 4, "text": "\\u2603"}'
+]
+
+def frame(messages, delimited='length'):
+    """The ``delimited`` body of ``messages``, with keep alive lines
+      between them.
+    """
+    
+    parts = []
+    for message in messages:
+        parts.append('\r\n')
+        if delimited == 'length':
+            parts.append('%d\r\n' % len(message))
+            parts.append(message)
+        else:
+            parts.append('%s\r\n' % message)
+    return ''.join(parts)
+    
+    
+
+def chunk(body, size):
+    """Chunk transfer encode ``body`` in chunks of up to ``size`` bytes,
+      with the odd chunk extension, and end it.
+    """
+    
+    parts = []
+    for i in xrange(0, len(body), size):
+        data = body[i:i + size]
+        extension = i % 3 and ';n=%d' % i or ''
+        parts.append('%x%s\r\n%s\r\n' % (len(data), extension, data))
+    parts.append('0\r\n\r\n')
+    return ''.join(parts)
+    
+    
+
+def feed(parser, data, sizes):
+    """Feed ``data`` to ``parser`` in slices of the ``sizes`` it yields,
+      through a reused buffer, as a consumer would from ``recv_into``,
+      and return the messages.
+    """
+    
+    buf = bytearray(4096)
+    messages = []
+    pos = 0
+    while pos < len(data):
+        n = min(next(sizes), len(data) - pos)
+        buf[:n] = data[pos:pos + n]
+        messages.extend(parser.feed(buf, 0, n))
+        pos += n
+    return messages
+    
+    
+
+
+class TestStreamParser(unittest.TestCase):
+    
+    def streams(self):
+        """``(delimited, stream)`` pairs, with chunks that split the
+          messages and their length prefixes, and chunks that don't.
+        """
+        
+        for delimited in 'length', 'newline':
+            body = frame(MESSAGES, delimited)
+            for size in 1, 3, 7, 64, len(body):
+                yield delimited, chunk(body, size)
+        
+    
+    def test_whole(self):
+        for delimited, stream in self.streams():
+            parser = StreamParser(delimited=delimited)
+            self.assertEqual(parser.feed(stream), MESSAGES)
+            self.assertTrue(parser.closed)
+        
+    
+    def test_one_byte_at_a_time(self):
+        for delimited, stream in self.streams():
+            parser = StreamParser(delimited=delimited)
+            messages = []
+            for i in xrange(len(stream)):
+                # it's closed by the last chunk's size line, before the
+                # final CRLF
+                self.assertEqual(parser.closed, len(stream) - i <= 2)
+                messages.extend(parser.feed(stream[i]))
+            self.assertEqual(messages, MESSAGES)
+            self.assertTrue(parser.closed)
+        
+    
+    def test_random_slices(self):
+        rand = random.Random(0)
+        sizes = iter(lambda: rand.randint(1, 100), None)
+        for i in xrange(20):
+            for delimited, stream in self.streams():
+                parser = StreamParser(delimited=delimited)
+                self.assertEqual(feed(parser, stream, sizes), MESSAGES)
+                self.assertTrue(parser.closed)
+        
+    
+    def test_every_split(self):
+        # covers splitting the size lines, the CRLFs after the chunks and
+        # the length prefixes at every point
+        stream = chunk(frame(MESSAGES[:2]), 16)
+        for i in xrange(len(stream) + 1):
+            parser = StreamParser()
+            messages = parser.feed(stream[:i]) + parser.feed(stream[i:])
+            self.assertEqual(messages, MESSAGES[:2])
+            self.assertTrue(parser.closed)
+        
+    
+    def test_closed(self):
+        parser = StreamParser()
+        self.assertEqual(parser.feed('5\r\n4\r\nab\r\n'), [])
+        self.assertFalse(parser.closed)
+        self.assertEqual(parser.feed('3\r\ncd\n\r\n'), ['abcd'])
+        self.assertFalse(parser.closed)
+        self.assertEqual(parser.feed('0'), [])
+        self.assertFalse(parser.closed)
+        self.assertEqual(parser.feed('\r\n\r\n2\r\nxx\r\n'), [])
+        self.assertTrue(parser.closed)
+        self.assertEqual(parser.num_chunks, 3)
+        
+    
+    def test_unchunked(self):
+        body = frame(MESSAGES)
+        parser = StreamParser(chunked=False)
+        self.assertEqual(feed(parser, body, iter(lambda: 1, None)), MESSAGES)
+        self.assertFalse(parser.closed)
+        
+    
+    def test_lost_chunk_sync(self):
+        parser = StreamParser()
+        self.assertRaises(FramingError, parser.feed, 'not hex\r\n')
+        parser = StreamParser()
+        self.assertRaises(FramingError, parser.feed, 'f' * 2000)
+        
+    
+    def test_lost_length_sync(self):
+        parser = StreamParser(chunked=False)
+        self.assertRaises(FramingError, parser.feed, '1' * 2000)
+        
+    
+
+
+if __name__ == '__main__':
+    unittest.main()
+    
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test that ``parse.parse_item``, the compiled item parser, reduces items
+  and fails the same way as ``parse.parse_item_slowly``, the reference.
+"""
+
+import logging
+import unittest
+
+import parse
+from parse import ParsingError, parse_item, parse_item_slowly
+
+STATUS = (
+    '{"id": 1, "in_reply_to_status_id": null, "in_reply_to_user_id": 2, '
+    '"retweeted_status": {"id": 3, "text": "rt"}, "text": "hi \\u00e9", '
+    '"user": {"id": 4, "screen_name": "someone", "name": "Some One"}, '
+    '"source": "web"}'
+)
+
+# valid JSON that isn't a status, statuses the projection can't reduce,
+# or not JSON at all
+EDGE_CASES = (
+    '123',
+    '[1, 2]',
+    '["in_reply_to_status_id"]',
+    '"in_reply_to_status_id"',
+    'null',
+    '{}',
+    '{"text": "no in_reply_to_status_id"}',
+    'not json',
+    '{"in_reply_to_status_id": null, "id": 1234567890123456789012345}',
+    '{"in_reply_to_status_id": null, "id": 1.7976931348623157e308}',
+    '{"in_reply_to_status_id": null, "text": "lone \\ud800"}',
+    '{"in_reply_to_status_id": null, "text": "lone \\ud800, then x"}',
+    '{"in_reply_to_status_id": null, "text": "high \\ud83d\\ud83d"}',
+    '{"in_reply_to_status_id": null, "text": "low \\ude00\\ud83d"}',
+    '{"in_reply_to_status_id": null, "text": "\\\\ud83d\\ude00"}',
+    '{"in_reply_to_status_id": null, "text": "pair \\ud83d\\ude00"}',
+    '{"in_reply_to_status_id": null, "text": "pair \\uD83D\\uDE00"}',
+    '{"delete": {"status": {"id": 1}}, "in_reply_to_status_id": 2}',
+    '{"in_reply_to_status_id": null, "user": {"id": 4}}',
+    '{"in_reply_to_status_id": null, "user": [4]}',
+    '{"in_reply_to_status_id": null, "user": "someone"}',
+    '{"in_reply_to_status_id": null, "retweeted_status": {}}'
+)
+
+class TestParseItem(unittest.TestCase):
+    
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        
+    
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+        
+    
+    def outcome(self, item_parser, item):
+        try:
+            return item_parser(item)
+        except Exception, err:
+            return type(err)
+        
+    
+    def test_status(self):
+        self.assertEqual(parse_item(STATUS), parse_item_slowly(STATUS))
+        
+    
+    def test_notices_pass_through(self):
+        for item in ('{"delete": {"status": {"id": 1}}}', '{"limit": {"track": 1}}'):
+            self.assertEqual(parse_item(item), item)
+            self.assertEqual(parse_item_slowly(item), item)
+        
+    
+    def test_not_an_object(self):
+        for item in ('123', '[1, 2]', '["in_reply_to_status_id"]', 'null'):
+            self.assertRaises(ParsingError, parse_item, item)
+            self.assertRaises(ParsingError, parse_item_slowly, item)
+        
+    
+    def assertSameOutcomes(self):
+        for item in (STATUS,) + EDGE_CASES:
+            self.assertEqual(
+                self.outcome(parse_item, item),
+                self.outcome(parse_item_slowly, item),
+                item
+            )
+        
+    
+    def test_edge_cases(self):
+        self.assertSameOutcomes()
+        
+    
+    def test_edge_cases_with_each_decoder(self):
+        decoders = [parse.json.loads]
+        if parse.ujson is not None:
+            decoders.append(parse._ujson_loads)
+        for decoder in decoders:
+            self.patch(parse, '_loads', decoder)
+            self.assertSameOutcomes()
+        
+    
+
+
+
+if __name__ == '__main__':
+    unittest.main()
+    
+    
\ No newline at end of file
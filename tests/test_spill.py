@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the ``spill.SpillQueue`` and ``consumer.Batcher``'s use of it,
+  including what survives a "crash", i.e.: reopening without closing.
+"""
+
+import logging
+import shutil
+import tempfile
+import unittest
+
+import gevent
+
+from consumer import Batcher
+from spill import HEADER, SpillQueue
+
+class FlakyBackend(object):
+    """Records the batches written to it, failing the writes numbered in
+      ``failures``, counting from ``0``.
+    """
+    
+    def __init__(self, *failures):
+        self.failures = set(failures)
+        self.writes = 0
+        self.batches = []
+        
+    
+    def write(self, items):
+        n = self.writes
+        self.writes += 1
+        if n in self.failures:
+            raise IOError('redis is down')
+        self.batches.append(list(items))
+        
+    
+    def items(self):
+        return [item for batch in self.batches for item in batch]
+        
+    
+
+
+class SpillTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='close.test.')
+        
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        
+    
+    def items(self, n, start=0):
+        return ['item %d' % i for i in xrange(start, start + n)]
+        
+    
+    def read_all(self, queue):
+        return [queue.get() for i in xrange(len(queue))]
+        
+    
+
+
+
+class TestSpillQueue(SpillTestCase):
+    
+    def test_reopen_without_close(self):
+        """Everything put, less what was committed, is read again.
+        """
+        
+        queue = SpillQueue(self.directory)
+        for item in self.items(10):
+            queue.put(item)
+        for i in xrange(4):
+            queue.get()
+        queue.commit()
+        # read but not committed, so they should be read again
+        queue.get()
+        queue.get()
+        queue.sync()
+        recovered = SpillQueue(self.directory)
+        self.assertEqual(len(recovered), 6)
+        self.assertEqual(self.read_all(recovered), self.items(6, start=4))
+        
+    
+    def test_reopen_across_segments(self):
+        queue = SpillQueue(self.directory, segment_size=64)
+        for item in self.items(20):
+            queue.put(item)
+        for i in xrange(15):
+            queue.get()
+        queue.commit()
+        queue.sync()
+        recovered = SpillQueue(self.directory, segment_size=64)
+        self.assertEqual(self.read_all(recovered), self.items(5, start=15))
+        recovered.commit()
+        recovered.put('more')
+        self.assertEqual(recovered.get(), 'more')
+        
+    
+    def test_torn_data(self):
+        """Data written without its length, which goes in last, is ignored.
+        """
+        
+        queue = SpillQueue(self.directory)
+        for item in self.items(3):
+            queue.put(item)
+        queue.sync()
+        pos = queue._wpos
+        queue._wmap[pos + HEADER.size:pos + HEADER.size + 5] = 'items'
+        recovered = SpillQueue(self.directory)
+        self.assertEqual(len(recovered), 3)
+        recovered.put('item 3')
+        self.assertEqual(self.read_all(recovered), self.items(4))
+        
+    
+    def test_torn_length(self):
+        """A length that runs off the end of the segment is ignored.
+        """
+        
+        queue = SpillQueue(self.directory, segment_size=256)
+        for item in self.items(3):
+            queue.put(item)
+        queue.sync()
+        pos = queue._wpos
+        queue._wmap[pos:pos + HEADER.size] = HEADER.pack(1024)
+        recovered = SpillQueue(self.directory, segment_size=256)
+        self.assertEqual(len(recovered), 3)
+        self.assertEqual(self.read_all(recovered), self.items(3))
+        
+    
+    def test_rollback(self):
+        queue = SpillQueue(self.directory)
+        for item in self.items(3):
+            queue.put(item)
+        queue.get()
+        queue.commit()
+        queue.get()
+        queue.rollback()
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(self.read_all(queue), self.items(2, start=1))
+        
+    
+
+
+
+class TestBatcher(SpillTestCase):
+    
+    def setUp(self):
+        super(TestBatcher, self).setUp()
+        # the failed flushes are logged, with their tracebacks
+        logging.disable(logging.WARNING)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        
+    
+    def make_batcher(self, backend, spill=True):
+        spill_queue = None
+        if spill:
+            spill_queue = SpillQueue(self.directory)
+        batcher = Batcher(
+            max_batch_size=10,
+            max_linger=0,
+            retry_delay=0,
+            spill=spill_queue,
+            backend=backend
+        )
+        self.addCleanup(batcher._flusher.kill)
+        return batcher
+        
+    
+    def wait_for(self, backend, n, timeout=5):
+        with gevent.Timeout(timeout):
+            while len(backend.items()) < n:
+                gevent.sleep(0.001)
+        
+    
+    def test_flush_failure_keeps_order(self):
+        """A batch that fails mid way through goes back at the front.
+        """
+        
+        backend = FlakyBackend(1)
+        batcher = self.make_batcher(backend, spill=False)
+        batcher.items.extend(self.items(25))
+        batcher.flush()
+        self.assertRaises(IOError, batcher.flush)
+        self.assertEqual(batcher.items, self.items(15, start=10))
+        batcher.flush()
+        batcher.flush()
+        self.assertEqual(backend.items(), self.items(25))
+        self.assertEqual(
+            [len(batch) for batch in backend.batches],
+            [10, 10, 5]
+        )
+        
+    
+    def test_drain_rolls_back_failed_write(self):
+        backend = FlakyBackend(1)
+        batcher = self.make_batcher(backend)
+        batcher.items.extend(self.items(25))
+        batcher._spill()
+        self.assertEqual(batcher.items, [])
+        self.assertRaises(IOError, batcher._drain)
+        self.assertEqual(len(batcher.spill), 15)
+        # and, if we crashed now, the rolled back items would be read again
+        batcher.spill.sync()
+        recovered = SpillQueue(self.directory)
+        self.assertEqual(self.read_all(recovered), self.items(15, start=10))
+        batcher._drain()
+        self.assertEqual(len(batcher.spill), 0)
+        self.assertEqual(backend.items(), self.items(25))
+        
+    
+    def test_spill_appends_in_order(self):
+        backend = FlakyBackend()
+        batcher = self.make_batcher(backend)
+        batcher.items.extend(self.items(5))
+        batcher._spill()
+        batcher.items.extend(self.items(5, start=5))
+        batcher._spill()
+        batcher._drain()
+        self.assertEqual(backend.items(), self.items(10))
+        
+    
+    def test_recovers_with_spill(self):
+        """Items added while the backend is down are spilled and then
+          written, in order, once it's back.
+        """
+        
+        backend = FlakyBackend(0, 1, 2)
+        batcher = self.make_batcher(backend)
+        for item in self.items(50):
+            batcher.add(item)
+        self.wait_for(backend, 50)
+        self.assertEqual(backend.items(), self.items(50))
+        self.assertEqual(len(batcher.spill), 0)
+        self.assertEqual(batcher.items, [])
+        
+    
+    def test_recovers_without_spill(self):
+        backend = FlakyBackend(0, 1, 2)
+        batcher = self.make_batcher(backend, spill=False)
+        for item in self.items(50):
+            batcher.add(item)
+        self.wait_for(backend, 50)
+        self.assertEqual(backend.items(), self.items(50))
+        self.assertEqual(batcher.items, [])
+        
+    
+
+
+
+if __name__ == '__main__':
+    unittest.main()
+    
\ No newline at end of file